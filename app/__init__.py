@@ -3,14 +3,25 @@ import os
 from datetime import datetime
 import pandas as pd
 import logging
-from flask import Flask, request, Response # Response, make_response
+from flask import Flask, request, Response, send_file # Response, make_response
 from time import perf_counter
 import requests
 import traceback
 import numpy as np
 import re
-from utils.query import Query, Filter 
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.query import Query, Filter, QueryCostError, NeighborhoodQuery, HistoryQuery
 from utils.database import Database
+from utils import formats
+from utils.bitmaps import BitmapIndex
+from utils.kmers import KmerIndex
+from utils.store import SequenceStore
+from utils.metadata import MetadataCache
+from utils.singleflight import SingleFlight
+from utils.jobs import JobQueue, JobQueueFullError
 import traceback
 
 from typing import List, Generator, Dict, Tuple
@@ -20,6 +31,63 @@ from typing import List, Generator, Dict, Tuple
 # Tells Flask the name of the current module. 
 app = Flask(__name__)
 
+# Record the shape of every query, so scripts/advise.py can recommend indices. This is off unless a path is given in the environment, 
+# e.g. FINDABUG_QUERY_LOG=/home/prichter/microbes-data1/findabug/queries.jsonl. 
+Query.log_path = os.environ.get('FINDABUG_QUERY_LOG', None)
+
+# Evaluate filters on the metadata table in memory, so that the large tables don't need to be joined to it. 
+Filter.metadata_cache = MetadataCache()
+
+# Used to share the results of identical count and get requests which arrive at the same time. 
+single_flight = SingleFlight()
+
+# Runs export jobs in the background, writing the results to disk. 
+export_jobs = JobQueue(os.path.join(Database.index_dir, 'exports'))
+
+# The total number of results for recent paginated requests, keyed by table and filter string, so that the total only needs to be 
+# computed for the first page requested. 
+total_counts = dict()
+total_counts_lock = threading.Lock()
+max_total_counts = 10000
+
+# The maximum number of queries which can be sent in a single request to /batch. 
+max_batch_size = 100
+
+# The maximum number of candidate proteins a motif can match in the k-mer index before a request to /search is rejected. This is also
+# the maximum number of proteins which are scanned for a motif which is too short to search using the index. 
+max_search_candidates = 100000
+
+# The number of gene IDs looked up in the sequence store at a time by /sequences. 
+sequences_chunk_size = 10000
+
+
+def get_option(url:str, option:str) -> Tuple[str, str]:
+    '''Extract an option of the form [option]value from the URL, e.g. [format]parquet. Returns the value (None if the option 
+    is not present) and the URL with the option removed, so that it is not mistaken for part of the filter string.'''
+    match = re.search(f'(\\[and\\])?\\[{option}\\]([^\\[&]+)(\\[and\\])?', url)
+    if match is None:
+        return None, url
+    # Make sure to keep the connector if the option is sandwiched between two filters. 
+    connector = '[and]' if (match.group(1) is not None) and (match.group(3) is not None) else ''
+    return match.group(2), url.replace(match.group(0), connector)
+
+
+def get_versions(versions:str) -> List[int]:
+    '''Parse the value of the [versions] option, which is either a comma-separated list of GTDB releases (e.g. 207,214) or all. Returns
+    None if all releases should be queried.'''
+    return None if (versions == 'all') else [int(version) for version in versions.split(',')]
+
+
+def stream(chunks, database:Database, format_:str, fields:List[str]=None, columns=None) -> Generator:
+    '''Write the query results in the specified format as they are read from the database, closing the 
+    database connection once the response has been sent. The columns selected by the query are used to get the types of the 
+    fields in the Parquet and Arrow formats.'''
+    try:
+        for data in formats.write(chunks, format_, fields=fields, columns=columns):
+            yield data
+    finally:
+        database.close()
+
 
 @app.route('/')
 def welcome():
@@ -30,20 +98,58 @@ def welcome():
 def count(table_name:str=None, debug:bool=False) -> Tuple[requests.Response, int, Dict[str, str]]:
     url = request.url # Get the URL that was sent to the app. How does this work, I wonder?
 
-    if '[page]' in url: # Make sure page is not included in the count URL. 
-        url = re.sub('\[page\](\d+)', '', url)
+    _, url = get_option(url, 'page') # Make sure page is not included in the count URL. 
+    versions, url = get_option(url, 'versions') # The GTDB releases to count across, if the table name doesn't include a version. 
+    approx = '[approx]' in url # Whether or not to return an estimate instead of an exact count. 
+    if approx:
+        url = url.replace('[and][approx]', '').replace('[approx][and]', '').replace('[approx]', '')
+    parallel = '[parallel]' in url # Whether or not to split the count across multiple connections. 
+    if parallel:
+        url = url.replace('[and][parallel]', '').replace('[parallel][and]', '').replace('[parallel]', '')
 
     url = url.replace('https://microbes.gps.caltech.edu/count/', '') # Remove the front part from the URL. 
     filter_string = None if '?' not in url else url.split('?')[-1] # Extract the filter information, if present.
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string # Handle case of empty filter string. 
+
+    if debug:
+        return get_count(table_name, filter_string, approx=approx, parallel=parallel, versions=versions, debug=True)
+    # Identical counts which are requested at the same time share a single query. 
+    return single_flight.do(('count', table_name, Filter.normalize(filter_string), approx, parallel, versions), get_count, table_name, filter_string, approx=approx, parallel=parallel, versions=versions)
+
 
+def get_count(table_name:str, filter_string:str, approx:bool=False, parallel:bool=False, versions:str=None, debug:bool=False) -> Tuple[str, int, Dict[str, str]]:
+    '''Run a count query, and return the response. If versions is given, the count for each GTDB release is returned as a CSV.'''
     database = Database(reflect=True)
 
     try:
+        if versions is not None:
+            if approx or parallel:
+                raise ValueError('get_count: [approx] and [parallel] can\'t be combined with [versions].')
+            result = HistoryQuery(database, table_name, versions=get_versions(versions), filter_string=filter_string).count(database, debug=debug)
+            database.close()
+            if debug:
+                return result, 200, {'Content-Type':'text/plain'}
+            return ''.join(formats.write([[{'version':version, 'count':count} for version, count in result.items()]], 'csv')), 200, {'Content-Type':'text/plain'}
         query = Query(database, table_name, filter_string=filter_string)
-        result = query.count(database, debug=debug)
+        if approx and not debug:
+            # The error bound is returned in a header, so the body can be parsed the same way as an exact count. 
+            result, error = query.approx_count(database)
+            database.close()
+            return str(result), 200, {'Content-Type':'text/plain', 'X-Count-Error':str(error)}
+        if approx:
+            result = query.approx_count(database, debug=True)
+        elif parallel:
+            result = query.parallel_count(database, debug=debug)
+        else:
+            result = query.count(database, debug=debug)
         database.close()
         return str(result), 200, {'Content-Type':'text/plain'}
 
+    except QueryCostError as err: # The query was rejected for being too expensive, which is the client's problem. 
+
+        database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
+
     except Exception as err:
 
         database.close()
@@ -54,27 +160,167 @@ def count(table_name:str=None, debug:bool=False) -> Tuple[requests.Response, int
 def get(table_name:str=None, debug:bool=False) -> Tuple[requests.Response, int, Dict[str, str]]:
     '''Handles a data retrieval request to the server.'''
     url = request.url # Get the URL that was sent to the app. How does this work, I wonder?
-    page = 0
-    if '[page]' in url: # Removes the page from the URL string. 
-        page = int(re.search('\[page\](\d+)', url).group(1))
-        url = url.replace(f'[page]{page}', '')
+    page, url = get_option(url, 'page') # Removes the page from the URL string, along with any extra connectors. 
+    paged = page is not None
+    page = 0 if (page is None) else int(page)
+    format_, url = get_option(url, 'format') # Output format can be specified in the URL, or using the Accept header. 
+    fields, url = get_option(url, 'fields') # Comma-separated list of fields to include in FASTA headers. 
+    fields = None if (fields is None) else fields.split(',')
+    versions, url = get_option(url, 'versions') # The GTDB releases to get results from, if the table name doesn't include a version. 
+    parallel = '[parallel]' in url # Whether or not to read the results over multiple connections. Only applies to unpaginated results. 
+    if parallel:
+        url = url.replace('[and][parallel]', '').replace('[parallel][and]', '').replace('[parallel]', '')
+    total = '[total]' in url # Whether or not to return the total number of results in the X-Total-Count header. Only applies to CSV pages. 
+    if total:
+        url = url.replace('[and][total]', '').replace('[total][and]', '').replace('[total]', '')
 
     url = url.replace('https://microbes.gps.caltech.edu/get/', '') # Remove the front part from the URL. 
     filter_string = None if '?' not in url else url.split('?')[-1] # Extract the filter information, if present.
     filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string # Handle case of empty filter string. 
+
+    try:
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+    except Exception as err:
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+    if debug:
+        return get_page(table_name, filter_string, page=page, debug=True)
+    if (format_ == 'csv') and (versions is None):
+        # Identical pages which are requested at the same time share a single query. Pages for equivalent filters which are written 
+        # differently are shared too, and have the columns in the order of the first request. 
+        return single_flight.do(('get', table_name, Filter.normalize(filter_string), page, total), get_page, table_name, filter_string, page=page, total=total)
+
     database = Database(reflect=True)
 
     try:
-        query = Query(database, table_name, page=page, page_size=500, filter_string=filter_string)
-        result = query.get(database, debug=debug)
+        # Non-CSV formats are streamed from a server-side cursor, so they are only paginated if a page is explicitly requested. 
+        if versions is not None: # The results from each release are merged, and each page has up to 500 results from each release. 
+            query = HistoryQuery(database, table_name, versions=get_versions(versions), page=page, page_size=500 if paged else None, filter_string=filter_string)
+            chunks = query.stream(database)
+        else:
+            query = Query(database, table_name, page=page, page_size=500 if paged else None, filter_string=filter_string)
+            chunks = query.parallel_stream(database) if (parallel and not paged) else query.stream(database)
+        # Get the first chunk before sending the response, so any errors executing the query are caught here. 
+        chunks = itertools.chain([next(chunks, [])], chunks)
+        return Response(stream(chunks, database, format_, fields=fields, columns=query.stmt.selected_columns), 200, {'Content-Type':formats.content_types[format_]})
+
+    except QueryCostError as err: # The query was rejected for being too expensive, which is the client's problem. 
+
         database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+
+        database.close()
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+def get_page(table_name:str, filter_string:str, page:int=0, debug:bool=False, total:bool=False) -> Tuple[str, int, Dict[str, str]]:
+    '''Retrieve a page of results as a CSV, and return the response. If total is True, the total number of results is returned in the
+    X-Total-Count header. This is computed along with the first page requested, and cached for the later pages.'''
+    database = Database(reflect=True)
+
+    try:
+        total_count = total_counts.get((table_name, filter_string), None) if total else None
+        query = Query(database, table_name, page=page, page_size=500, filter_string=filter_string)
+        result = query.get(database, debug=debug, total=(total and (total_count is None)))
 
         if debug: # If in debug mode, don't try to convert the output to a CSV.
+            database.close()
             return result, 200, {'Content-Type':'text/plain'}
 
-        data = pd.DataFrame.from_records([row._asdict() for row in result]) #, columns=result._fields)
+        rows = [row._asdict() for row in result]
+        headers = {'Content-Type':'text/plain'}
+        if total:
+            if total_count is None:
+                # Every row has the total count, but there are no rows if the page is past the end of the results, so count them separately. 
+                total_count = [row.pop('total_count') for row in rows][0] if (len(rows) > 0) else Query(database, table_name, filter_string=filter_string).count(database)
+                with total_counts_lock:
+                    if len(total_counts) >= max_total_counts: # Evict the oldest count. 
+                        total_counts.pop(next(iter(total_counts)))
+                    total_counts[(table_name, filter_string)] = total_count
+            headers['X-Total-Count'] = str(total_count)
+        database.close()
+
+        data = pd.DataFrame.from_records(rows) #, columns=result._fields)
         data = '' if len(data) == 0 else data.to_csv() # Just return an empty string if there are no results. 
-        return data, 200, {'Content-Type':'text/plain'} 
+        return data, 200, headers
+
+    except QueryCostError as err: # The query was rejected for being too expensive, which is the client's problem. 
+
+        database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+
+        database.close()
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/lookup/<table_name>', methods=['POST'])
+def lookup(table_name:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a bulk lookup request, where the body of the request is a newline-separated list of gene or genome IDs. The 
+    IDs are loaded into a temporary table and joined against the target table, and all matching rows are streamed back. 
+    The field being looked up is specified with [field], e.g. /lookup/proteins_r207?[field]genome_id, and defaults to gene_id. 
+    Additional filters can be applied in the usual way.'''
+    url = request.url
+    field, url = get_option(url, 'field')
+    field = 'gene_id' if (field is None) else field
+    format_, url = get_option(url, 'format')
+    fields, url = get_option(url, 'fields')
+    fields = None if (fields is None) else fields.split(',')
+
+    filter_string = None if '?' not in url else url.split('?')[-1]
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string
+    database = Database(reflect=True)
+
+    try:
+        if field not in ['gene_id', 'genome_id']:
+            raise ValueError(f'lookup: Lookups can only be performed on gene_id or genome_id, not {field}.')
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+
+        # Read the request body line-by-line, so the full list of IDs is never held in memory. 
+        lookup_table = database.load_ids((line.decode() for line in request.stream))
+        query = Query(database, table_name, filter_string=filter_string, lookup=(lookup_table, field))
+        chunks = query.stream(database)
+        chunks = itertools.chain([next(chunks, [])], chunks)
+        return Response(stream(chunks, database, format_, fields=fields, columns=query.stmt.selected_columns), 200, {'Content-Type':formats.content_types[format_]})
+
+    except (QueryCostError, ValueError) as err: # The query was too expensive, or the field can't be looked up, which is the client's problem. 
+
+        database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+
+        database.close()
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/summary/<table_name>')
+def summary(table_name:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request for pre-computed annotation counts from one of the summary tables, e.g. 
+    /summary/summary_kegg_r207?ko[eq]K00001[and]rank[eq]gtdb_phylum. The results are small, so they are not paginated.'''
+    url = request.url
+    format_, url = get_option(url, 'format')
+    filter_string = None if '?' not in url else url.split('?')[-1]
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string
+    database = Database(reflect=True)
+
+    try:
+        if not table_name.startswith('summary_'):
+            raise ValueError(f'summary: {table_name} is not a summary table.')
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+
+        query = Query(database, table_name, filter_string=filter_string)
+        chunks = query.stream(database)
+        chunks = itertools.chain([next(chunks, [])], chunks)
+        return Response(stream(chunks, database, format_, columns=query.stmt.selected_columns), 200, {'Content-Type':formats.content_types[format_]})
+
+    except QueryCostError as err:
+
+        database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
 
     except Exception as err:
 
@@ -82,10 +328,290 @@ def get(table_name:str=None, debug:bool=False) -> Tuple[requests.Response, int,
         return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
 
 
+@app.route('/presence/<table_name>', methods=['POST'])
+def presence(table_name:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request for a genome-by-annotation presence/absence matrix, which is read from the bitmap index for the 
+    annotations table (e.g. /presence/annotations_kegg_r207). The body of the request should be JSON with a list of features, and
+    optionally a list of genome IDs. If an operator (or, and, andnot) is also given, the genome IDs resulting from combining the
+    features are returned instead of the matrix.'''
+    url = request.url
+    format_, url = get_option(url, 'format')
+
+    try:
+        body = request.get_json()
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+        index = BitmapIndex(os.path.join(Database.index_dir, f'{table_name}.h5'))
+
+        if body.get('operator', None) is not None:
+            genome_ids = index.query(body['features'], operator=body['operator'])
+            index.close()
+            return '\n'.join(genome_ids), 200, {'Content-Type':'text/plain'}
+
+        # The whole matrix is computed up front, as it is small compared to the annotations it summarizes.
+        chunks = list(index.matrix(body['features'], genome_ids=body.get('genome_ids', None)))
+        index.close()
+        return Response(formats.write(chunks, format_), 200, {'Content-Type':formats.content_types[format_]})
+
+    except Exception as err:
+
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/sequences/<table_name>', methods=['POST'])
+def sequences(table_name:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request for the sequences of a list of genes, where the body of the request is a newline-separated list of gene IDs,
+    e.g. /sequences/proteins_r207?[format]fasta. The sequences are read from the compressed sequence store for the proteins table,
+    rather than the database. Gene IDs which are not found are ignored.'''
+    url = request.url
+    format_, url = get_option(url, 'format')
+
+    try:
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+        store = SequenceStore(os.path.join(Database.index_dir, f'{table_name}_seqs'))
+        lines = (line.decode() for line in request.stream)
+
+        def chunks():
+            # The gene IDs are looked up in chunks, so the full list of IDs is never held in memory.
+            gene_ids = list(itertools.islice(lines, sequences_chunk_size))
+            while len(gene_ids) > 0:
+                yield [{'gene_id':gene_id, 'seq':seq} for gene_id, seq in store.get(gene_ids).items()]
+                gene_ids = list(itertools.islice(lines, sequences_chunk_size))
+
+        return Response(formats.write(chunks(), format_), 200, {'Content-Type':formats.content_types[format_]})
+
+    except Exception as err:
+
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/search/<table_name>')
+def search(table_name:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request for the proteins containing a peptide or a simple motif, where x stands for any residue, e.g.
+    /search/proteins_r207?[motif]CxxCHxxxKGDAL. The k-mer index for the proteins table is used to find the candidate proteins, which are
+    loaded into a temporary table and joined against the proteins table. The candidate sequences are then checked against the
+    motif, and the matching rows are streamed back. Additional filters can be applied in the usual way. A motif without a long enough
+    stretch of residues to use the index, e.g. CxxCH, is checked against every protein matching the filters, so the filters must select 
+    at most max_search_candidates proteins, e.g. /search/proteins_r207?[motif]CxxCH[and]genome_id[eq]GB_GCA_000008085.1.'''
+    url = request.url
+    motif, url = get_option(url, 'motif')
+    format_, url = get_option(url, 'format')
+    fields, url = get_option(url, 'fields')
+    fields = None if (fields is None) else fields.split(',')
+
+    filter_string = None if '?' not in url else url.split('?')[-1]
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string
+    database = Database(reflect=True)
+
+    try:
+        if motif is None:
+            raise ValueError('search: A motif must be specified using [motif].')
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+        pattern = KmerIndex.get_pattern(motif)
+        index = KmerIndex(os.path.join(Database.index_dir, f'{table_name}_kmers'))
+        if index.is_searchable(motif):
+            candidates = list(itertools.islice(index.search(motif), max_search_candidates + 1))
+            if len(candidates) > max_search_candidates:
+                raise QueryCostError(f'search: Motif {motif} matches more than {max_search_candidates} candidate proteins. Try a more specific motif.')
+            lookup_table = database.load_ids(candidates)
+            query = Query(database, table_name, filter_string=filter_string, lookup=(lookup_table, 'gene_id'))
+        else: # Scan the sequences of the proteins selected by the filters, as long as there aren't too many of them. 
+            query = Query(database, table_name, filter_string=filter_string)
+            if Query(database, table_name, filter_string=filter_string).count(database) > max_search_candidates:
+                raise QueryCostError(f'search: Motif {motif} needs at least {index.k} residues in a row without a wildcard to be searched using the index, and the filters select more than {max_search_candidates} proteins to scan. Try a longer motif, or more selective filters.')
+        # The k-mers in the motif might not be in the right order (or the right distance apart) in the candidates, so check each sequence.
+        chunks = ([row for row in chunk if pattern.search(row['seq']) is not None] for chunk in query.stream(database))
+        chunks = itertools.chain([next(chunks, [])], chunks)
+        return Response(stream(chunks, database, format_, fields=fields, columns=query.stmt.selected_columns), 200, {'Content-Type':formats.content_types[format_]})
+
+    except (QueryCostError, ValueError) as err: # The motif is invalid or too expensive to search for, which is the client's problem. 
+
+        database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+
+        database.close()
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/neighbors/<table_name>')
+def neighbors(table_name:str=None, debug:bool=False) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request for the genomic neighborhoods of a set of anchor genes, e.g. /neighbors/annotations_kegg_r207?ko[eq]K00001[and][window]10000. 
+    The filter is applied to the annotations table to select the anchor genes, and every gene within the window (in base pairs, default 10000) 
+    on the same scaffold is returned along with its annotations from the same table.'''
+    url = request.url
+    window, url = get_option(url, 'window')
+    window = 10000 if (window is None) else int(window)
+    format_, url = get_option(url, 'format')
+
+    filter_string = None if '?' not in url else url.split('?')[-1]
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string
+    database = Database(reflect=True)
+
+    try:
+        format_ = formats.get_format(accept=request.headers.get('Accept'), format_=format_)
+        query = NeighborhoodQuery(database, table_name, filter_string=filter_string, window=window)
+        if debug:
+            result = query.get(database, debug=True)
+            database.close()
+            return result, 200, {'Content-Type':'text/plain'}
+
+        chunks = query.stream(database)
+        chunks = itertools.chain([next(chunks, [])], chunks)
+        return Response(stream(chunks, database, format_, columns=query.stmt.selected_columns), 200, {'Content-Type':formats.content_types[format_]})
+
+    except QueryCostError as err:
+
+        database.close()
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+
+        database.close()
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/batch', methods=['POST'])
+def batch() -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a batch of queries, which are run concurrently over a shared connection pool. The body of the request is a JSON list of
+    queries, each of which has a table, a filter string, a mode (count, approx, or get), and optionally a page, e.g.
+    [{"table":"annotations_kegg_r207", "filter":"ko[eq]K00001", "mode":"count"}, ...]. The results are returned as a JSON list in the
+    same order as the queries or, if NDJSON is requested using the Accept header or [format]jsonl, streamed one line per query as each
+    finishes. Each result includes the index of the query, its status code, and the time it took to run.'''
+    format_, _ = get_option(request.url, 'format')
+
+    try:
+        format_ = 'jsonl' if ((format_ == 'jsonl') or (request.headers.get('Accept') == formats.content_types['jsonl'])) else 'json'
+        specs = json.loads(request.get_data())
+        if (not isinstance(specs, list)) or (not all([isinstance(spec, dict) for spec in specs])):
+            raise ValueError('batch: The body of the request must be a JSON list of queries.')
+        if len(specs) > max_batch_size:
+            raise ValueError(f'batch: A batch can contain at most {max_batch_size} queries, but {len(specs)} were given.')
+    except Exception as err:
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    # The tables are reflected once for the whole batch, and each query gets its own session on the same engine.
+    database = Database(reflect=True)
+    pool = ThreadPoolExecutor(Query.n_workers)
+    futures = [pool.submit(run_batch_query, database, i, spec) for i, spec in enumerate(specs)]
+
+    def results():
+        try:
+            for future in (as_completed(futures) if (format_ == 'jsonl') else futures):
+                yield future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            database.close()
+
+    if format_ == 'jsonl':
+        return Response((json.dumps(result, default=str) + '\n' for result in results()), 200, {'Content-Type':formats.content_types['jsonl']})
+    return json.dumps(list(results()), default=str), 200, {'Content-Type':'application/json'}
+
+
+def run_batch_query(database:Database, index:int, spec:Dict) -> Dict:
+    '''Run a single query in a batch, and return the result along with the status code and the time taken.'''
+    start = perf_counter()
+    table_name, filter_string, mode = spec.get('table'), spec.get('filter'), spec.get('mode', 'count')
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string
+    result = {'index':index, 'table':table_name, 'filter':filter_string, 'mode':mode}
+    if mode not in ['count', 'approx', 'get']:
+        result['status'], result['message'] = 400, f'run_batch_query: Mode {mode} is not supported. Supported modes are count, approx, and get.'
+        result['time'] = perf_counter() - start
+        return result
+    forked = None
+
+    try:
+        # The connection is opened inside the try block, so a failure only affects this query. 
+        database = forked = database.fork()
+        if mode == 'count':
+            result['result'] = Query(database, table_name, filter_string=filter_string).count(database)
+        elif mode == 'approx':
+            result['result'], result['error_bound'] = Query(database, table_name, filter_string=filter_string).approx_count(database)
+        elif mode == 'get':
+            query = Query(database, table_name, page=int(spec.get('page', 0)), page_size=500, filter_string=filter_string)
+            result['result'] = [row._asdict() for row in query.get(database)]
+        result['status'] = 200
+
+    except QueryCostError as err: # The query was rejected, which is the client's problem.
+        result['status'], result['message'] = 400, str(err)
+
+    except Exception as err:
+        result['status'], result['message'] = 500, traceback.format_exc()
+
+    finally:
+        if forked is not None:
+            forked.close()
+
+    result['time'] = perf_counter() - start
+    return result
+
+
+@app.route('/export/<table_name>', methods=['POST'])
+def export(table_name:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request to export all results for a query to a file, e.g. /export/proteins_r207?gtdb_order[eq]Methanobacteriales[and][format]fasta.
+    The query is run in the background, and the job ID is returned immediately. The status of the job can be checked at /jobs/<job_id>, 
+    and the file can be downloaded from /jobs/<job_id>/result once the job is finished. The default format is csv.gz.'''
+    url = request.url
+    format_, url = get_option(url, 'format')
+    fields, url = get_option(url, 'fields')
+    fields = None if (fields is None) else fields.split(',')
+
+    filter_string = None if '?' not in url else url.split('?')[-1]
+    filter_string = None if ((filter_string is None) or (len(filter_string) == 0)) else filter_string
+
+    def task():
+        # The database connection is opened in the worker thread, so it is not tied to the request. It is closed once the output is
+        # written, or if the query fails. 
+        database = Database(reflect=True)
+        try:
+            query = Query(database, table_name, filter_string=filter_string)
+            chunks = query.stream(database)
+            chunks = itertools.chain([next(chunks, [])], chunks)
+            yield from formats.write(chunks, format_, fields=fields, columns=query.stmt.selected_columns)
+        finally:
+            database.close()
+
+    try:
+        format_ = formats.get_format(format_=('csv.gz' if (format_ is None) else format_))
+        job = export_jobs.submit(task, format_)
+        return job.job_id, 202, {'Content-Type':'text/plain', 'Location':f'/jobs/{job.job_id}'}
+
+    except JobQueueFullError as err: # Too many exports are already running, so the client should try again later. 
+
+        return str(err), 503, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id:str=None) -> Tuple[requests.Response, int, Dict[str, str]]:
+    '''Handles a request for the status of an export job, which is returned as JSON.'''
+    job = export_jobs.get(job_id)
+    if job is None:
+        return f'job_status: No job with ID {job_id}.', 404, {'Content-Type':'text/plain'}
+    return json.dumps(job.to_dict()), 200, {'Content-Type':'application/json'}
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id:str=None):
+    '''Handles a request to download the output of a finished export job.'''
+    job = export_jobs.get(job_id)
+    if job is None:
+        return f'job_result: No job with ID {job_id}.', 404, {'Content-Type':'text/plain'}
+    if job.status != 'done':
+        return f'job_result: Job {job_id} is {job.status}, so there is no result to download.', 409, {'Content-Type':'text/plain'}
+    format_ = os.path.basename(job.path).split('.', 1)[-1]
+    return send_file(job.path, mimetype=formats.content_types[format_], as_attachment=True, download_name=os.path.basename(job.path))
+
+
 @app.route('/debug/<cmd>/<table_name>')
 def debug(cmd:str=None, table_name:str=None):
 
     if cmd == 'count':
         return count(table_name=table_name, debug=True)
     elif cmd == 'get':
-        return get(table_name=table_name, debug=True)
\ No newline at end of file
+        return get(table_name=table_name, debug=True)
+    elif cmd == 'neighbors':
+        return neighbors(table_name=table_name, debug=True)
\ No newline at end of file
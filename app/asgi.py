@@ -0,0 +1,119 @@
+'''ASGI version of the Find-A-Bug app, which is served by asgi.py. Under WSGI, each request holds a worker thread for as long as its query
+runs, so the number of workers limits the number of queries in flight. Here, the /count and /get requests are handled on the event loop
+using the async engine (see Database.get_async_engine), so a single process can wait on hundreds of queries at once. Any requests the async
+path doesn't handle (e.g. the streaming formats, which rely on server-side cursors) are passed to the Flask app, which runs them in a
+thread pool as before.'''
+import traceback
+import urllib.parse
+import pandas as pd
+from asgiref.wsgi import WsgiToAsgi
+from app import app, get_option
+from utils.query import Query, QueryCostError
+from utils.database import Database
+from utils import formats
+from typing import Tuple, Dict
+
+wsgi_app = WsgiToAsgi(app)
+
+# The database is set up when the process starts. Only the table definitions are used, as queries are run using the shared async engine.
+database = None
+
+
+async def count(table_name:str, url:str) -> Tuple[str, int, Dict[str, str]]:
+    '''Async version of the /count endpoint.'''
+    _, url = get_option(url, 'page')
+    session = database.get_async_session()
+    try:
+        query = Query(database, table_name, filter_string=(url if (len(url) > 0) else None))
+        result = await query.async_count(database, session)
+        return str(result), 200, {'Content-Type':'text/plain'}
+
+    except QueryCostError as err: # The query was rejected for being too expensive, which is the client's problem.
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+    finally:
+        await session.close()
+
+
+async def get(table_name:str, url:str) -> Tuple[str, int, Dict[str, str]]:
+    '''Async version of the /get endpoint, which returns a page of results as a CSV.'''
+    page, url = get_option(url, 'page')
+    page = 0 if (page is None) else int(page)
+    _, url = get_option(url, 'format')
+    session = database.get_async_session()
+    try:
+        query = Query(database, table_name, page=page, page_size=500, filter_string=(url if (len(url) > 0) else None))
+        rows = [row._asdict() for row in await query.async_get(database, session)]
+        data = pd.DataFrame.from_records(rows)
+        data = '' if len(data) == 0 else data.to_csv() # Just return an empty string if there are no results.
+        return data, 200, {'Content-Type':'text/plain'}
+
+    except QueryCostError as err:
+        return str(err), 400, {'Content-Type':'text/plain'}
+
+    except Exception as err:
+        return traceback.format_exc(), 500, {'Content-Type':'text/plain'}
+
+    finally:
+        await session.close()
+
+
+def get_handler(scope:Dict):
+    '''Get the async handler for a request, or None if the request should be handled by the Flask app.'''
+    path = scope['path'].strip('/').split('/')
+    if (len(path) != 2) or (scope['method'] != 'GET'):
+        return None
+    endpoint, url = path[0], urllib.parse.unquote(scope['query_string'].decode())
+
+    if endpoint == 'count':
+        # Approximate, parallel, and cross-release counts are not handled asynchronously.
+        return None if (('[approx]' in url) or ('[parallel]' in url) or ('[versions]' in url)) else count
+    if endpoint == 'get':
+        if ('[parallel]' in url) or ('[total]' in url) or ('[fields]' in url) or ('[versions]' in url):
+            return None
+        headers = {key.decode().lower():value.decode() for key, value in scope['headers']}
+        format_, _ = get_option(url, 'format')
+        try:
+            format_ = formats.get_format(accept=headers.get('accept'), format_=format_)
+        except Exception: # Let the Flask app return the error.
+            return None
+        return get if (format_ == 'csv') else None
+    return None
+
+
+async def lifespan(receive, send):
+    global database
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                database = Database(reflect=False)
+                await database.async_reflect()
+                await send({'type':'lifespan.startup.complete'})
+            except Exception:
+                await send({'type':'lifespan.startup.failed', 'message':traceback.format_exc()})
+        elif message['type'] == 'lifespan.shutdown':
+            await database.async_close()
+            await send({'type':'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope:Dict, receive, send):
+
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = get_handler(scope) if (scope['type'] == 'http') else None
+    if handler is None:
+        await wsgi_app(scope, receive, send)
+        return
+
+    table_name = scope['path'].strip('/').split('/')[-1]
+    url = urllib.parse.unquote(scope['query_string'].decode())
+    body, status, headers = await handler(table_name, url)
+    await send({'type':'http.response.start', 'status':status, 'headers':[(key.lower().encode(), value.encode()) for key, value in headers.items()]})
+    await send({'type':'http.response.body', 'body':body.encode()})
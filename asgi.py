@@ -0,0 +1,6 @@
+from app.asgi import application
+
+# Launch the ASGI app when the file is called. In production, run e.g. uvicorn asgi:application --workers 4.
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, port=8001, host='0.0.0.0')
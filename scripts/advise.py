@@ -0,0 +1,22 @@
+'''Script for recommending indices for the Find-A-Bug database, based on the shapes of the queries recorded in the query log.'''
+import os
+import argparse
+from utils.database import Database
+from utils.advisor import load_log, advise
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log-path', default=os.path.join(Database.index_dir, 'queries.jsonl'), type=str, help='The path to the query log written by the app.')
+    parser.add_argument('--n', default=10, type=int, help='The maximum number of indices to recommend.')
+    args = parser.parse_args()
+
+    entries = load_log(args.log_path)
+    results = advise(entries, Database.tables)
+    print(f'advise: Read {len(entries)} queries from the log. Found {len(results)} missing indices.')
+
+    for row in results.head(args.n).itertuples():
+        cols = row.columns.split(',')
+        # Print the declaration which should be added to the __table_args__ of the table in utils/tables.py. 
+        print(f"{row.table}: Index('ix_{row.table}_{'_'.join(cols)}', {', '.join([repr(col) for col in cols])}) would be used by {row.n_queries} queries, which examined an estimated {row.cost} rows.")
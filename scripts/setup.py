@@ -3,6 +3,13 @@ import os
 os.sys.path.append('../utils/')
 import argparse
 from utils.database import Database
+from utils.bitmaps import BitmapIndex
+from utils.kmers import KmerIndex
+from utils.store import SequenceStore
+from utils.taxonomy import build_taxonomy
+from utils.tables import VOCABULARIES
+import sqlalchemy
+from sqlalchemy import select
 from utils.files import * 
 from tqdm import tqdm
 import zipfile 
@@ -114,6 +121,7 @@ def upload(paths:List[str], table_name:str, file_class:File):
         file = file_class(path, version=VERSION)
         entries += file.entries()
     try:
+        entries = DATABASE.encode(table_name, entries) # Replace the KO, Pfam, and InterPro fields with their vocabulary IDs. 
         DATABASE.bulk_upload(table_name, entries)
     except pymysql.err.IntegrityError as err:
         # In case of an exception, switch to uploading one at a time to figure out where the problem is. 
@@ -154,6 +162,79 @@ def upload_proteins(paths:List[Tuple[str, str]], table_name:str, file_class:Prot
     return len(entries) - len(failed_entries)
 
 
+def upload_metadata(paths:List[str]):
+    '''Upload the metadata files to the metadata table, and build the taxonomy table. These are handled together because the 
+    taxonomy indices in the metadata table are assigned by sorting all genomes (from every file) by lineage.'''
+    data = pd.concat([MetadataFile(path, version=VERSION).dataframe() for path in paths])
+    data, nodes = build_taxonomy(data)
+    data['version'], nodes['version'] = VERSION, VERSION
+
+    DATABASE.bulk_upload(f'metadata_r{VERSION}', data.to_dict(orient='records'))
+    DATABASE.bulk_upload(f'taxonomy_r{VERSION}', nodes.to_dict(orient='records'))
+    print(f'upload_metadata: {len(data)} genomes and {len(nodes)} taxonomy nodes were written to the database.')
+
+
+def check_schema(table_name:str):
+    '''Make sure a table which is not being re-created has every column defined in utils/tables.py. Columns added since the table
+    was created (e.g. the sequence composition columns of the proteins table) can only be filled in by re-loading it with --drop-existing.'''
+    if not DATABASE.has_table(table_name):
+        raise RuntimeError(f'check_schema: Table {table_name} does not exist. Run the setup script with --drop-existing to create and load it.')
+    existing_columns = [col['name'] for col in sqlalchemy.inspect(DATABASE.engine).get_columns(table_name)]
+    missing_columns = [col.name for col in DATABASE.get_table(table_name).__table__.c if (col.name not in existing_columns)]
+    if len(missing_columns) > 0:
+        raise RuntimeError(f"check_schema: Table {table_name} is missing the columns {', '.join(missing_columns)}. Run the setup script with --drop-existing to re-create and re-load it.")
+
+
+def build_bitmap_index(table_name:str, field:str):
+    '''Build the bitmap index for an annotations table, which maps each annotation to the genomes which carry it. The (annotation, genome)
+    pairs are streamed from the database in order of annotation, so that only one bitmap needs to be held in memory at a time.'''
+    table, metadata_table = DATABASE.get_table(table_name), DATABASE.get_table(f'metadata_r{VERSION}')
+    genome_ids = DATABASE.session.execute(select(metadata_table.genome_id)).scalars().all()
+
+    # The annotations are dictionary-encoded, so the values need to be read from the vocabulary table. 
+    vocabulary, id_field = VOCABULARIES[field]
+    vocabulary_table = DATABASE.get_table(f'vocabulary_{vocabulary}_r{VERSION}')
+    stmt = select(getattr(vocabulary_table, field), table.genome_id).distinct().select_from(table)
+    stmt = stmt.join(vocabulary_table, getattr(table, id_field) == getattr(vocabulary_table, id_field)).order_by(getattr(vocabulary_table, field))
+    result = DATABASE.session.execute(stmt, execution_options={'stream_results':True, 'yield_per':100000})
+
+    def groups():
+        feature, feature_genome_ids = None, []
+        for row in result:
+            if (row[0] != feature) and (feature is not None):
+                yield feature, feature_genome_ids
+                feature_genome_ids = []
+            feature = row[0]
+            feature_genome_ids.append(row[1])
+        if feature is not None:
+            yield feature, feature_genome_ids
+
+    BitmapIndex.build(os.path.join(Database.index_dir, f'{table_name}.h5'), genome_ids, groups())
+    result.close()
+
+
+def build_kmer_index(table_name:str):
+    '''Build the k-mer index over the amino acid sequences in the proteins table, which is used to search for peptides and motifs. The
+    sequences are streamed from the database, and the index is written one shard at a time.'''
+    table = DATABASE.get_table(table_name)
+    stmt = select(table.gene_id, table.seq)
+    result = DATABASE.session.execute(stmt, execution_options={'stream_results':True, 'yield_per':100000})
+    KmerIndex.build(os.path.join(Database.index_dir, f'{table_name}_kmers'), ((row[0], row[1]) for row in result))
+    result.close()
+
+
+def build_sequence_store(paths:List[str], table_name:str):
+    '''Build the compressed sequence store for a proteins table from the original amino acid FASTA files, so that sequences can be
+    served without reading them from the database. The files are parsed one at a time.'''
+    def entries():
+        for path in tqdm(paths, desc='build_sequence_store'):
+            file = ProteinsFile(path, version=VERSION)
+            for header, seq in zip(file.headers, file.seqs):
+                yield ProteinsFile.parse_header(header)['gene_id'], seq
+
+    SequenceStore.build(os.path.join(Database.index_dir, f'{table_name}_seqs'), entries())
+
+
 def parallelize(paths:List[str], upload_func, table_name:str, file_class:File, chunk_size:int=100):
 
     # reset_progress(len(paths), desc=f'parallelize: Uploading to table {table_name}...')
@@ -188,7 +269,7 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', default=207, type=int, help='The GTDB version to upload to the SQL database.')
-    parser.add_argument('--drop-existing', action='store_true')
+    parser.add_argument('--drop-existing', action='store_true', help='Re-create and re-load every table for the GTDB version, including the metadata and proteins tables.')
     # parser.add_argument('--parallelize', action='store_true')
     args = parser.parse_args()
 
@@ -200,45 +281,81 @@ if __name__ == '__main__':
     
     data_dir = os.path.join(DATA_DIR, f'r{VERSION}')
 
-    # if args.drop_existing:
-    #     for table_name in DATABASE.table_names[::-1]:
-    #         print(f'Dropping existing table {table_name}.')
-    #         DATABASE.drop(table_name)
-
-    # for table_name in DATABASE.table_names:
-    #     print(f'Initializing table {table_name}.')
-    #     DATABASE.create(table_name)
-
-    DATABASE.drop('annotations_pfam_r207')
-    DATABASE.create('annotations_pfam_r207')
+    if args.drop_existing:
+        # The metadata and proteins tables have columns which are computed when they are uploaded (the taxonomy indices, the sequence
+        # composition), so they can't be added to an existing table, and every table for the release is re-created and re-loaded.
+        table_names = [table_name for table_name in DATABASE.table_names if table_name.endswith(f'_r{VERSION}')]
+        for table_name in table_names[::-1]:
+            print(f'Dropping existing table {table_name}.')
+            DATABASE.drop(table_name)
+        for table_name in table_names:
+            print(f'Initializing table {table_name}.')
+            DATABASE.create(table_name)
+    else:
+        # The metadata, taxonomy, and proteins tables are kept, so make sure they have the columns the app expects. 
+        for table_name in [f'metadata_r{VERSION}', f'taxonomy_r{VERSION}', f'proteins_r{VERSION}']:
+            check_schema(table_name)
+
+        # The KO, Pfam, and InterPro fields of the annotations tables are dictionary-encoded, so both annotations tables are re-loaded along 
+        # with the vocabulary tables. The annotations tables refer to the vocabulary tables, so they are dropped first and created last. 
+        annotations_table_names = [f'annotations_kegg_r{VERSION}', f'annotations_pfam_r{VERSION}']
+        for table_name in annotations_table_names:
+            DATABASE.drop(table_name)
+        for table_name in [f'vocabulary_ko_r{VERSION}', f'vocabulary_pfam_r{VERSION}', f'vocabulary_interpro_r{VERSION}']:
+            DATABASE.drop(table_name)
+            DATABASE.create(table_name)
+        for table_name in annotations_table_names:
+            DATABASE.create(table_name)
+
+        # The summary and boundaries tables are rebuilt from scratch after every load. 
+        for table_name in [f'summary_kegg_r{VERSION}', f'summary_pfam_r{VERSION}', f'boundaries_r{VERSION}']:
+            DATABASE.drop(table_name)
+            DATABASE.create(table_name)
 
     DATABASE.reflect()
 
     # NOTE: Table uploads must be done sequentially, i.e. the entire metadata table needs to be up before anything else. 
-
-    # print(f'Uploading to the metadata_r{VERSION} table.')
-    # metadata_paths = glob.glob(os.path.join(data_dir, '*metadata*.tsv')) # This should output the full paths. 
-    # # upload(metadata_paths, database, f'metadata_r{VERSION}', MetadataFile)
-    # upload(metadata_paths, f'metadata_r{VERSION}', MetadataFile)
-
-    # # Need to upload amino acid and nucleotide data simultaneously.
-    # print(f'Uploading to the proteins_r{VERSION} table.')
-    # proteins_aa_dir, proteins_nt_dir = os.path.join(data_dir, 'proteins_aa'), os.path.join(data_dir, 'proteins_nt')
-    # proteins_aa_paths = [os.path.join(proteins_aa_dir, file_name) for file_name in os.listdir(proteins_aa_dir) if (file_name != 'gtdb_release_tk.log.gz')]
-    # proteins_nt_paths = [os.path.join(proteins_nt_dir, file_name) for file_name in os.listdir(proteins_nt_dir)]
-    # paths = [(aa_path, nt_path) for aa_path, nt_path in zip(sorted(proteins_aa_paths), sorted(proteins_nt_paths))]
-    # # parallelize(paths, upload_proteins, database, f'proteins_r{VERSION}', ProteinsFile)
-    # parallelize(paths, upload_proteins, f'proteins_r{VERSION}', ProteinsFile)
-
-    # print(f'Uploading to the annotations_kegg_r{VERSION} table.')
-    # annotations_kegg_dir = os.path.join(data_dir, 'annotations_kegg')
-    # paths = [os.path.join(annotations_kegg_dir, file_name) for file_name in os.listdir(annotations_kegg_dir)]
-    # parallelize(paths, upload, f'annotations_kegg_r{VERSION}', KeggAnnotationsFile)
+    if args.drop_existing:
+        print(f'Uploading to the metadata_r{VERSION} and taxonomy_r{VERSION} tables.')
+        metadata_paths = glob.glob(os.path.join(data_dir, '*metadata*.tsv')) # This should output the full paths. 
+        upload_metadata(metadata_paths)
+
+        # Need to upload amino acid and nucleotide data simultaneously.
+        print(f'Uploading to the proteins_r{VERSION} table.')
+        proteins_aa_dir, proteins_nt_dir = os.path.join(data_dir, 'proteins_aa'), os.path.join(data_dir, 'proteins_nt')
+        proteins_aa_paths = [os.path.join(proteins_aa_dir, file_name) for file_name in os.listdir(proteins_aa_dir) if (file_name != 'gtdb_release_tk.log.gz')]
+        proteins_nt_paths = [os.path.join(proteins_nt_dir, file_name) for file_name in os.listdir(proteins_nt_dir)]
+        paths = [(aa_path, nt_path) for aa_path, nt_path in zip(sorted(proteins_aa_paths), sorted(proteins_nt_paths))]
+        parallelize(paths, upload_proteins, f'proteins_r{VERSION}', ProteinsFile)
+
+    print(f'Uploading to the annotations_kegg_r{VERSION} table.')
+    annotations_kegg_dir = os.path.join(data_dir, 'annotations_kegg')
+    paths = [os.path.join(annotations_kegg_dir, file_name) for file_name in os.listdir(annotations_kegg_dir)]
+    parallelize(paths, upload, f'annotations_kegg_r{VERSION}', KeggAnnotationsFile)
 
     print(f'Uploading to the annotations_pfam_r{VERSION} table.')
     annotations_pfam_dir = os.path.join(data_dir, 'annotations_pfam')
     paths = [os.path.join(annotations_pfam_dir, file_name) for file_name in os.listdir(annotations_pfam_dir)]
     parallelize(paths, upload, f'annotations_pfam_r{VERSION}', PfamAnnotationsFile)
 
+    print(f'Building the summary_kegg_r{VERSION} and summary_pfam_r{VERSION} tables.')
+    DATABASE.build_summary(f'summary_kegg_r{VERSION}', f'annotations_kegg_r{VERSION}', f'metadata_r{VERSION}', 'ko')
+    DATABASE.build_summary(f'summary_pfam_r{VERSION}', f'annotations_pfam_r{VERSION}', f'metadata_r{VERSION}', 'pfam')
+
+    print(f'Building the boundaries_r{VERSION} table.')
+    DATABASE.build_boundaries(f'boundaries_r{VERSION}', f'metadata_r{VERSION}')
+
+    print(f'Building the bitmap indices for the annotations_kegg_r{VERSION} and annotations_pfam_r{VERSION} tables.')
+    build_bitmap_index(f'annotations_kegg_r{VERSION}', 'ko')
+    build_bitmap_index(f'annotations_pfam_r{VERSION}', 'pfam')
+
+    print(f'Building the k-mer index for the proteins_r{VERSION} table.')
+    build_kmer_index(f'proteins_r{VERSION}')
+
+    print(f'Building the sequence store for the proteins_r{VERSION} table.')
+    proteins_aa_dir = os.path.join(data_dir, 'proteins_aa')
+    proteins_aa_paths = [os.path.join(proteins_aa_dir, file_name) for file_name in os.listdir(proteins_aa_dir) if (file_name != 'gtdb_release_tk.log.gz')]
+    build_sequence_store(sorted(proteins_aa_paths), f'proteins_r{VERSION}')
+
     DATABASE.close()
     
\ No newline at end of file
@@ -0,0 +1,53 @@
+'''Shared set-up for the tests which use SQLite as a stand-in for MariaDB. Each test case gets its own database file, which is filled in
+by overriding SQLiteTestCase.populate.'''
+import unittest
+import os
+import tempfile
+import sqlalchemy
+from utils.database import Database
+from utils.query import Query, Filter
+from utils.tables import Reflected
+
+GENOME_IDS = [f'GB_GCA_{i:09}.1' for i in range(10)]
+
+
+def get_metadata(genome_ids:list=GENOME_IDS, n_proteins:int=5) -> list:
+    '''Get metadata entries for the genomes, which are split evenly between two phyla in the same domain.'''
+    return [{'genome_id':genome_id, 'gtdb_domain':'d0', 'gtdb_phylum':f'p{i % 2}', 'gc_content':i / 10, 'protein_count':n_proteins, 'version':207} for i, genome_id in enumerate(genome_ids)]
+
+
+def get_proteins(genome_ids:list=GENOME_IDS, n_proteins:int=5) -> list:
+    '''Get protein entries for the genomes, with n_proteins genes per genome laid out along a single scaffold.'''
+    return [{'gene_id':f'{genome_id}_{j}', 'genome_id':genome_id, 'seq':'M' * (j + 1), 'gc_content':j / 10, 'start':100 * j, 'stop':100 * j + 90, 'scaffold_id':1, 'strand':'+', 'version':207} for genome_id in genome_ids for j in range(n_proteins)]
+
+
+class SQLiteTestCase(unittest.TestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        '''Upload the data used by the tests. The tables are empty by default.'''
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.settings = (Database.url, Query.max_cost, Query.max_statement_time, Query.log_path, Query.get_outer_table, Filter.metadata_cache)
+        Database.url = f"sqlite:///{os.path.join(cls.dir.name, 'findabug.db')}"
+        # SQLite doesn't support the MariaDB-specific parts of admitting a query, and its EXPLAIN output is not a query plan.
+        Query.max_cost, Query.max_statement_time, Query.log_path = None, None, None
+        Query.get_outer_table = lambda self, database : self.table
+        Filter.metadata_cache = None # A cache left over from another test case would hold the metadata from another database.
+
+        database = Database(reflect=False)
+        # Only the tables are created, as reflecting the tables in other tests can leave duplicate indices in the metadata.
+        with database.engine.begin() as conn:
+            for table in Database.tables:
+                conn.execute(sqlalchemy.schema.CreateTable(table.__table__))
+        Reflected.prepare(database.engine)
+        cls.populate(database)
+        database.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        Database.url, Query.max_cost, Query.max_statement_time, Query.log_path, Query.get_outer_table, Filter.metadata_cache = cls.settings
+        cls.dir.cleanup()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import json
+import tempfile
+from sqlite import SQLiteTestCase
+from utils.advisor import * 
+from utils.database import Database
+from utils.query import Query
+
+
+class TestAdvisor(unittest.TestCase):
+
+    tables = Database.tables
+
+    def test_declared_indices_are_not_recommended(self):
+        # The (ko_id, genome_id) index serves a filter on the KO, sorted by genome. 
+        entries = [{'table':'annotations_kegg_r207', 'order_by':'genome_id', 'cost':100, 'filters':[('annotations_kegg_r207', 'ko_id', '[eq]')]}]
+        self.assertEqual(len(advise(entries, TestAdvisor.tables)), 0)
+
+    def test_primary_key_is_used(self):
+        entries = [{'table':'metadata_r207', 'order_by':'genome_id', 'cost':1, 'filters':[('metadata_r207', 'genome_id', '[eq]')]}]
+        self.assertEqual(len(advise(entries, TestAdvisor.tables)), 0)
+
+    def test_missing_indices_are_recommended(self):
+        entries = [{'table':'annotations_kegg_r207', 'order_by':'genome_id', 'cost':100, 'filters':[('annotations_kegg_r207', 'e_value', '[lt]')]}]
+        entries += [{'table':'annotations_kegg_r207', 'order_by':'genome_id', 'cost':200, 'filters':[('metadata_r207', 'gtdb_phylum', '[eq]'), ('annotations_kegg_r207', 'e_value', '[lt]')]}]
+        entries += [{'table':'annotations_kegg_r207', 'order_by':'genome_id', 'cost':50, 'filters':[('metadata_r207', 'gtdb_phylum', '[eq]')]}]
+        results = advise(entries, TestAdvisor.tables)
+        self.assertEqual(len(results), 2)
+        # The range column should not be followed by the sort column, and the results should be sorted by cost. 
+        self.assertEqual(results.iloc[0].to_dict(), {'table':'annotations_kegg_r207', 'columns':'e_value', 'n_queries':2, 'cost':300})
+        self.assertEqual(results.iloc[1].to_dict(), {'table':'metadata_r207', 'columns':'gtdb_phylum', 'n_queries':2, 'cost':250})
+
+    def test_order_of_equality_columns_is_ignored(self):
+        self.assertTrue(is_covered(('a', 'b', 'c'), [('b', 'a', 'c', 'd')], 2))
+        self.assertFalse(is_covered(('a', 'b', 'c'), [('a', 'c', 'b')], 2))
+
+    def test_incomplete_lines_are_skipped(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'queries.jsonl')
+            with open(path, 'w') as f:
+                f.write(json.dumps({'table':'metadata_r207', 'filters':[]}) + '\n')
+                f.write('{"table": "meta')
+            self.assertEqual(len(load_log(path)), 1)
+
+
+class TestQueryLog(SQLiteTestCase):
+
+    def tearDown(self):
+        Query.log_path = None
+
+    def test_queries_are_logged(self):
+        Query.log_path = os.path.join(TestQueryLog.dir.name, 'queries.jsonl')
+        database = Database(reflect=False)
+        Query(database, 'proteins_r207', filter_string='gtdb_phylum[eq]p1').count(database)
+        Query(database, 'proteins_r207', page=0, page_size=10).get(database).all()
+        database.close()
+        Query.log_queue.join() # Wait for the entries to be written. 
+
+        entries = load_log(Query.log_path)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['filters'], [['metadata_r207', 'gtdb_phylum', '[eq]']])
+        self.assertEqual((entries[1]['table'], entries[1]['order_by']), ('proteins_r207', 'genome_id'))
+
+    def test_log_errors_are_ignored(self):
+        # The directory doesn't exist, so the log can't be written, but the query should still succeed. 
+        Query.log_path = os.path.join(TestQueryLog.dir.name, 'missing', 'queries.jsonl')
+        database = Database(reflect=False)
+        self.assertEqual(Query(database, 'proteins_r207').count(database), 0)
+        database.close()
+        Query.log_queue.join()
+        self.assertFalse(os.path.exists(Query.log_path))
+        self.assertTrue(Query.log_thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import unittest
+import io
+import time
+import json
+import tempfile
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import app
+from sqlite import SQLiteTestCase, GENOME_IDS, get_metadata, get_proteins
+from utils.database import Database
+from utils.jobs import JobQueue
+
+N_PROTEINS = 120 # With 10 genomes, there are 1200 proteins, so the results for a phylum span more than one page.
+
+
+class TestTotalCount(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata(n_proteins=N_PROTEINS))
+        database.bulk_upload('proteins_r207', get_proteins(n_proteins=N_PROTEINS))
+
+    def setUp(self):
+        self.max_total_counts = app.max_total_counts
+        app.total_counts.clear()
+
+    def tearDown(self):
+        app.max_total_counts = self.max_total_counts
+        app.total_counts.clear()
+
+    def get_page(self, filter_string:str, page:int) -> tuple:
+        response = app.app.test_client().get(f'/get/proteins_r207?{filter_string}[and][page]{page}[and][total]')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        return int(response.headers['X-Total-Count']), (0 if (len(data) == 0) else len(pd.read_csv(io.StringIO(data))))
+
+    def test_total_matches_count(self):
+        client = app.app.test_client()
+        for filter_string in ['gtdb_phylum[eq]p1', 'gc_content[gt]0.5', 'gtdb_phylum[eq]p3']:
+            count = int(client.get(f'/count/proteins_r207?{filter_string}').get_data(as_text=True))
+            # The last page is past the end of the results, so the total is counted separately.
+            for page in [2, 0, 1]:
+                app.total_counts.clear()
+                total, _ = self.get_page(filter_string, page)
+                self.assertEqual(total, count)
+        self.assertNotIn('total_count', client.get('/get/proteins_r207?gtdb_phylum[eq]p1[and][page]0[and][total]').get_data(as_text=True))
+        self.assertNotIn('X-Total-Count', client.get('/get/proteins_r207?gtdb_phylum[eq]p1[and][page]0').headers)
+
+    def test_total_is_reused(self):
+        self.assertEqual(self.get_page('gtdb_phylum[eq]p1', 0), (600, 500))
+        self.assertEqual(app.total_counts, {('proteins_r207', 'gtdb_phylum[eq]p1'):600})
+        # Later pages read the total from the cache instead of computing it again.
+        app.total_counts[('proteins_r207', 'gtdb_phylum[eq]p1')] = 601
+        self.assertEqual(self.get_page('gtdb_phylum[eq]p1', 1), (601, 100))
+
+    def test_oldest_total_is_evicted(self):
+        app.max_total_counts = 2
+        for filter_string in ['gtdb_phylum[eq]p0', 'gtdb_phylum[eq]p1', 'gc_content[gt]0.5']:
+            self.get_page(filter_string, 0)
+        self.assertEqual(list(app.total_counts.keys()), [('proteins_r207', 'gtdb_phylum[eq]p1'), ('proteins_r207', 'gc_content[gt]0.5')])
+
+
+class TestStreamedFormats(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata(n_proteins=N_PROTEINS))
+        # The GC content is only known for the last genome, so it is NULL in every row of the first chunk of results. 
+        proteins = get_proteins(n_proteins=N_PROTEINS)
+        database.bulk_upload('proteins_r207', [{**row, 'gc_content':(row['gc_content'] if (row['genome_id'] == GENOME_IDS[-1]) else None)} for row in proteins])
+
+    def test_null_columns_in_first_chunk(self):
+        for format_ in ['parquet', 'arrow']:
+            response = app.app.test_client().get(f'/get/proteins_r207?[format]{format_}')
+            self.assertEqual(response.status_code, 200)
+            data = io.BytesIO(response.get_data())
+            df = pd.read_parquet(data) if (format_ == 'parquet') else pa.ipc.open_stream(data).read_pandas()
+            self.assertEqual(len(df), len(GENOME_IDS) * N_PROTEINS)
+            self.assertEqual(df.gc_content.notnull().sum(), N_PROTEINS)
+            self.assertEqual(df.gc_content.dtype, np.float64)
+
+    def test_null_columns_in_jsonl(self):
+        response = app.app.test_client().get(f'/get/proteins_r207?genome_id[eq]{GENOME_IDS[0]}[and][format]jsonl')
+        rows = [json.loads(line) for line in response.get_data(as_text=True).strip().split('\n')]
+        self.assertEqual(len(rows), N_PROTEINS)
+        self.assertTrue(all([row['gc_content'] is None for row in rows]))
+
+
+class TestExport(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.export_jobs, app.export_jobs = app.export_jobs, JobQueue(self.dir.name)
+        # Count the connections which are closed, to make sure the export doesn't leak any. 
+        self.closed, self.close = [], Database.close
+        def close(database:Database):
+            self.closed.append(database)
+            self.close(database)
+        Database.close = close
+
+    def tearDown(self):
+        Database.close = self.close
+        app.export_jobs.pool.shutdown(wait=True)
+        app.export_jobs = self.export_jobs
+        self.dir.cleanup()
+
+    def export(self, query_string:str) -> dict:
+        '''Submit an export job, and wait for it to finish.'''
+        client = app.app.test_client()
+        response = client.post(f'/export/proteins_r207?{query_string}')
+        self.assertEqual(response.status_code, 202)
+        job_id, start = response.get_data(as_text=True), time.time()
+        while (app.export_jobs.get(job_id).status in ['queued', 'running']) and (time.time() - start < 5):
+            time.sleep(0.01)
+        return json.loads(client.get(f'/jobs/{job_id}').get_data(as_text=True))
+
+    def test_export(self):
+        job = self.export(f'genome_id[eq]{GENOME_IDS[0]}[and][format]csv')
+        self.assertEqual(job['status'], 'done')
+        data = pd.read_csv(io.StringIO(app.app.test_client().get(f"/jobs/{job['job_id']}/result").get_data(as_text=True)))
+        self.assertEqual(len(data), 5)
+        self.assertEqual(len(self.closed), 1)
+
+    def test_failed_export_closes_connection(self):
+        for query_string in ['not_a_field[eq]1', 'gene_id[match]x']:
+            self.closed.clear()
+            job = self.export(query_string)
+            self.assertEqual(job['status'], 'failed')
+            self.assertEqual(len(self.closed), 1, query_string)
+
+
+class TestBatch(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+
+    def post(self, specs, query_string:str='', headers:dict=dict()):
+        return app.app.test_client().post(f'/batch{query_string}', data=json.dumps(specs), headers=headers)
+
+    def test_results_are_in_order(self):
+        # Gene j of each genome has a GC content of j / 10, so each filter matches a different number of proteins.
+        specs = [{'table':'proteins_r207', 'filter':f'gc_content[lt]0.{k}', 'mode':'count'} for k in [5, 1, 3, 0]]
+        specs += [{'table':'proteins_r207', 'filter':f'genome_id[eq]{GENOME_IDS[2]}', 'mode':'get'}]
+        response = self.post(specs)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data(as_text=True))
+        self.assertEqual([result['index'] for result in results], list(range(len(specs))))
+        self.assertEqual([result['status'] for result in results], [200] * len(specs))
+        self.assertEqual([result['result'] for result in results[:4]], [50, 10, 30, 0])
+        self.assertEqual(sorted([row['gene_id'] for row in results[4]['result']]), [f'{GENOME_IDS[2]}_{j}' for j in range(5)])
+
+    def test_results_are_streamed(self):
+        specs = [{'table':'proteins_r207', 'filter':f'genome_id[eq]{genome_id}'} for genome_id in GENOME_IDS]
+        for query_string, headers in [('?[format]jsonl', dict()), ('', {'Accept':'application/x-ndjson'})]:
+            response = self.post(specs, query_string=query_string, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+            # The results are written as each query finishes, so they might be out of order.
+            results = [json.loads(line) for line in response.get_data(as_text=True).strip().split('\n')]
+            self.assertEqual(sorted([result['index'] for result in results]), list(range(len(specs))))
+            self.assertTrue(all([(result['status'] == 200) and (result['result'] == 5) for result in results]))
+
+    def test_bad_mode_fails_its_query_only(self):
+        specs = [{'table':'proteins_r207', 'mode':'count'}, {'table':'proteins_r207', 'mode':'delete'}, {'table':'proteins_r207', 'mode':'get'}]
+        response = self.post(specs)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data(as_text=True))
+        self.assertEqual([result['status'] for result in results], [200, 400, 200])
+        self.assertIn('Mode delete is not supported', results[1]['message'])
+        self.assertNotIn('result', results[1])
+        self.assertEqual(results[0]['result'], 5 * len(GENOME_IDS))
+
+    def test_connection_errors_fail_their_query_only(self):
+        fork = Database.fork
+        def fork_(database:Database):
+            raise ConnectionError('Lost connection to the database.')
+        Database.fork = fork_
+        try:
+            response = self.post([{'table':'proteins_r207', 'mode':'count'}, {'table':'proteins_r207', 'mode':'delete'}])
+        finally:
+            Database.fork = fork
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data(as_text=True))
+        self.assertEqual([(result['index'], result['status']) for result in results], [(0, 500), (1, 400)])
+        self.assertIn('Lost connection', results[0]['message'])
+
+    def test_invalid_batches_are_rejected(self):
+        spec = {'table':'proteins_r207', 'mode':'count'}
+        self.assertEqual(self.post([spec] * app.max_batch_size).status_code, 200)
+        response = self.post([spec] * (app.max_batch_size + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(f'at most {app.max_batch_size} queries', response.get_data(as_text=True))
+        for specs in [spec, [spec, 'count'], 'not json']:
+            self.assertEqual(self.post(specs).status_code, 400)
+        self.assertEqual(app.app.test_client().post('/batch', data='[').status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import os
+import io
+import asyncio
+import tempfile
+import pandas as pd
+from utils.database import Database
+from utils.query import Query
+from utils.tables import Reflected
+
+# The async path needs an async database driver, so the tests use SQLite (through aiosqlite) as a stand-in for MariaDB.
+try:
+    import aiosqlite
+    from app import asgi
+except ImportError:
+    aiosqlite = None
+
+
+async def request(path:str, query_string:str='', headers:list=[]):
+    '''Send a GET request to the ASGI app, and return the status code and body of the response.'''
+    scope = {'type':'http', 'method':'GET', 'path':path, 'query_string':query_string.encode(), 'headers':headers, 'root_path':'', 'http_version':'1.1', 'scheme':'http', 'server':('localhost', 80)}
+    messages = []
+
+    async def receive():
+        return {'type':'http.request', 'body':b'', 'more_body':False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.application(scope, receive, send)
+    body = b''.join([message.get('body', b'') for message in messages if message['type'] == 'http.response.body'])
+    return messages[0]['status'], body.decode()
+
+
+async def serve(requests:list):
+    '''Start up the ASGI app, send the requests concurrently, and shut the app down, all in the same event loop.'''
+    received, sent = asyncio.Queue(), asyncio.Queue()
+    lifespan = asyncio.create_task(asgi.application({'type':'lifespan'}, received.get, sent.put))
+    await received.put({'type':'lifespan.startup'})
+    assert (await sent.get())['type'] == 'lifespan.startup.complete'
+    try:
+        return await asyncio.gather(*[request(*args) for args in requests])
+    finally:
+        await received.put({'type':'lifespan.shutdown'})
+        await lifespan
+
+
+@unittest.skipIf(aiosqlite is None, 'The aiosqlite package is required to test the async path.')
+class TestASGI(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.dir.name, 'findabug.db')
+        cls.settings = (Database.url, Database.async_url, Database.async_engine_kwargs, Query.max_cost, Query.max_statement_time, Query.log_path, Query.get_outer_table, Query.async_get_outer_table)
+        Database.url, Database.async_url = f'sqlite:///{path}', f'sqlite+aiosqlite:///{path}'
+        Database.async_engine_kwargs = dict() # The aiosqlite driver doesn't use a connection pool.
+        # SQLite doesn't support the MariaDB-specific parts of admitting a query, and its EXPLAIN output is not a query plan.
+        Query.max_cost, Query.max_statement_time, Query.log_path = None, None, None
+        Query.get_outer_table = lambda self, database : self.table
+
+        async def async_get_outer_table(self, database, session):
+            return self.table
+        Query.async_get_outer_table = async_get_outer_table
+
+        database = Database(reflect=False)
+        for table in Database.tables:
+            table.__table__.create(bind=database.engine)
+        Reflected.prepare(database.engine)
+        database.bulk_upload('metadata_r207', [{'genome_id':f'GB_GCA_{i:09}.1', 'gtdb_phylum':f'p{i % 2}', 'version':207} for i in range(10)])
+        proteins = [{'gene_id':f'GB_GCA_{i:09}.1_{j}', 'genome_id':f'GB_GCA_{i:09}.1', 'seq':'M' * (j + 1), 'start':100 * j, 'stop':100 * j + 90, 'scaffold_id':1, 'strand':'+', 'version':207} for i in range(10) for j in range(120)]
+        database.bulk_upload('proteins_r207', proteins)
+        database.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        Database.url, Database.async_url, Database.async_engine_kwargs, Query.max_cost, Query.max_statement_time, Query.log_path, Query.get_outer_table, Query.async_get_outer_table = cls.settings
+        cls.dir.cleanup()
+
+    def test_count(self):
+        results = asyncio.run(serve([('/count/proteins_r207', ''), ('/count/proteins_r207', 'gtdb_phylum[eq]p1'), ('/count/proteins_r207', 'genome_id[eq]GB_GCA_000000001.1[and][page]2')]))
+        self.assertEqual(results, [(200, '1200'), (200, '600'), (200, '120')])
+
+    def test_get(self):
+        (status, body), = asyncio.run(serve([('/get/proteins_r207', 'gtdb_phylum[eq]p0[and][page]1')]))
+        self.assertEqual(status, 200)
+        data = pd.read_csv(io.StringIO(body), index_col=0)
+        self.assertEqual(len(data), 100) # There are 600 results, so the second page is the last 100.
+        self.assertTrue((data.gtdb_phylum == 'p0').all())
+        (status, body), = asyncio.run(serve([('/get/proteins_r207', 'gtdb_phylum[eq]p0[and][page]2')]))
+        self.assertEqual((status, body), (200, ''))
+
+    def test_many_concurrent_requests(self):
+        requests = [('/count/proteins_r207', f'genome_id[eq]GB_GCA_{i % 10:09}.1') for i in range(200)]
+        results = asyncio.run(serve(requests))
+        self.assertEqual(results, [(200, '120')] * 200)
+
+    def test_other_requests_are_passed_to_flask(self):
+        (status, body), = asyncio.run(serve([('/get/proteins_r207', 'genome_id[eq]GB_GCA_000000001.1[and][format]jsonl')]))
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body.strip().split('\n')), 120)
+
+    def test_outer_table_is_cached(self):
+        database = Database(reflect=False)
+        query = Query(database, 'proteins_r207', filter_string='gtdb_phylum[eq]p1')
+        # The outer table is found by Query.get_outer_table in the synchronous path, and the async path shouldn't need to run EXPLAIN again,
+        # so there is no session to run it with. 
+        database.outer_tables['proteins_r207'] = 'metadata_r207'
+        async_get_outer_table = TestASGI.settings[-1]
+        self.assertIs(asyncio.run(async_get_outer_table(query, database, None)), database.get_table('metadata_r207'))
+        database.close()
+
+    def test_errors(self):
+        (status, body), = asyncio.run(serve([('/count/proteins_r207', 'not_a_field[eq]1')]))
+        self.assertEqual(status, 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import os 
+import tempfile
+import numpy as np 
+from utils.bitmaps import * 
+
+GENOME_IDS = [f'GCA_{i:09d}.1' for i in range(100)]
+# Each feature is carried by the genomes whose ordinal is divisible by the feature number.
+FEATURES = {f'K0000{n}':[genome_id for i, genome_id in enumerate(GENOME_IDS) if (i % n == 0)] for n in range(1, 6)}
+
+
+class TestBitmapIndex(unittest.TestCase):
+
+    dir_ = tempfile.TemporaryDirectory()
+    path = os.path.join(dir_.name, 'annotations_kegg.h5')
+    BitmapIndex.build(path, GENOME_IDS[::-1], FEATURES.items()) # Order of the input genome IDs shouldn't matter. 
+    index = BitmapIndex(path)
+
+    def test_all_features_loaded(self):
+        self.assertEqual(set(TestBitmapIndex.index.features.keys()), set(FEATURES.keys()))
+
+    def test_or(self):
+        genome_ids = TestBitmapIndex.index.query(['K00002', 'K00003'], operator='or')
+        self.assertEqual(genome_ids, sorted(set(FEATURES['K00002']) | set(FEATURES['K00003'])))
+
+    def test_and(self):
+        genome_ids = TestBitmapIndex.index.query(['K00002', 'K00003'], operator='and')
+        self.assertEqual(genome_ids, sorted(set(FEATURES['K00002']) & set(FEATURES['K00003'])))
+
+    def test_andnot(self):
+        genome_ids = TestBitmapIndex.index.query(['K00002', 'K00003', 'K00005'], operator='andnot')
+        self.assertEqual(genome_ids, sorted(set(FEATURES['K00002']) - set(FEATURES['K00003']) - set(FEATURES['K00005'])))
+
+    def test_missing_feature_has_no_genomes(self):
+        self.assertEqual(TestBitmapIndex.index.query(['K99999']), [])
+
+    def test_matrix(self):
+        genome_ids = GENOME_IDS[10:20][::-1]
+        rows = [row for chunk in TestBitmapIndex.index.matrix(['K00003', 'K00002', 'K00003'], genome_ids=genome_ids, chunk_size=3) for row in chunk]
+        self.assertEqual([row['genome_id'] for row in rows], genome_ids)
+        for row in rows:
+            self.assertEqual(row['K00002'], int(row['genome_id'] in FEATURES['K00002']))
+            self.assertEqual(row['K00003'], int(row['genome_id'] in FEATURES['K00003']))
+
+    def test_missing_genome_raises_error(self):
+        self.assertRaises(ValueError, TestBitmapIndex.index.get_ordinals, ['GCA_999999999.1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
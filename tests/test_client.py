@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+import pandas as pd
+import numpy as np
+from flask import Flask, request
+from utils.client import *
+from utils.query import Filter
+
+
+def get_app(data:pd.DataFrame, page_size:int=500, n_failures:int=0) -> Flask:
+    '''Build a small app which serves the data using the same URL syntax and page format as the Find-A-Bug /count and /get endpoints.
+    Each request for a page fails with a server error the first n_failures times.'''
+    app = Flask(__name__)
+    failures = dict()
+
+    def get_results(table_name:str, url:str):
+        filter_string = url.split('?')[-1]
+        filters, _ = Filter.parse(filter_string) if (len(filter_string) > 0) else (dict(), [])
+        results = data
+        for field, (operator, value) in filters.items():
+            if operator == '[eq]':
+                results = results[results[field].astype(str).isin(value.split('[or]'))]
+            elif operator == '[gt]':
+                results = results[results[field] > float(value)]
+        return results
+
+    @app.route('/count/<table_name>')
+    def count(table_name:str=None):
+        return str(len(get_results(table_name, request.url))), 200
+
+    @app.route('/get/<table_name>')
+    def get(table_name:str=None):
+        url, page = request.url.split('[page]')
+        url = url.replace('[and]', '') if url.endswith('[and]') else url
+        failures[page] = failures.get(page, 0) + 1
+        if failures[page] <= n_failures:
+            return 'Server error.', 500
+        results = get_results(table_name, url).iloc[int(page) * page_size:(int(page) + 1) * page_size]
+        return ('' if len(results) == 0 else results.to_csv()), 200
+
+    return app
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.data = pd.DataFrame({'gene_id':[f'gene_{i}' for i in range(1234)], 'genome_id':[f'genome_{i % 3}' for i in range(1234)]})
+        self.data['gc_content'] = np.linspace(0, 1, len(self.data))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_filter_string_can_be_parsed(self):
+        filters = {'genome_id':['GB_GCA_000008085.1', 'GB_GCA_000010525.1'], 'gc_content':('gt', 0.5), 'gene_length':('in', (100, 200)), 'ko':'K00001'}
+        filter_string = get_filter_string(filters, include=['gtdb_order'])
+        filters, include = Filter.parse(filter_string)
+        self.assertEqual(filters['genome_id'], ('[eq]', 'GB_GCA_000008085.1[or]GB_GCA_000010525.1'))
+        self.assertEqual(filters['gc_content'], ('[gt]', '0.5'))
+        self.assertEqual(filters['gene_length'], ('[in]', '100[to]200'))
+        self.assertEqual(filters['ko'], ('[eq]', 'K00001'))
+        self.assertEqual(include, ['gtdb_order'])
+
+    def test_pages_are_returned_in_order(self):
+        client = Client(base_url='http://localhost', session=get_app(self.data).test_client())
+        results = client.get('proteins', filters={'genome_id':['genome_0', 'genome_2']})
+        expected = self.data[self.data.genome_id.isin(['genome_0', 'genome_2'])].reset_index(drop=True)
+        self.assertTrue(np.all(results.gene_id.values == expected.gene_id.values))
+        self.assertEqual(client.count('proteins', filters={'gc_content':('gt', 0.5)}), (self.data.gc_content > 0.5).sum())
+
+    def test_failed_requests_are_retried(self):
+        client = Client(base_url='http://localhost', session=get_app(self.data, n_failures=2).test_client(), backoff=0)
+        self.assertEqual(len(client.get('proteins')), len(self.data))
+
+        client = Client(base_url='http://localhost', session=get_app(self.data, n_failures=2).test_client(), backoff=0, max_retries=1)
+        with self.assertRaises(ClientError):
+            client.get('proteins')
+
+    def test_results_are_cached(self):
+        client = Client(base_url='http://localhost', session=get_app(self.data).test_client(), cache_dir=self.dir.name)
+        results = client.get('proteins')
+        n_requests = client.n_requests
+        self.assertEqual(n_requests, 4) # One count request and three pages.
+        self.assertTrue(results.equals(client.get('proteins')))
+        self.assertEqual(client.n_requests, n_requests)
+        # Pages from other releases should not be read from the cache.
+        client.version = 220
+        client.get('proteins')
+        self.assertEqual(client.n_requests, 2 * n_requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
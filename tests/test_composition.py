@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+from utils.files import ProteinsFile, RESIDUE_MASSES, WATER_MASS
+
+# The tests in test_files.py check the composition of the sequences in the data files, and these check the edge cases on literal sequences.
+
+
+class TestComposition(unittest.TestCase):
+
+    def test_stop_is_not_counted(self):
+        composition = ProteinsFile.get_composition(['MC*', 'MC'])
+        self.assertEqual(composition['seq_length'].tolist(), [2, 2])
+        self.assertEqual(composition['cysteine_count'].tolist(), [1, 1])
+        self.assertTrue(np.allclose(composition['molecular_weight'], RESIDUE_MASSES['M'] + RESIDUE_MASSES['C'] + WATER_MASS))
+
+    def test_lowercase_is_counted(self):
+        composition = ProteinsFile.get_composition(['mcc*', 'MCC*'])
+        self.assertEqual(composition['cysteine_count'].tolist(), [2, 2])
+        self.assertEqual(composition['molecular_weight'][0], composition['molecular_weight'][1])
+
+    def test_empty_sequences(self):
+        composition = ProteinsFile.get_composition(['', 'M', '*', ''])
+        self.assertEqual(composition['seq_length'].tolist(), [0, 1, 0, 0])
+        self.assertEqual(composition['cysteine_count'].tolist(), [0, 0, 0, 0])
+        # An empty sequence has no mass, not even that of the water molecule.
+        self.assertTrue(np.allclose(composition['molecular_weight'], [0, RESIDUE_MASSES['M'] + WATER_MASS, 0, 0]))
+        self.assertEqual(len(ProteinsFile.get_composition([])['seq_length']), 0)
+
+    def test_unknown_residues(self):
+        composition = ProteinsFile.get_composition(['MXA', 'MOA', 'mo'])
+        self.assertEqual(composition['seq_length'].tolist(), [3, 3, 2])
+        # Residues without a known mass are given the mass of X.
+        mass = RESIDUE_MASSES['M'] + RESIDUE_MASSES['X'] + RESIDUE_MASSES['A'] + WATER_MASS
+        self.assertTrue(np.allclose(composition['molecular_weight'], [mass, mass, mass - RESIDUE_MASSES['A']]))
+
+
+if __name__ == '__main__':
+    unittest.main()
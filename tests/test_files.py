@@ -59,6 +59,15 @@ class TestProteinsFile(unittest.TestCase):
         entries = file.entries()
         self.assertEqual(len(entries), TestProteinsFile.count_entries(file.path))
 
+    @parameterized.expand(aa_files)
+    def test_composition_is_correct(self, file:ProteinsFile):
+        df = file.dataframe()
+        seqs = df.seq.str.rstrip('*')
+        self.assertTrue(np.all(df.seq_length.values == seqs.str.len().values))
+        self.assertTrue(np.all(df.cysteine_count.values == seqs.str.count('C').values))
+        masses = np.array([sum([RESIDUE_MASSES.get(aa, RESIDUE_MASSES['X']) for aa in seq]) + WATER_MASS for seq in seqs])
+        self.assertTrue(np.allclose(df.molecular_weight.values, masses))
+
 
 class TestKeggAnnotationsFile(unittest.TestCase):
     '''Class for testing the File objects defines in utils/files.py.'''
@@ -0,0 +1,96 @@
+import unittest
+import io
+import gzip
+import json
+import pandas as pd 
+import numpy as np 
+import sqlalchemy
+from sqlalchemy import Column, String, Integer, Float
+from utils.formats import * 
+
+
+def get_chunks(n_chunks:int=3, chunk_size:int=4):
+    '''Generate some chunks of fake query results, in the format yielded by Query.stream.'''
+    chunks = []
+    for i in range(n_chunks):
+        chunks.append([{'gene_id':f'gene_{j}', 'start':j * 100, 'gc_content':0.5, 'seq':'M' * (j * 50)} for j in range(i * chunk_size, (i + 1) * chunk_size)])
+    return chunks
+
+
+def join(output) -> bytes:
+    return b''.join([data.encode() if isinstance(data, str) else data for data in output])
+
+
+class TestFormats(unittest.TestCase):
+
+    chunks = get_chunks()
+    df = pd.DataFrame.from_records([row for chunk in chunks for row in chunk])
+
+    def test_csv_matches_to_csv(self):
+        output = join(write(TestFormats.chunks, 'csv')).decode()
+        self.assertEqual(output, TestFormats.df.to_csv())
+
+    def test_csv_gz_matches_to_csv(self):
+        output = gzip.decompress(join(write(TestFormats.chunks, 'csv.gz'))).decode()
+        self.assertEqual(output, TestFormats.df.to_csv())
+
+    def test_jsonl_has_all_rows(self):
+        lines = join(write(TestFormats.chunks, 'jsonl')).decode().strip().split('\n')
+        self.assertEqual(len(lines), len(TestFormats.df))
+        self.assertEqual(json.loads(lines[0]), TestFormats.chunks[0][0])
+
+    def test_parquet_has_all_rows(self):
+        df = pd.read_parquet(io.BytesIO(join(write(TestFormats.chunks, 'parquet'))))
+        self.assertTrue(df.equals(TestFormats.df))
+
+    def test_arrow_has_all_rows(self):
+        df = pa.ipc.open_stream(join(write(TestFormats.chunks, 'arrow'))).read_pandas()
+        self.assertTrue(df.equals(TestFormats.df))
+
+    def test_fasta_has_all_sequences(self):
+        output = join(write(TestFormats.chunks, 'fasta', fields=['start'])).decode()
+        headers = [line for line in output.split('\n') if line.startswith('>')]
+        self.assertEqual(len(headers), len(TestFormats.df))
+        self.assertEqual(headers[1], '>gene_1 start=100')
+        seqs = output.replace('\n', ' ').split('>')[1:]
+        seqs = [''.join(seq.split(' ')[2:]) for seq in seqs]
+        self.assertEqual(seqs, TestFormats.df.seq.tolist())
+
+    def test_fasta_lines_are_wrapped(self):
+        output = join(write(TestFormats.chunks, 'fasta')).decode()
+        self.assertTrue(max([len(line) for line in output.split('\n')]) <= 80)
+
+    def test_empty_result(self):
+        for format_ in ['csv', 'jsonl', 'parquet', 'arrow', 'fasta']:
+            self.assertEqual(len(join(write([], format_))), 0)
+
+    def test_null_columns_use_sql_types(self):
+        # The gc_content and start are NULL in every row of the first chunk, so their types can't be inferred from it. 
+        chunks = get_chunks()
+        chunks[0] = [{**row, 'gc_content':None, 'start':None} for row in chunks[0]]
+        table = sqlalchemy.Table('proteins', sqlalchemy.MetaData(), Column('gene_id', String(50)), Column('start', Integer), Column('gc_content', Float), Column('seq', sqlalchemy.Text))
+        columns = sqlalchemy.select(table).selected_columns
+        df = pd.DataFrame.from_records([row for chunk in chunks for row in chunk])
+        for format_ in ['parquet', 'arrow']:
+            self.assertRaises(pa.lib.ArrowInvalid, join, write(chunks, format_))
+        output = pd.read_parquet(io.BytesIO(join(write(chunks, 'parquet', columns=columns))))
+        self.assertTrue(output.equals(df))
+        stream = pa.ipc.open_stream(join(write(chunks, 'arrow', columns=columns)))
+        self.assertEqual(stream.schema, pa.schema([('gene_id', pa.string()), ('start', pa.int64()), ('gc_content', pa.float64()), ('seq', pa.string())]))
+        self.assertTrue(stream.read_pandas().equals(df))
+
+    def test_jsonl_nan_is_null(self):
+        chunks = [[{'gene_id':'gene_0', 'gc_content':float('nan')}, {'gene_id':'gene_1', 'gc_content':float('inf')}, {'gene_id':'gene_2', 'gc_content':0.5}]]
+        lines = join(write(chunks, 'jsonl')).decode().strip().split('\n')
+        self.assertNotIn('NaN', lines[0])
+        self.assertEqual([json.loads(line)['gc_content'] for line in lines], [None, None, 0.5])
+
+    def test_get_format(self):
+        self.assertEqual(get_format(accept='application/vnd.apache.parquet;q=0.9, */*'), 'parquet')
+        self.assertEqual(get_format(accept='application/x-ndjson', format_='arrow'), 'arrow')
+        self.assertEqual(get_format(accept='*/*'), 'csv')
+        self.assertRaises(ValueError, get_format, format_='xlsx')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import tempfile
+import sqlalchemy
+from utils.database import Database
+from utils.query import Query, HistoryQuery
+from utils.tables import Reflected, create_metadata_table, create_proteins_table
+
+# The tests use SQLite as a stand-in for MariaDB, with a second (made-up) GTDB release added to the tables.
+VERSIONS = [207, 214]
+GENOME_IDS = {207:[f'GB_GCA_{i:09}.1' for i in range(10)], 214:[f'GB_GCA_{i:09}.1' for i in range(4, 12)]}
+
+
+class TestHistoryQuery(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.settings = (Database.url, Database.versions, Query.max_cost, Query.max_statement_time, Query.log_path, Query.get_outer_table)
+        Database.url = f"sqlite:///{os.path.join(cls.dir.name, 'findabug.db')}"
+        # SQLite doesn't support the MariaDB-specific parts of admitting a query, and its EXPLAIN output is not a query plan.
+        Query.max_cost, Query.max_statement_time, Query.log_path = None, None, None
+        Query.get_outer_table = lambda self, database : self.table
+
+        cls.tables = [create_metadata_table(214), create_proteins_table(214)]
+        Database.versions = VERSIONS
+        Database.tables, Database.table_names = Database.tables + cls.tables, Database.table_names + [table.__tablename__ for table in cls.tables]
+
+        database = Database(reflect=False)
+        # Only the tables are created, as reflecting the tables in other tests can leave duplicate indices in the metadata.
+        with database.engine.begin() as conn:
+            for table in Database.tables:
+                conn.execute(sqlalchemy.schema.CreateTable(table.__table__))
+        Reflected.prepare(database.engine)
+        for version in VERSIONS:
+            database.bulk_upload(f'metadata_r{version}', [{'genome_id':genome_id, 'gtdb_phylum':f'p{i % 2}', 'version':version} for i, genome_id in enumerate(GENOME_IDS[version])])
+            proteins = [{'gene_id':f'{genome_id}_{j}', 'genome_id':genome_id, 'seq':'M' * (j + 1), 'start':100 * j, 'stop':100 * j + 90, 'scaffold_id':1, 'strand':'+', 'version':version} for genome_id in GENOME_IDS[version] for j in range(5)]
+            database.bulk_upload(f'proteins_r{version}', proteins)
+        database.close()
+        HistoryQuery.cache.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        Database.url, Database.versions, Query.max_cost, Query.max_statement_time, Query.log_path, Query.get_outer_table = cls.settings
+        Database.tables, Database.table_names = Database.tables[:-len(cls.tables)], Database.table_names[:-len(cls.tables)]
+        HistoryQuery.cache.clear()
+        cls.dir.cleanup()
+
+    def test_count(self):
+        database = Database(reflect=False)
+        counts = HistoryQuery(database, 'proteins', filter_string='gtdb_phylum[eq]p1').count(database)
+        database.close()
+        self.assertEqual(counts, {207:25, 214:20})
+
+    def test_only_old_releases_are_cached(self):
+        database = Database(reflect=False)
+        HistoryQuery(database, 'proteins_r214', filter_string='genome_id[eq]GB_GCA_000000005.1').count(database)
+        database.close()
+        self.assertIn(('proteins_r207', 'genome_id[eq]GB_GCA_000000005.1', 0, None, 'count'), HistoryQuery.cache)
+        self.assertNotIn(('proteins_r214', 'genome_id[eq]GB_GCA_000000005.1', 0, None, 'count'), HistoryQuery.cache)
+
+    def test_stream_is_tagged_with_version(self):
+        for page_size in [None, 3]:
+            database = Database(reflect=False)
+            rows = [row for chunk in HistoryQuery(database, 'proteins', page_size=page_size, filter_string='genome_id[eq]GB_GCA_000000005.1').stream(database, chunk_size=2) for row in chunk]
+            database.close()
+            n = 5 if (page_size is None) else page_size
+            self.assertEqual([row['version'] for row in rows], [207] * n + [214] * n)
+
+    def test_missing_version_raises_error(self):
+        database = Database(reflect=False)
+        self.assertRaises(ValueError, HistoryQuery, database, 'proteins', versions=[207, 999])
+        database.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+import os
+import time
+import threading
+import tempfile
+from utils.jobs import * 
+
+
+def wait(job:Job, timeout:float=5):
+    '''Wait for a job to finish, and for its final state to be saved, so nothing is written to the output directory afterwards.'''
+    start = time.time()
+    while (JobQueue(os.path.dirname(job.path)).load(job.job_id) or job).status in ['queued', 'running'] and (time.time() - start < timeout):
+        time.sleep(0.01)
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_output_is_written(self):
+        jobs = JobQueue(self.dir.name)
+        job = jobs.submit(lambda : iter(['a,b\n', b'1,2\n']), 'csv')
+        wait(job)
+        self.assertEqual(job.status, 'done')
+        with open(job.path, 'r') as f:
+            self.assertEqual(f.read(), 'a,b\n1,2\n')
+        self.assertEqual(job.size, 8)
+
+    def test_failed_jobs_leave_no_output(self):
+        def task():
+            yield 'a,b\n'
+            raise ValueError('error')
+        jobs = JobQueue(self.dir.name)
+        job = jobs.submit(task, 'csv')
+        wait(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('ValueError', job.error)
+        # Only the state of the job is left. 
+        self.assertEqual(os.listdir(self.dir.name), [f'{job.job_id}.json'])
+
+    def test_queue_is_bounded(self):
+        event = threading.Event()
+        def task():
+            event.wait()
+            return iter([])
+        jobs = JobQueue(self.dir.name, max_workers=1, max_jobs=2)
+        submitted = [jobs.submit(task, 'csv') for _ in range(2)]
+        with self.assertRaises(JobQueueFullError):
+            jobs.submit(task, 'csv')
+        event.set()
+        for job in submitted:
+            wait(job)
+        wait(jobs.submit(task, 'csv')) # Finished jobs don't count towards the limit. 
+
+    def test_expired_jobs_are_removed(self):
+        jobs = JobQueue(self.dir.name, max_age=0)
+        job = jobs.submit(lambda : iter(['a']), 'csv')
+        wait(job)
+        time.sleep(0.01)
+        wait(jobs.submit(lambda : iter(['b']), 'csv'))
+        self.assertIsNone(jobs.get(job.job_id))
+        self.assertFalse(os.path.exists(job.path))
+        self.assertFalse(os.path.exists(jobs.get_state_path(job.job_id)))
+
+    def test_jobs_are_shared_between_processes(self):
+        # A second queue with the same output directory stands in for another worker process. 
+        event = threading.Event()
+        def task():
+            event.wait()
+            yield 'a,b\n'
+        jobs, other_jobs = JobQueue(self.dir.name), JobQueue(self.dir.name)
+        job = jobs.submit(task, 'csv')
+        self.assertIn(other_jobs.get(job.job_id).status, ['queued', 'running'])
+        event.set()
+        wait(job)
+        other_job = other_jobs.get(job.job_id)
+        self.assertEqual(other_job.to_dict(), job.to_dict())
+        self.assertEqual(other_job.path, job.path)
+
+    def test_finish_time_is_set_when_done(self):
+        jobs = JobQueue(self.dir.name)
+        job = jobs.submit(lambda : iter(['a'] * 1000), 'csv')
+        # Check the finish time as soon as the job is seen to be done.
+        start = time.time()
+        while (job.status != 'done') and (time.time() - start < 5):
+            pass
+        self.assertEqual(job.status, 'done')
+        self.assertIsNotNone(job.finished)
+        wait(job)
+
+    def test_missing_jobs_are_not_found(self):
+        jobs = JobQueue(self.dir.name)
+        wait(jobs.submit(lambda : iter(['a']), 'csv'))
+        for job_id in ['0' * 32, '../' + '0' * 29, '']:
+            self.assertIsNone(jobs.get(job_id))
+
+    def test_expired_jobs_from_other_processes_are_removed(self):
+        jobs = JobQueue(self.dir.name, max_age=0)
+        job = jobs.submit(lambda : iter(['a']), 'csv')
+        wait(job)
+        time.sleep(0.01)
+        JobQueue(self.dir.name, max_age=0).cleanup()
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+import os
+import tempfile
+import io
+import numpy as np
+import pandas as pd
+from sqlite import SQLiteTestCase, GENOME_IDS as SQLITE_GENOME_IDS, get_metadata
+from utils.database import Database
+from utils.kmers import *
+import app
+
+rng = np.random.default_rng(42)
+GENE_IDS = [f'GCA_000000001.1_{i}' for i in range(500)]
+SEQS = [''.join(rng.choice(list(AMINO_ACIDS), size=rng.integers(1, 300))) for _ in GENE_IDS]
+SEQS[7] = 'MKLVCAACHGGXXCAACHLLW*' # Include non-standard residues and a stop, which shouldn't be indexed.
+
+
+class TestKmerIndex(unittest.TestCase):
+
+    dir_ = tempfile.TemporaryDirectory()
+    path = os.path.join(dir_.name, 'proteins_kmers')
+    KmerIndex.build(path, zip(GENE_IDS, SEQS), k=3, shard_size=128) # Use multiple shards, with the last one partially full.
+    index = KmerIndex(path)
+
+    @staticmethod
+    def get_matches(motif:str):
+        pattern = KmerIndex.get_pattern(motif)
+        return [gene_id for gene_id, seq in zip(GENE_IDS, SEQS) if pattern.search(seq) is not None]
+
+    def test_all_shards_loaded(self):
+        self.assertEqual(len(TestKmerIndex.index.shards), 4)
+
+    def test_candidates_include_all_matches(self):
+        for seq in SEQS[::25]:
+            if len(seq) < 10:
+                continue
+            motif = seq[3:5] + 'x' + seq[6:10]
+            candidates = set(TestKmerIndex.index.search(motif))
+            self.assertTrue(set(TestKmerIndex.get_matches(motif)).issubset(candidates))
+
+    def test_candidates_contain_all_kmers(self):
+        motif = 'CAACHxxCAA'
+        candidates = list(TestKmerIndex.index.search(motif))
+        self.assertIn(GENE_IDS[7], candidates)
+        for gene_id in candidates:
+            seq = SEQS[GENE_IDS.index(gene_id)]
+            self.assertTrue(('CAACH' in seq) and ('CAA' in seq))
+
+    def test_non_standard_residues_not_indexed(self):
+        self.assertNotIn(GENE_IDS[7], list(TestKmerIndex.index.search('GGC')))
+
+    def test_short_motif_raises_error(self):
+        self.assertRaises(ValueError, TestKmerIndex.index.get_motif_kmers, 'CxxCH')
+
+    def test_invalid_motif_raises_error(self):
+        self.assertRaises(ValueError, KmerIndex.get_pattern, 'CxxC[HK]')
+
+
+# The first gene in each genome has a c-type cytochrome heme-binding motif (CxxCH), and the genes in the even genomes also have the
+# peptide KGDAL after it, so the full motif can be searched using the index. 
+PROTEINS = {f'{genome_id}_{j}':(genome_id, ('MSTCAACH' + ('WKGDALW' if (i % 2 == 0) else 'WW')) if (j == 0) else 'MSTWKGDAW') for i, genome_id in enumerate(SQLITE_GENOME_IDS) for j in range(3)}
+
+
+class TestSearch(SQLiteTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir_ = tempfile.TemporaryDirectory()
+        cls.index_dir, Database.index_dir = Database.index_dir, cls.dir_.name
+        KmerIndex.build(os.path.join(cls.dir_.name, 'proteins_r207_kmers'), [(gene_id, seq) for gene_id, (_, seq) in PROTEINS.items()])
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        Database.index_dir = cls.index_dir
+        cls.dir_.cleanup()
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata(n_proteins=3))
+        proteins = [{'gene_id':gene_id, 'genome_id':genome_id, 'seq':seq, 'start':0, 'stop':3 * len(seq), 'scaffold_id':1, 'strand':'+', 'version':207} for gene_id, (genome_id, seq) in PROTEINS.items()]
+        database.bulk_upload('proteins_r207', proteins)
+
+    def search(self, query_string:str):
+        response = app.app.test_client().get(f'/search/proteins_r207?{query_string}')
+        body = response.get_data(as_text=True)
+        return response.status_code, (body if (response.status_code != 200) else ([] if (len(body) == 0) else pd.read_csv(io.StringIO(body)).gene_id.tolist()))
+
+    def test_motif_is_searched_using_index(self):
+        status, gene_ids = self.search('[motif]CxxCHWKGDAL')
+        self.assertEqual(status, 200)
+        self.assertEqual(gene_ids, [f'{genome_id}_0' for genome_id in SQLITE_GENOME_IDS[::2]])
+        # The candidates from the index are checked against the motif, so genes with KGDAL in the wrong place are excluded. 
+        self.assertEqual(self.search('[motif]KGDAL[and]gtdb_phylum[eq]p1'), (200, []))
+
+    def test_short_motif_is_scanned(self):
+        status, gene_ids = self.search(f'[motif]CxxCH[and]genome_id[eq]{SQLITE_GENOME_IDS[1]}')
+        self.assertEqual((status, gene_ids), (200, [f'{SQLITE_GENOME_IDS[1]}_0']))
+        self.assertEqual(self.search('[motif]CxxCH')[1], [f'{genome_id}_0' for genome_id in SQLITE_GENOME_IDS])
+
+    def test_short_motif_with_too_many_proteins_is_rejected(self):
+        max_search_candidates = app.max_search_candidates
+        try:
+            app.max_search_candidates = 10
+            status, message = self.search('[motif]CxxCH')
+            self.assertEqual(status, 400)
+            self.assertIn('at least 5 residues in a row', message)
+            self.assertEqual(self.search(f'[motif]CxxCH[and]genome_id[eq]{SQLITE_GENOME_IDS[1]}')[0], 200)
+        finally:
+            app.max_search_candidates = max_search_candidates
+
+    def test_invalid_motif_is_rejected(self):
+        for query_string in ['[motif]CxxCZ', '[motif]cxx-ch', 'genome_id[eq]x']:
+            status, message = self.search(query_string)
+            self.assertEqual(status, 400)
+            self.assertNotIn('Traceback', message)
+
+
+if __name__ == '__main__':
+    unittest.main()
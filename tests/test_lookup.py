@@ -0,0 +1,62 @@
+import unittest
+import io
+import pandas as pd
+from sqlite import SQLiteTestCase, GENOME_IDS, get_metadata, get_proteins
+from utils.database import Database
+from utils.query import Query
+from app import app
+
+
+class TestLookup(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+
+    def test_ids_are_loaded(self):
+        database = Database(reflect=False)
+        table = database.load_ids([' GB_GCA_000000001.1_0\n', 'GB_GCA_000000001.1_0', '', 'GB_GCA_000000002.1_3\n'], chunk_size=2)
+        ids = database.session.execute(table.select()).scalars().all()
+        database.close()
+        # Duplicates, whitespace, and empty lines are ignored.
+        self.assertEqual(sorted(ids), ['GB_GCA_000000001.1_0', 'GB_GCA_000000002.1_3'])
+
+    def test_ids_are_joined(self):
+        gene_ids = ['GB_GCA_000000001.1_0', 'GB_GCA_000000002.1_3', 'GB_GCA_999999999.1_0']
+        # Only the last two genes in each genome pass the filter on GC content.
+        for field, ids, n in [('gene_id', gene_ids, 1), ('genome_id', GENOME_IDS[:3], 6)]:
+            database = Database(reflect=False)
+            query = Query(database, 'proteins_r207', filter_string='gc_content[gt]0.2', lookup=(database.load_ids(ids), field))
+            rows = [row for chunk in query.stream(database) for row in chunk]
+            database.close()
+            self.assertEqual(len(rows), n)
+            self.assertTrue(all([(row[field] in ids) and (row['gc_content'] > 0.2) for row in rows]))
+
+    def test_table_is_replaced(self):
+        database = Database(reflect=False)
+        database.load_ids(['GB_GCA_000000001.1_0'])
+        table = database.load_ids(['GB_GCA_000000002.1_0'])
+        ids = database.session.execute(table.select()).scalars().all()
+        database.close()
+        self.assertEqual(ids, ['GB_GCA_000000002.1_0'])
+
+    def test_missing_field_raises_error(self):
+        database = Database(reflect=False)
+        self.assertRaises(ValueError, Query, database, 'metadata_r207', lookup=(database.load_ids(GENOME_IDS), 'gene_id'))
+        database.close()
+
+    def test_endpoint(self):
+        client = app.test_client()
+        response = client.post('/lookup/proteins_r207?[field]genome_id', data='\n'.join(GENOME_IDS[:2]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(pd.read_csv(io.StringIO(response.get_data(as_text=True)))), 10)
+        # The metadata table has no gene IDs, which is the client's problem.
+        response = client.post('/lookup/metadata_r207?[field]gene_id', data='GB_GCA_000000001.1_0')
+        self.assertEqual(response.status_code, 400)
+        response = client.post('/lookup/proteins_r207?[field]seq', data='M')
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
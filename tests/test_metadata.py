@@ -0,0 +1,114 @@
+import unittest
+import sqlalchemy
+import numpy as np
+import pandas as pd
+from sqlite import SQLiteTestCase, GENOME_IDS, get_metadata, get_proteins
+from utils.database import Database
+from utils.query import Query, Filter
+from utils.metadata import *
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.data = pd.DataFrame({'genome_id':[f'GB_GCA_{i:09}.1' for i in range(10)]})
+        self.data['gtdb_phylum'] = pd.Categorical(['Bacillota', 'Pseudomonadota'] * 5)
+        self.data['checkm_completeness'] = np.arange(90, 100, dtype=float)
+        self.data['gtdb_order'] = pd.Categorical(['Bacillales', 'Enterobacterales'] * 5)
+        self.data['taxonomy_index'] = np.arange(10)
+
+    def test_operators(self):
+        get_mask = MetadataCache.get_mask
+        self.assertEqual(get_mask(self.data, 'gtdb_phylum', '[eq]', 'bacillota').sum(), 5) # Matching should be case-insensitive.
+        self.assertEqual(get_mask(self.data, 'checkm_completeness', '[eq]', '91[or]92').sum(), 2)
+        self.assertEqual(get_mask(self.data, 'checkm_completeness', '[gt]', '95').sum(), 4)
+        self.assertEqual(get_mask(self.data, 'checkm_completeness', '[lte]', '95').sum(), 6)
+        self.assertEqual(get_mask(self.data, 'checkm_completeness', '[in]', '91[to]93').sum(), 3)
+        self.assertEqual(get_mask(self.data, 'gtdb_order', '[under]', 'Bacillales', ranges=[(0, 1), (8, 20)]).sum(), 4)
+        self.assertEqual(get_mask(self.data, 'gtdb_order', '[under]', 'Bacillales', ranges=[]).sum(), 0)
+
+    def test_shorter_list_is_returned(self):
+        cache = MetadataCache(max_genome_ids=3)
+        include, genome_ids = cache.get_genome_ids(self.data, [('checkm_completeness', '[gt]', '97')])
+        self.assertTrue(include)
+        self.assertEqual(list(genome_ids), list(self.data.genome_id.values[-2:]))
+        include, genome_ids = cache.get_genome_ids(self.data, [('checkm_completeness', '[gt]', '91')])
+        self.assertFalse(include)
+        self.assertEqual(list(genome_ids), list(self.data.genome_id.values[:2]))
+        # Both lists are too long, so the filter should be applied with a join. 
+        self.assertIsNone(cache.get_genome_ids(self.data, [('gtdb_phylum', '[eq]', 'Bacillota')]))
+
+    def test_filters_are_combined(self):
+        cache = MetadataCache()
+        include, genome_ids = cache.get_genome_ids(self.data, [('gtdb_phylum', '[eq]', 'Bacillota'), ('checkm_completeness', '[gte]', '96')])
+        self.assertTrue(include)
+        self.assertEqual(list(genome_ids), [self.data.genome_id.values[6], self.data.genome_id.values[8]])
+
+
+class TestCachedFilters(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        # The CheckM completeness is NULL for every genome, as it might be in a sparse release. 
+        database.bulk_upload('metadata_r207', [{**entry, 'checkm_contamination':i, 'checkm_completeness':None} for i, entry in enumerate(get_metadata())])
+        database.bulk_upload('proteins_r207', get_proteins())
+
+    def setUp(self):
+        Filter.metadata_cache = MetadataCache(max_genome_ids=4)
+
+    def tearDown(self):
+        Filter.metadata_cache = None
+
+    def count(self, filter_string:str) -> tuple:
+        '''Count the proteins matching the filter using the metadata cache, and return the count and the fields which were evaluated 
+        using the cache, along with the count using the join.'''
+        database = Database(reflect=False)
+        query = Query(database, 'proteins_r207', filter_string=filter_string)
+        count = query.count(database)
+        metadata_cache, Filter.metadata_cache = Filter.metadata_cache, None
+        join_count = Query(database, 'proteins_r207', filter_string=filter_string).count(database)
+        Filter.metadata_cache = metadata_cache
+        database.close()
+        return count, query.filter_.cached_fields, join_count
+
+    def test_counts_match_join(self):
+        # The cache matches strings case-insensitively, like MariaDB, but SQLite doesn't, so the filters all use the same case as the data.
+        filter_strings = ['checkm_contamination[gt]6', 'checkm_contamination[gt]1', 'checkm_contamination[in]2[to]4', 'gtdb_phylum[eq]p1[and]checkm_contamination[lte]4']
+        filter_strings += ['gtdb_phylum[eq]p1[or]p0[and]checkm_contamination[lt]2', 'checkm_contamination[eq]3[or]7', 'checkm_completeness[gt]-5', 'checkm_contamination[eq]abc']
+        for filter_string in filter_strings:
+            count, cached_fields, join_count = self.count(filter_string)
+            self.assertEqual(count, join_count, filter_string)
+            self.assertTrue(len(cached_fields) > 0, filter_string)
+        self.assertEqual(self.count('checkm_contamination[gt]1')[0], 40) # The two excluded genomes are applied with NOT IN. 
+        # A filter which matches (and excludes) too many genomes is applied using the join.
+        self.assertEqual(self.count('gtdb_phylum[eq]p1'), (25, [], 25))
+
+    def test_null_numeric_columns_are_numeric(self):
+        database = Database(reflect=False)
+        data = MetadataCache().load(database.session, database.get_table('metadata_r207'))
+        database.close()
+        self.assertTrue(data.checkm_completeness.isna().all())
+        self.assertTrue(pd.api.types.is_float_dtype(data.checkm_completeness))
+        self.assertIsInstance(data.gtdb_phylum.dtype, pd.CategoricalDtype)
+        self.assertEqual(MetadataCache.get_mask(data, 'checkm_completeness', '[gt]', '-5').sum(), 0)
+
+    def test_uploads_invalidate_cache(self):
+        database = Database(reflect=False)
+        table = database.get_table('metadata_r207')
+        cache = MetadataCache()
+        cache.add(table, [])
+        self.assertFalse(cache.is_loaded(table)) # An empty table is probably still being uploaded, so it isn't cached. 
+        self.assertEqual(len(cache.load(database.session, table)), len(GENOME_IDS))
+        self.assertTrue(cache.is_loaded(table))
+        database.bulk_upload('metadata_r207', [{'genome_id':'GB_GCA_999999999.1', 'gtdb_phylum':'p1', 'version':207}])
+        self.assertFalse(cache.is_loaded(table))
+        self.assertEqual(len(cache.load(database.session, table)), len(GENOME_IDS) + 1)
+        database.session.execute(sqlalchemy.delete(table.__table__).where(table.genome_id == 'GB_GCA_999999999.1'))
+        database.session.commit()
+        MetadataCache.invalidate()
+        self.assertFalse(cache.is_loaded(table))
+        database.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
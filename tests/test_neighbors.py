@@ -0,0 +1,85 @@
+import unittest
+import io
+import pandas as pd
+from sqlite import SQLiteTestCase, get_metadata
+from utils.database import Database
+from utils.query import NeighborhoodQuery
+from app import app
+
+GENOME_IDS = ['GB_GCA_000000001.1', 'GB_GCA_000000002.1']
+
+# The anchor genes (annotated with K00001) are a1 on scaffold 1 and b1 on scaffold 2 of the first genome. With a window of 500, the
+# neighborhood of a1 is 500 to 1800, and the neighborhood of b1 is 4500 to 5800.
+PROTEINS = [('long', 1, 50, 5000, '+'), ('a0', 1, 100, 499, '+'), ('a0b', 1, 200, 500, '-'), ('a1', 1, 1000, 1300, '-'), ('a2', 1, 1800, 2100, '-'), ('a3', 1, 1801, 2000, '+')]
+PROTEINS += [('b0', 2, 1000, 1300, '+'), ('b1', 2, 5000, 5300, '+'), ('b2', 2, 5400, 5500, '-'), ('b3', 2, 5801, 6100, '-')]
+ANNOTATIONS = {'a1':1, 'b1':1, 'a2':2, 'b0':2}
+
+
+class TestNeighborhoodQuery(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata(GENOME_IDS))
+        # The second genome has a gene with the same location as the first anchor, which should never be returned.
+        proteins = [{'gene_id':f'{GENOME_IDS[0]}_{name}', 'genome_id':GENOME_IDS[0], 'scaffold_id':scaffold_id, 'start':start, 'stop':stop, 'strand':strand, 'seq':'M', 'version':207} for name, scaffold_id, start, stop, strand in PROTEINS]
+        proteins += [{'gene_id':f'{GENOME_IDS[1]}_a1', 'genome_id':GENOME_IDS[1], 'scaffold_id':1, 'start':1000, 'stop':1300, 'strand':'-', 'seq':'M', 'version':207}]
+        database.bulk_upload('proteins_r207', proteins)
+        database.bulk_upload('vocabulary_ko_r207', [{'ko_id':1, 'ko':'K00001'}, {'ko_id':2, 'ko':'K00002'}])
+        database.bulk_upload('annotations_kegg_r207', [{'gene_id':f'{GENOME_IDS[0]}_{name}', 'genome_id':GENOME_IDS[0], 'ko_id':ko_id, 'version':207} for name, ko_id in ANNOTATIONS.items()])
+
+    def get_neighbors(self, window:int, filter_string:str='ko[eq]K00001') -> pd.DataFrame:
+        database = Database(reflect=False)
+        query = NeighborhoodQuery(database, 'annotations_kegg_r207', filter_string=filter_string, window=window)
+        neighbors = pd.DataFrame([row for chunk in query.stream(database) for row in chunk])
+        database.close()
+        return neighbors
+
+    @staticmethod
+    def get_names(neighbors:pd.DataFrame, anchor:str) -> list:
+        neighbors = neighbors[neighbors.anchor_gene_id == f'{GENOME_IDS[0]}_{anchor}']
+        return [gene_id.split('_')[-1] for gene_id in neighbors.gene_id]
+
+    def test_window_edges(self):
+        neighbors = self.get_neighbors(500)
+        # Genes which end or start exactly at the edge of the window are included, and those one base further out are not. The long gene
+        # starts well before the window, but overlaps it. Genes on either strand are included.
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'a1'), ['long', 'a0b', 'a1', 'a2'])
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'b1'), ['b1', 'b2'])
+        self.assertEqual(neighbors.anchor_gene_id.nunique(), 2)
+
+    def test_other_scaffolds_and_genomes_are_excluded(self):
+        neighbors = self.get_neighbors(10000)
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'a1'), ['long', 'a0', 'a0b', 'a1', 'a2', 'a3'])
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'b1'), ['b0', 'b1', 'b2', 'b3'])
+        self.assertTrue((neighbors.genome_id == GENOME_IDS[0]).all())
+
+    def test_zero_window_returns_overlapping_genes(self):
+        neighbors = self.get_neighbors(0)
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'a1'), ['long', 'a1'])
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'b1'), ['b1'])
+
+    def test_annotations_are_included(self):
+        neighbors = self.get_neighbors(500).set_index('gene_id')
+        self.assertEqual(neighbors.loc[f'{GENOME_IDS[0]}_a2', 'ko'], 'K00002')
+        self.assertTrue(pd.isnull(neighbors.loc[f'{GENOME_IDS[0]}_a0b', 'ko']))
+        self.assertNotIn('seq', neighbors.columns)
+
+    def test_anchors_are_filtered(self):
+        neighbors = self.get_neighbors(500, filter_string='ko[eq]K00002')
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'a2'), ['long', 'a1', 'a2', 'a3'])
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'b0'), ['b0'])
+
+    def test_endpoint(self):
+        response = app.test_client().get('/neighbors/annotations_kegg_r207?ko[eq]K00001[and][window]500')
+        self.assertEqual(response.status_code, 200)
+        neighbors = pd.read_csv(io.StringIO(response.get_data(as_text=True)))
+        self.assertEqual(TestNeighborhoodQuery.get_names(neighbors, 'a1'), ['long', 'a0b', 'a1', 'a2'])
+
+    def test_anchors_must_be_annotations(self):
+        database = Database(reflect=False)
+        self.assertRaises(ValueError, NeighborhoodQuery, database, 'proteins_r207', filter_string='gene_id[eq]x')
+        database.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
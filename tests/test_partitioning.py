@@ -0,0 +1,112 @@
+import unittest
+import sqlalchemy
+from sqlalchemy import select
+from sqlite import SQLiteTestCase, get_metadata, get_proteins
+from utils.database import Database
+from utils.query import Query, Filter
+from utils.tables import Partitioning, get_genome_key, create_metadata_table, create_proteins_table
+
+# The genome keys are 1, 2, 3, 6, and 7, so with 4 hash partitions, partition 0 is empty and partitions 2 and 3 hold two genomes each.
+GENOME_IDS = ['GB_GCA_000000001.1', 'GB_GCA_000000002.1', 'RS_GCF_000000003.1', 'GB_GCA_000000006.1', 'GB_GCA_000000007.2']
+BOUNDARIES = ['GB_GCA_000000006.1', 'GB_GCA_000000002.1'] # The boundaries don't need to be sorted.
+
+# The partitioned tables use made-up GTDB releases, so they don't replace the tables used by the other tests. The hash-partitioned tables
+# are r901, and the range-partitioned tables are r902. They are only created in TestPartitionedTables.setUpClass, as the tables of every 
+# table class created so far are reflected when the tables are prepared. 
+HASH, RANGE = Partitioning('hash', n_partitions=4), Partitioning('range', boundaries=BOUNDARIES)
+MARIADB = sqlalchemy.create_mock_engine('mariadb://', None).dialect
+
+
+class TestPartitioning(unittest.TestCase):
+
+    def test_genome_key_is_stable(self):
+        # The key only depends on the accession, so it is the same in every process, for GenBank and RefSeq, and for every version.
+        for genome_id in ['GB_GCA_000007325.1', 'RS_GCF_000007325.2', 'GCA_000007325.1', '000007325']:
+            self.assertEqual(get_genome_key(genome_id), 7325)
+        self.assertEqual(get_genome_key('GB_GCA_123456789.1'), 123456789)
+        self.assertEqual(get_genome_key('unknown'), 0)
+        self.assertEqual([HASH.get_partition(genome_id) for genome_id in GENOME_IDS], [1, 2, 3, 2, 3])
+
+    def test_range_partition_boundaries(self):
+        # Each partition holds the genome IDs from its lower boundary (inclusive) up to the next boundary (exclusive).
+        self.assertEqual(RANGE.boundaries, ['GB_GCA_000000002.1', 'GB_GCA_000000006.1'])
+        self.assertEqual(RANGE.n_partitions, 3)
+        partitions = {'GB_GCA_000000000.1':0, 'GB_GCA_000000001.9':0, 'GB_GCA_000000002.1':1, 'GB_GCA_000000005.9':1, 'GB_GCA_000000006.1':2, 'RS_GCF_000000001.1':2}
+        for genome_id, partition in partitions.items():
+            self.assertEqual(RANGE.get_partition(genome_id), partition)
+
+    def test_invalid_partitioning_raises_error(self):
+        self.assertRaises(ValueError, Partitioning, 'list')
+        self.assertRaises(ValueError, Partitioning, 'range')
+
+
+class TestPartitionedTables(SQLiteTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tables = [create_metadata_table(901), create_proteins_table(901, partitioning=HASH), create_metadata_table(902), create_proteins_table(902, partitioning=RANGE)]
+        Database.tables, Database.table_names = Database.tables + cls.tables, Database.table_names + [table.__tablename__ for table in cls.tables]
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        Database.tables, Database.table_names = Database.tables[:-len(cls.tables)], Database.table_names[:-len(cls.tables)]
+
+    @classmethod
+    def populate(cls, database:Database):
+        for version in [901, 902]:
+            database.bulk_upload(f'metadata_r{version}', get_metadata(GENOME_IDS))
+            database.bulk_upload(f'proteins_r{version}', get_proteins(GENOME_IDS))
+
+    def test_hash_partitioning_ddl(self):
+        ddl = str(sqlalchemy.schema.CreateTable(TestPartitionedTables.tables[1].__table__).compile(dialect=MARIADB))
+        self.assertTrue(ddl.strip().endswith('PARTITION BY HASH(genome_key) PARTITIONS 4'))
+        self.assertIn('PRIMARY KEY (gene_id, genome_key)', ddl)
+        self.assertNotIn('FOREIGN KEY', ddl) # MariaDB doesn't support foreign keys on partitioned tables.
+
+    def test_range_partitioning_ddl(self):
+        ddl = str(sqlalchemy.schema.CreateTable(TestPartitionedTables.tables[3].__table__).compile(dialect=MARIADB))
+        partitions = "PARTITION p0 VALUES LESS THAN ('GB_GCA_000000002.1'), PARTITION p1 VALUES LESS THAN ('GB_GCA_000000006.1'), PARTITION p2 VALUES LESS THAN (MAXVALUE)"
+        self.assertTrue(ddl.strip().endswith(f'PARTITION BY RANGE COLUMNS(genome_id) ({partitions})'))
+        self.assertIn('PRIMARY KEY (gene_id, genome_id)', ddl)
+        self.assertNotIn('FOREIGN KEY', ddl)
+
+    def test_unpartitioned_ddl(self):
+        ddl = str(sqlalchemy.schema.CreateTable(Database.tables[Database.table_names.index('proteins_r207')].__table__).compile(dialect=MARIADB))
+        self.assertNotIn('PARTITION', ddl)
+        self.assertIn('FOREIGN KEY(genome_id) REFERENCES metadata_r207 (genome_id)', ddl)
+
+    def test_entries_are_uploaded_by_partition(self):
+        database = Database(reflect=False)
+        table = database.get_table('proteins_r901')
+        # SQLite assigns row IDs in the order the rows are inserted.
+        rows = database.session.execute(select(table.genome_id, table.genome_key).order_by(sqlalchemy.text('rowid'))).all()
+        database.close()
+        self.assertEqual(len(rows), 5 * len(GENOME_IDS))
+        self.assertTrue(all([genome_key == get_genome_key(genome_id) for genome_id, genome_key in rows]))
+        partitions = [HASH.get_partition(genome_id) for genome_id, _ in rows]
+        self.assertEqual(partitions, sorted(partitions))
+
+    def test_prune_only_applies_to_genome_id_equality(self):
+        database = Database(reflect=False)
+        table = database.get_table('proteins_r901')
+        stmt = Filter(database, 'proteins_r901', f'genome_id[eq]{GENOME_IDS[0]}[or]{GENOME_IDS[2]}').prune(select(table.gene_id))
+        self.assertIn('genome_key IN (1, 3)', str(stmt.compile(compile_kwargs={'literal_binds':True})))
+        for filter_string in [f'genome_id[gt]{GENOME_IDS[0]}', f'gene_id[eq]{GENOME_IDS[0]}_0', 'gc_content[gt]0.5']:
+            self.assertNotIn('genome_key', str(Filter(database, 'proteins_r901', filter_string).prune(select(table.gene_id))))
+        # Range-partitioned tables are pruned using the genome ID itself.
+        stmt = select(database.get_table('proteins_r902').gene_id)
+        self.assertEqual(str(Filter(database, 'proteins_r902', f'genome_id[eq]{GENOME_IDS[0]}').prune(stmt)), str(stmt))
+        database.close()
+
+    def test_pruned_count(self):
+        database = Database(reflect=False)
+        for version in [901, 902]:
+            query = Query(database, f'proteins_r{version}', filter_string=f'genome_id[eq]{GENOME_IDS[0]}[or]{GENOME_IDS[3]}[or]GB_GCA_000000004.1')
+            self.assertEqual(query.count(database), 10)
+        database.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import unittest
+import pandas as pd
+import numpy as np
+import sqlalchemy
+from sqlalchemy import select
+from sqlite import SQLiteTestCase, GENOME_IDS, get_metadata, get_proteins
+from utils.database import Database
+from utils.query import Query, QueryCostError, Filter
+from app import app
+
+
+class TestApproxCount(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+        summary = [{'ko':'K00001', 'rank':'gtdb_domain', 'taxon':'d0', 'n_annotations':7}, {'ko':'K00001', 'rank':'gtdb_phylum', 'taxon':'p0', 'n_annotations':3}]
+        summary += [{'ko':'K00001', 'rank':'gtdb_phylum', 'taxon':'p1', 'n_annotations':4}, {'ko':'K00002', 'rank':'gtdb_domain', 'taxon':'d0', 'n_annotations':1}]
+        database.bulk_upload('summary_kegg_r207', [{'version':207, 'n_genomes':1, 'n_genes':1, **entry} for entry in summary])
+
+    def test_metadata_filters_use_protein_counts(self):
+        database = Database(reflect=False)
+        result = Query(database, 'proteins_r207', filter_string='gtdb_phylum[eq]p1[and]gtdb_domain[eq]d0').approx_count(database)
+        database.close()
+        self.assertEqual(result, (25, 0))
+
+    def test_shared_fields_are_not_metadata_filters(self):
+        # The proteins table also has a GC content, which is what the filter applies to, so the protein counts can't be used.
+        database = Database(reflect=False)
+        for filter_string in ['gc_content[gt]0.5', 'gtdb_phylum[eq]p1[and]gc_content[gt]0.5']:
+            self.assertNotIn('protein_count', Query(database, 'proteins_r207', filter_string=filter_string).approx_count(database, debug=True))
+        self.assertIn('protein_count', Query(database, 'proteins_r207', filter_string='gtdb_phylum[eq]p1').approx_count(database, debug=True))
+        database.close()
+
+    def test_summary_is_used(self):
+        database = Database(reflect=False)
+        for filter_string, (rank, taxon) in [('ko[eq]K00001', ('gtdb_domain', None)), ('ko[eq]K00001[and]gtdb_phylum[eq]p1', ('gtdb_phylum', 'p1'))]:
+            summary_table, field, rank_, taxon_ = Query(database, 'annotations_kegg_r207', filter_string=filter_string).get_summary(database, 207)
+            self.assertEqual((summary_table.__tablename__, field, rank_, taxon_), ('summary_kegg_r207', 'ko', rank, taxon))
+        self.assertEqual(Query(database, 'annotations_kegg_r207', filter_string='ko[eq]K00001').approx_count(database), (7, 0))
+        self.assertEqual(Query(database, 'annotations_kegg_r207', filter_string='gtdb_phylum[eq]p1[and]ko[eq]K00001').approx_count(database), (4, 0))
+        self.assertEqual(Query(database, 'annotations_kegg_r207', filter_string='ko[eq]K99999').approx_count(database), (0, 0))
+        database.close()
+
+    def test_summary_is_not_used(self):
+        database = Database(reflect=False)
+        filter_strings = ['ko[eq]K00001[or]K00002', 'ko[gt]1', 'e_value[lt]0.1', 'ko[eq]K00001[and]e_value[lt]0.1']
+        filter_strings += ['ko[eq]K00001[and]gtdb_phylum[eq]p0[or]p1', 'ko[eq]K00001[and]gtdb_phylum[eq]p1[and]gtdb_domain[eq]d0']
+        for filter_string in filter_strings:
+            self.assertIsNone(Query(database, 'annotations_kegg_r207', filter_string=filter_string).get_summary(database, 207))
+        self.assertIsNone(Query(database, 'proteins_r207', filter_string='gtdb_phylum[eq]p1').get_summary(database, 207))
+        database.close()
+
+
+class TestEstimateCost(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+
+    def setUp(self):
+        self.settings = (Query.max_cost, Query.get_cost)
+
+    def tearDown(self):
+        Query.max_cost, Query.get_cost = self.settings
+
+    @staticmethod
+    def get_explain(rows:list, extra:list=None) -> pd.DataFrame:
+        '''Build the output of EXPLAIN for a nested-loop join over tables with the given row estimates.'''
+        return pd.DataFrame({'table':[f'table_{i}' for i in range(len(rows))], 'rows':rows, 'Extra':[None] * len(rows) if (extra is None) else extra})
+
+    def test_cost_is_sum_of_running_products(self):
+        database = Database(reflect=False)
+        query = Query(database, 'proteins_r207')
+        database.close()
+        self.assertEqual(query.estimate_cost(TestEstimateCost.get_explain([10, 5, 2])), 10 + 10 * 5 + 10 * 5 * 2)
+        # Missing row estimates (e.g. for a constant table) are treated as a single row.
+        self.assertEqual(query.estimate_cost(TestEstimateCost.get_explain([10, np.nan, 'NULL'])), 30)
+
+    def test_limit_is_discounted(self):
+        database = Database(reflect=False)
+        query = Query(database, 'proteins_r207', page=1, page_size=500)
+        database.close()
+        # Only the first two pages need to be read, if the rows can be read in order.
+        self.assertEqual(query.estimate_cost(TestEstimateCost.get_explain([10000, 2], extra=['Using where', None])), 1000 + 1000 * 2)
+        self.assertEqual(query.estimate_cost(TestEstimateCost.get_explain([100, 2])), 100 + 100 * 2)
+
+    def test_limit_is_not_discounted_when_sorting(self):
+        database = Database(reflect=False)
+        query = Query(database, 'proteins_r207', page=1, page_size=500)
+        database.close()
+        for extra in [['Using where; Using filesort', None], ['Using temporary', 'Using where'], [None, 'Using join buffer; Using filesort']]:
+            self.assertEqual(query.estimate_cost(TestEstimateCost.get_explain([10000, 2], extra=extra)), 10000 + 10000 * 2)
+
+    def test_expensive_query_is_rejected(self):
+        Query.max_cost, Query.get_cost = 100, lambda self, database : 101
+        database = Database(reflect=False)
+        self.assertRaises(QueryCostError, Query(database, 'proteins_r207', filter_string='gtdb_phylum[eq]p1').count, database)
+        database.close()
+
+        client = app.test_client()
+        for url in ['/count/proteins_r207?gtdb_phylum[eq]p1', '/get/proteins_r207?gtdb_phylum[eq]p1', '/get/proteins_r207?gtdb_phylum[eq]p1[and][format]jsonl']:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('exceeds the limit of 100', response.get_data(as_text=True))
+
+        Query.get_cost = lambda self, database : 100
+        self.assertEqual(client.get('/count/proteins_r207?gtdb_phylum[eq]p1').get_data(as_text=True), '25')
+
+
+class TestParallel(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+        database.build_boundaries('boundaries_r207', 'metadata_r207', n_ranges=4)
+
+    def test_ranges_cover_genome_ids(self):
+        database = Database(reflect=False)
+        query = Query(database, 'proteins_r207')
+        ranges = query.get_ranges(database)
+        self.assertEqual(len(ranges), 4)
+        # The first and last ranges are open, and each range starts where the previous one ends.
+        self.assertIsNone(ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        self.assertTrue(all([high == low for (_, high), (low, _) in zip(ranges[:-1], ranges[1:])]))
+
+        genome_ids = [database.session.execute(query.restrict(select(query.table.genome_id).distinct(), low, high)).scalars().all() for low, high in ranges]
+        database.close()
+        # Every genome ID is in exactly one range, including the ones before the first boundary and after the last.
+        self.assertEqual(sorted(sum(genome_ids, [])), GENOME_IDS)
+        self.assertTrue(all([len(ids) > 0 for ids in genome_ids]))
+
+    def test_parallel_count_matches_count(self):
+        database = Database(reflect=False)
+        for filter_string in [None, 'gtdb_phylum[eq]p1', 'gc_content[gt]0.2', f'genome_id[eq]{GENOME_IDS[0]}[or]{GENOME_IDS[-1]}', 'gtdb_phylum[eq]p3']:
+            count = Query(database, 'proteins_r207', filter_string=filter_string).count(database)
+            self.assertEqual(Query(database, 'proteins_r207', filter_string=filter_string).parallel_count(database), count)
+        database.close()
+
+    def test_parallel_stream_matches_stream(self):
+        database = Database(reflect=False)
+        rows = [row for chunk in Query(database, 'proteins_r207', filter_string='gc_content[gt]0.2').stream(database) for row in chunk]
+        parallel_rows = [row for chunk in Query(database, 'proteins_r207', filter_string='gc_content[gt]0.2').parallel_stream(database, chunk_size=4) for row in chunk]
+        database.close()
+        # The rows are only sorted by genome ID, so the order within each genome can differ.
+        self.assertEqual([row['genome_id'] for row in parallel_rows], [row['genome_id'] for row in rows])
+        self.assertEqual(sorted([row['gene_id'] for row in parallel_rows]), sorted([row['gene_id'] for row in rows]))
+
+
+class TestMatch(SQLiteTestCase):
+
+    # The [match] operator uses MariaDB's full-text search, which SQLite doesn't support, so the statements are only compiled.
+    dialect = sqlalchemy.create_mock_engine('mariadb://', None).dialect
+
+    def get_against(self, value:str, field:str='interpro_description') -> str:
+        '''Apply a [match] filter to a statement, and return the compiled search string.'''
+        database = Database(reflect=False)
+        try:
+            table = database.get_table('vocabulary_interpro_r207')
+            filter_ = Filter(database, 'vocabulary_interpro_r207', f'{field}[match]{value}')
+            stmt = filter_.match(select(table.interpro_accession), getattr(table, field), value)
+        finally:
+            database.close()
+        stmt = str(stmt.compile(dialect=TestMatch.dialect, compile_kwargs={'literal_binds':True}))
+        self.assertIn('IN BOOLEAN MODE', stmt)
+        return stmt.split('AGAINST (')[-1].split(' IN BOOLEAN MODE')[0]
+
+    def test_every_keyword_is_required(self):
+        self.assertEqual(self.get_against('ferredoxin'), "'+ferredoxin'")
+        # Keywords are separated by encoded spaces in the URL.
+        self.assertEqual(self.get_against('protein%20kinase+domain'), "'+protein +kinase +domain'")
+
+    def test_keywords_are_sanitised(self):
+        # Boolean operators and quotes are removed, so they can't change the meaning of the search.
+        self.assertEqual(self.get_against('-kinase%20"ABC"%20(iron-sulfur)%20~4Fe%3E'), "'+kinase +ABC +ironsulfur +4Fe'")
+        self.assertEqual(self.get_against("o'brien"), "'+obrien'")
+
+    def test_trailing_star_is_kept(self):
+        self.assertEqual(self.get_against('ferredox*%20kin*ase'), "'+ferredox* +kinase'")
+        self.assertEqual(self.get_against('ferredoxin%20*%20**'), "'+ferredoxin'")
+
+    def test_no_keywords_raises_error(self):
+        # An empty search string would match nothing, so the filter is rejected instead.
+        for value in ['', '*', '%20', '---', '%22%28%29%22', '+-*']:
+            self.assertRaises(ValueError, self.get_against, value)
+
+    def test_field_without_fulltext_index_raises_error(self):
+        self.assertRaises(ValueError, self.get_against, 'IPR000719', field='interpro_accession')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import threading
+import time
+from utils.singleflight import * 
+from utils.query import Filter
+import app
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_threads(self, single_flight:SingleFlight, key, func, n_threads:int=10):
+        '''Call the function with the same key from several threads at once, and return the results (or errors).'''
+        results = [None] * n_threads
+        def target(i):
+            try:
+                results[i] = single_flight.do(key, func)
+            except Exception as err:
+                results[i] = err
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_are_coalesced(self):
+        n_calls = []
+        def func():
+            n_calls.append(1)
+            time.sleep(0.5) # Make sure the other threads arrive while this is running. 
+            return 'result'
+        results = self.run_threads(SingleFlight(), ('count', 'metadata_r207', None), func)
+        self.assertEqual(len(n_calls), 1)
+        self.assertTrue(all([result == 'result' for result in results]))
+
+    def test_errors_are_shared(self):
+        def func():
+            time.sleep(0.5)
+            raise ValueError('error')
+        results = self.run_threads(SingleFlight(), 'key', func)
+        self.assertTrue(all([isinstance(result, ValueError) for result in results]))
+
+    def test_different_keys_are_not_coalesced(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do('a', lambda : 1), 1)
+        self.assertEqual(single_flight.do('b', lambda : 2), 2)
+
+    def test_results_are_not_cached(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do('a', lambda : 1), 1)
+        self.assertEqual(single_flight.do('a', lambda : 2), 2)
+        self.assertEqual(len(single_flight.calls), 0)
+
+
+class TestFilterKeys(unittest.TestCase):
+
+    def test_equivalent_filters_are_normalized(self):
+        filter_strings = ['gtdb_phylum[eq]p1[and]gc_content[gt]0.5', 'gc_content[gt]0.5[and]gtdb_phylum[eq]p1', ' gc_content[gt]0.5 [and] gtdb_phylum[eq] p1 ']
+        self.assertEqual(len(set([Filter.normalize(filter_string) for filter_string in filter_strings])), 1)
+        self.assertEqual(Filter.normalize('ko[eq]K00002[or]K00001[and]gene_id'), Filter.normalize('gene_id[and]ko[eq]K00001[or]K00002'))
+        self.assertNotEqual(Filter.normalize('gc_content[gt]0.5'), Filter.normalize('gc_content[lt]0.5'))
+        self.assertNotEqual(Filter.normalize('gc_content[in]0.1[to]0.5'), Filter.normalize('gc_content[in]0.5[to]0.1'))
+        for filter_string in [None, '', ' ']:
+            self.assertIsNone(Filter.normalize(filter_string))
+
+    def test_equivalent_counts_are_coalesced(self):
+        filter_strings = []
+        def get_count(table_name:str, filter_string:str, **kwargs):
+            filter_strings.append(filter_string)
+            time.sleep(0.5) # Make sure the other requests arrive while this is running. 
+            return '1', 200, {'Content-Type':'text/plain'}
+        get_count_, app.get_count = app.get_count, get_count
+        try:
+            urls = ['/count/proteins_r207?gtdb_phylum[eq]p1[and]gc_content[gt]0.5', '/count/proteins_r207?gc_content[gt]0.5[and]gtdb_phylum[eq]p1']
+            threads = [threading.Thread(target=app.app.test_client().get, args=(urls[i % 2],)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            app.get_count = get_count_
+        self.assertEqual(len(filter_strings), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
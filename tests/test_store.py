@@ -0,0 +1,42 @@
+import unittest
+import os
+import gzip
+import tempfile
+import numpy as np
+from utils.store import *
+
+rng = np.random.default_rng(42)
+GENE_IDS = [f'GCA_{i // 100:09d}.1_{i % 100}' for i in range(1000)]
+SEQS = [''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), size=rng.integers(0, 500))) + '*' for _ in GENE_IDS]
+
+
+class TestSequenceStore(unittest.TestCase):
+
+    dir_ = tempfile.TemporaryDirectory()
+    path = os.path.join(dir_.name, 'proteins_seqs')
+    SequenceStore.build(path, zip(GENE_IDS[::-1], SEQS[::-1]), block_size=4096) # Order of the input entries shouldn't matter.
+    store = SequenceStore(path)
+
+    def test_all_sequences_stored(self):
+        self.assertEqual(len(TestSequenceStore.store), len(GENE_IDS))
+        self.assertEqual(TestSequenceStore.store.get(GENE_IDS), dict(zip(GENE_IDS, SEQS)))
+
+    def test_multiple_blocks_written(self):
+        self.assertGreater(len(TestSequenceStore.store.blocks), 2)
+
+    def test_order_is_preserved(self):
+        gene_ids = list(rng.choice(GENE_IDS, size=50, replace=False))
+        self.assertEqual(list(TestSequenceStore.store.get(gene_ids).keys()), gene_ids)
+
+    def test_missing_gene_ids_are_ignored(self):
+        seqs = TestSequenceStore.store.get([GENE_IDS[0], 'GCA_999999999.1_1', '', GENE_IDS[-1]])
+        self.assertEqual(seqs, {GENE_IDS[0]:SEQS[0], GENE_IDS[-1]:SEQS[-1]})
+
+    def test_data_file_is_valid_fasta(self):
+        with gzip.open(os.path.join(TestSequenceStore.path, SequenceStore.data_file_name), 'rt') as f:
+            content = f.read()
+        self.assertEqual(content, ''.join([f'>{gene_id}\n{seq}\n' for gene_id, seq in zip(GENE_IDS[::-1], SEQS[::-1])]))
+
+
+if __name__ == '__main__':
+    unittest.main()
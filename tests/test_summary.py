@@ -0,0 +1,88 @@
+import unittest
+import io
+import pandas as pd
+from sqlalchemy import select
+from sqlite import SQLiteTestCase, GENOME_IDS, get_metadata, get_proteins
+from utils.database import Database
+from utils.query import Query
+from utils.tables import RANKS
+from app import app
+
+# Gene j of genome i is annotated with K00001 if j is less than i % 3 + 1, and the first gene of every other genome is annotated twice
+# with K00002, so that the numbers of genomes, genes, and annotations are all different.
+ANNOTATIONS = [{'gene_id':f'{genome_id}_{j}', 'genome_id':genome_id, 'ko_id':1, 'version':207} for i, genome_id in enumerate(GENOME_IDS) for j in range(i % 3 + 1)]
+ANNOTATIONS += [{'gene_id':f'{genome_id}_0', 'genome_id':genome_id, 'ko_id':2, 'version':207} for genome_id in GENOME_IDS[::2] for _ in range(2)]
+
+
+class TestSummary(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+        database.bulk_upload('vocabulary_ko_r207', [{'ko_id':1, 'ko':'K00001'}, {'ko_id':2, 'ko':'K00002'}])
+        database.bulk_upload('annotations_kegg_r207', ANNOTATIONS)
+        database.build_summary('summary_kegg_r207', 'annotations_kegg_r207', 'metadata_r207', 'ko')
+
+    def get_summary(self) -> pd.DataFrame:
+        database = Database(reflect=False)
+        table = database.get_table('summary_kegg_r207')
+        summary = pd.DataFrame([row._asdict() for row in database.session.execute(select(table.__table__))])
+        database.close()
+        return summary
+
+    def test_totals_match_count(self):
+        summary = self.get_summary()
+        database = Database(reflect=False)
+        for ko in ['K00001', 'K00002']:
+            count = Query(database, 'annotations_kegg_r207', filter_string=f'ko[eq]{ko}').count(database)
+            # Every genome has exactly one taxon at each rank, so the totals for each rank should be the same.
+            for rank in RANKS:
+                self.assertEqual(summary[(summary.ko == ko) & (summary['rank'] == rank)].n_annotations.sum(), count)
+        database.close()
+
+    def test_counts_match_count(self):
+        summary = self.get_summary().set_index(['ko', 'rank', 'taxon'])
+        database = Database(reflect=False)
+        for ko in ['K00001', 'K00002']:
+            for phylum in ['p0', 'p1']:
+                count = Query(database, 'annotations_kegg_r207', filter_string=f'ko[eq]{ko}[and]gtdb_phylum[eq]{phylum}').count(database)
+                # There is no row for a taxon without any annotations, e.g. K00002 in p1.
+                self.assertEqual(summary.n_annotations.get((ko, 'gtdb_phylum', phylum), 0), count)
+        database.close()
+
+        annotations = pd.DataFrame(ANNOTATIONS)
+        annotations = annotations[annotations.ko_id == 2]
+        self.assertEqual(summary.loc[('K00002', 'gtdb_domain', 'd0')].n_genomes, annotations.genome_id.nunique())
+        self.assertEqual(summary.loc[('K00002', 'gtdb_domain', 'd0')].n_genes, annotations.gene_id.nunique())
+        self.assertEqual(summary.loc[('K00002', 'gtdb_domain', 'd0')].n_annotations, len(annotations))
+
+    def test_missing_ranks_are_counted_as_none(self):
+        summary = self.get_summary()
+        self.assertEqual(summary[summary['rank'] == 'gtdb_class'].taxon.unique().tolist(), ['none'])
+
+    def test_rebuild_replaces_rows(self):
+        n = len(self.get_summary())
+        database = Database(reflect=False)
+        database.build_summary('summary_kegg_r207', 'annotations_kegg_r207', 'metadata_r207', 'ko')
+        database.close()
+        self.assertEqual(len(self.get_summary()), n)
+
+    def test_approx_count_is_exact(self):
+        database = Database(reflect=False)
+        for filter_string in ['ko[eq]K00001', 'ko[eq]K00001[and]gtdb_phylum[eq]p1', 'ko[eq]K00002[and]gtdb_phylum[eq]p1']:
+            query = Query(database, 'annotations_kegg_r207', filter_string=filter_string)
+            self.assertIsNotNone(query.get_summary(database, 207))
+            self.assertEqual(query.approx_count(database), (Query(database, 'annotations_kegg_r207', filter_string=filter_string).count(database), 0))
+        database.close()
+
+    def test_endpoint(self):
+        response = app.test_client().get('/summary/summary_kegg_r207?ko[eq]K00001[and]rank[eq]gtdb_phylum')
+        self.assertEqual(response.status_code, 200)
+        results = pd.read_csv(io.StringIO(response.get_data(as_text=True)))
+        self.assertEqual(sorted(results.taxon.tolist()), ['p0', 'p1'])
+        self.assertEqual(results.n_annotations.sum(), len([a for a in ANNOTATIONS if (a['ko_id'] == 1)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
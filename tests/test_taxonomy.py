@@ -0,0 +1,55 @@
+import unittest
+import pandas as pd 
+import numpy as np 
+from utils.taxonomy import * 
+from utils.tables import RANKS
+
+
+def get_metadata(n_genomes:int=200, seed:int=42) -> pd.DataFrame:
+    '''Generate a fake metadata table with a random lineage for each genome.'''
+    rng = np.random.default_rng(seed)
+    data = {'genome_id':[f'GCA_{i:09d}.1' for i in range(n_genomes)]}
+    for i, rank in enumerate(RANKS):
+        # Prepend the higher ranks so that names at each rank are nested in a single parent. 
+        data[rank] = [f'{rank}_{x}' for x in rng.integers(0, 2 + i, size=n_genomes)]
+    data = pd.DataFrame(data)
+    for i, rank in enumerate(RANKS[1:]):
+        data[rank] = data[RANKS[i]] + ';' + data[rank]
+    data.loc[::7, 'gtdb_species'] = 'none' # Missing species names appear in lots of places in the taxonomy. 
+    return data
+
+
+class TestTaxonomy(unittest.TestCase):
+
+    metadata, nodes = build_taxonomy(get_metadata())
+
+    def test_taxonomy_indices_are_unique(self):
+        self.assertEqual(len(np.unique(TestTaxonomy.metadata.taxonomy_index)), len(TestTaxonomy.metadata))
+
+    def test_ranges_match_clades(self):
+        metadata, nodes = TestTaxonomy.metadata, TestTaxonomy.nodes
+        for rank in RANKS[:-1]:
+            for name in metadata[rank].unique():
+                clade = metadata[metadata[rank] == name]
+                node = nodes[(nodes['rank'] == rank) & (nodes['name'] == name)]
+                self.assertEqual(len(node), 1)
+                in_range = metadata.taxonomy_index.between(node.left_index.iloc[0], node.right_index.iloc[0])
+                self.assertEqual(set(metadata[in_range].genome_id), set(clade.genome_id))
+
+    def test_repeated_names_have_multiple_ranges(self):
+        metadata, nodes = TestTaxonomy.metadata, TestTaxonomy.nodes
+        node = nodes[(nodes['rank'] == 'gtdb_species') & (nodes['name'] == 'none')]
+        self.assertGreater(len(node), 1)
+        in_range = np.any([metadata.taxonomy_index.between(left, right) for left, right in zip(node.left_index, node.right_index)], axis=0)
+        self.assertEqual(in_range.sum(), (metadata.gtdb_species == 'none').sum())
+
+    def test_parents_contain_children(self):
+        nodes = TestTaxonomy.nodes.set_index('node_id')
+        children = nodes[nodes.parent_id >= 0]
+        parents = nodes.loc[children.parent_id]
+        self.assertTrue(np.all(parents.left_index.values <= children.left_index.values))
+        self.assertTrue(np.all(parents.right_index.values >= children.right_index.values))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from sqlalchemy import select
+from sqlite import SQLiteTestCase, GENOME_IDS, get_metadata, get_proteins
+from utils.database import Database
+from utils.query import Query
+from utils.tables import get_accession_id
+
+PFAM = [('PF00069', 'IPR000719', 'Protein kinase domain'), ('PF00005', 'IPR003439', 'ABC transporter-like, ATP-binding domain'), ('PF13499', '-', '-')]
+
+
+def get_pfam_annotations(genome_ids:list=GENOME_IDS) -> list:
+    '''Get Pfam annotations for the genomes, before they are encoded. The first gene in each genome gets each of the Pfam families.'''
+    return [{'gene_id':f'{genome_id}_0', 'genome_id':genome_id, 'pfam':pfam, 'interpro_accession':interpro_accession, 'interpro_description':interpro_description, 'version':207} for genome_id in genome_ids for pfam, interpro_accession, interpro_description in PFAM]
+
+
+class TestVocabulary(SQLiteTestCase):
+
+    @classmethod
+    def populate(cls, database:Database):
+        database.bulk_upload('metadata_r207', get_metadata())
+        database.bulk_upload('proteins_r207', get_proteins())
+        # The files are encoded separately when they are uploaded, so the same values are added to the vocabulary more than once.
+        for genome_ids in [GENOME_IDS[:5], GENOME_IDS[5:]]:
+            database.bulk_upload('annotations_pfam_r207', database.encode('annotations_pfam_r207', get_pfam_annotations(genome_ids)))
+        annotations = [{'gene_id':f'{genome_id}_{j}', 'genome_id':genome_id, 'ko':f'K0000{j + 1}', 'e_value':0.1 * j, 'version':207} for genome_id in GENOME_IDS for j in range(3)]
+        database.bulk_upload('annotations_kegg_r207', database.encode('annotations_kegg_r207', annotations))
+
+    def test_accession_ids(self):
+        accessions = {'K00001':1, 'K12345':12345, 'PF00069':69, 'IPR000719':719, '-':0, None:0, float('nan'):0}
+        for accession, id_ in accessions.items():
+            self.assertEqual(get_accession_id(accession), id_)
+
+    def test_entries_are_encoded(self):
+        database = Database(reflect=False)
+        entries = database.encode('annotations_kegg_r207', [{'gene_id':'x', 'genome_id':GENOME_IDS[0], 'ko':'K00002', 'version':207}])
+        database.close()
+        self.assertEqual(entries, [{'gene_id':'x', 'genome_id':GENOME_IDS[0], 'ko_id':2, 'version':207}])
+        self.assertEqual(database.encode('annotations_kegg_r207', []), [])
+
+    def test_vocabulary_has_no_duplicates(self):
+        database = Database(reflect=False)
+        vocabulary = database.session.execute(select(database.get_table('vocabulary_interpro_r207').__table__)).all()
+        vocabulary_ko = database.session.execute(select(database.get_table('vocabulary_ko_r207').__table__)).all()
+        database.close()
+        self.assertEqual(sorted([tuple(row) for row in vocabulary]), sorted([(get_accession_id(accession), accession, description) for _, accession, description in PFAM]))
+        self.assertEqual(sorted([tuple(row) for row in vocabulary_ko]), [(1, 'K00001'), (2, 'K00002'), (3, 'K00003')])
+
+    def test_annotations_are_decoded(self):
+        database = Database(reflect=False)
+        rows = [row._asdict() for row in Query(database, 'annotations_pfam_r207', filter_string=f'genome_id[eq]{GENOME_IDS[5]}').get(database)]
+        database.close()
+        # The IDs are replaced with the values from the vocabulary tables.
+        self.assertEqual(sorted([(row['pfam'], row['interpro_accession'], row['interpro_description']) for row in rows]), sorted(PFAM))
+        self.assertTrue(all([('pfam_id' not in row) and ('interpro_id' not in row) for row in rows]))
+
+    def test_filters_look_up_ids(self):
+        database = Database(reflect=False)
+        self.assertEqual(Query(database, 'annotations_pfam_r207', filter_string='pfam[eq]PF00069').count(database), len(GENOME_IDS))
+        self.assertEqual(Query(database, 'annotations_pfam_r207', filter_string='interpro_accession[eq]IPR000719[or]-').count(database), 2 * len(GENOME_IDS))
+        self.assertEqual(Query(database, 'annotations_kegg_r207', filter_string='ko[eq]K00001[or]K00003[and]e_value[lt]0.15').count(database), len(GENOME_IDS))
+        self.assertEqual(Query(database, 'annotations_kegg_r207', filter_string='ko[eq]K99999').count(database), 0)
+        rows = [row._asdict() for row in Query(database, 'annotations_kegg_r207', filter_string=f'ko[eq]K00002[and]genome_id[eq]{GENOME_IDS[0]}').get(database)]
+        database.close()
+        self.assertEqual([(row['gene_id'], row['ko']) for row in rows], [(f'{GENOME_IDS[0]}_1', 'K00002')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+'''Functions for recommending indices based on the query log written by Query.log. Each logged query has a "shape" (the columns it filters
+on and the operator used for each, as well as the column it is sorted by), and queries with the same shape can use the same index. The
+advisor builds a candidate index for each shape, checks whether it is already covered by one of the indices declared in utils/tables.py,
+and ranks the missing ones by the number of rows examined by the queries which would use them.'''
+import json
+import pandas as pd
+from typing import List, Dict, Tuple
+
+
+def load_log(path:str) -> List[Dict]:
+    '''Read the entries in a query log, skipping any lines which are incomplete (e.g. if the log was being written to).'''
+    entries = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
+
+
+def get_indices(table) -> List[Tuple[str]]:
+    '''Get the columns of every index on a table, including the primary key. MariaDB creates an index for every foreign key which is not
+    already the prefix of another index, so these are included too.'''
+    indices = [tuple(col.name for col in table.__table__.primary_key.columns)]
+    indices += [tuple(col.name for col in index.columns) for index in table.__table__.indexes]
+    indices += [tuple(constraint.column_keys) for constraint in table.__table__.foreign_key_constraints]
+    return indices
+
+
+def get_candidates(entry:Dict) -> List[Tuple[str, Tuple[str]]]:
+    '''Get the index which would best serve a logged query on each of the tables it filters. Columns compared using equality come first,
+    followed by at most one range column, as the index can't be used past the first range. For the table being queried, the column the
+    results are sorted by is added at the end (if there is no range column), so that the database can avoid a filesort.
+
+    :param entry: An entry in the query log.
+    :return: A list of (table name, columns) tuples.
+    '''
+    tables = dict()
+    for table_name, col, operator in entry['filters']:
+        tables.setdefault(table_name, ([], []))
+        tables[table_name][0 if (operator == '[eq]') else 1].append(col)
+
+    candidates = []
+    for table_name, (eq_cols, range_cols) in tables.items():
+        cols = sorted(set(eq_cols))
+        if len(range_cols) > 0:
+            cols.append(range_cols[0])
+        elif (table_name == entry['table']) and (entry.get('order_by') is not None) and (entry['order_by'] not in cols):
+            cols.append(entry['order_by'])
+        candidates.append((table_name, tuple(cols)))
+    return candidates
+
+
+def is_covered(cols:Tuple[str], indices:List[Tuple[str]], n_eq:int) -> bool:
+    '''Check if the candidate index is covered by an existing index, i.e. if one of the indices starts with the candidate's columns. The
+    order of the equality columns (the first n_eq columns) doesn't matter.'''
+    for index in indices:
+        if len(index) < len(cols):
+            continue
+        if (set(index[:n_eq]) == set(cols[:n_eq])) and (tuple(index[n_eq:len(cols)]) == tuple(cols[n_eq:])):
+            return True
+    return False
+
+
+def advise(entries:List[Dict], tables:List) -> pd.DataFrame:
+    '''Find the indices which would serve the logged queries, but which are not already declared.
+
+    :param entries: The entries in the query log.
+    :param tables: The table classes, e.g. Database.tables.
+    :return: A DataFrame with one row per missing index, with columns table, columns, n_queries (the number of logged queries which would
+        use it), and cost (the total number of rows those queries were estimated to examine, which is an upper bound on the benefit of the
+        index). The rows are sorted by cost.
+    '''
+    tables = {table.__tablename__:table for table in tables}
+    missing = dict()
+    for entry in entries:
+        for table_name, cols in get_candidates(entry):
+            if (table_name not in tables) or (len(cols) == 0):
+                continue
+            n_eq = len(set([col for t, col, operator in entry['filters'] if (t == table_name) and (operator == '[eq]')]))
+            if is_covered(cols, get_indices(tables[table_name]), n_eq):
+                continue
+            n_queries, cost = missing.get((table_name, cols), (0, 0))
+            missing[(table_name, cols)] = (n_queries + 1, cost + (entry.get('cost') or 0))
+
+    rows = [{'table':table_name, 'columns':','.join(cols), 'n_queries':n_queries, 'cost':cost} for (table_name, cols), (n_queries, cost) in missing.items()]
+    results = pd.DataFrame(rows, columns=['table', 'columns', 'n_queries', 'cost'])
+    return results.sort_values(['cost', 'n_queries'], ascending=False).reset_index(drop=True)
+
@@ -0,0 +1,109 @@
+'''Class for managing bitmap indices, which map each annotation (i.e. a KO or Pfam) to the set of genomes which carry it. Each genome is
+assigned an ordinal (its position in the sorted list of genome IDs), and the genomes carrying each annotation are stored as a packed bit array
+over these ordinals. This makes it possible to build genome-by-annotation presence/absence matrices, and to do set algebra on annotations,
+without touching the annotations tables.'''
+import h5py
+import numpy as np
+import pandas as pd
+from typing import List, Dict, Iterable, Tuple, Generator
+
+# NOTE: The bitmaps are stored in an HDF5 file as a 2D array with one row per feature, compressed using gzip. Most bitmaps are very sparse,
+# so they compress well. The file is chunked by row, so only the rows which are needed are decompressed when reading.
+
+
+class BitmapIndex():
+
+    operators = ['or', 'and', 'andnot']
+
+    @staticmethod
+    def build(path:str, genome_ids:List[str], groups:Iterable[Tuple[str, List[str]]]):
+        '''Build a bitmap index and write it to an HDF5 file. The groups are consumed one at a time, so only one bitmap is held in memory.
+
+        :param path: The path where the index will be written.
+        :param genome_ids: All genome IDs in the database, which determine the ordinals.
+        :param groups: An iterable of (feature, genome IDs) tuples, e.g. ('K00001', ['GCA_000007325.1', ...]). Each feature should only appear once.
+        '''
+        genome_ids = np.sort(np.array(genome_ids, dtype=str))
+        n_bytes = (len(genome_ids) + 7) // 8
+
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('genome_ids', data=genome_ids.astype(bytes))
+            bitmaps = f.create_dataset('bitmaps', shape=(0, n_bytes), maxshape=(None, n_bytes), dtype=np.uint8, chunks=(1, n_bytes), compression='gzip')
+            features = []
+            for feature, feature_genome_ids in groups:
+                feature_genome_ids = np.array(feature_genome_ids, dtype=str)
+                ordinals = np.minimum(np.searchsorted(genome_ids, feature_genome_ids), len(genome_ids) - 1)
+                bitmap = np.zeros(len(genome_ids), dtype=bool)
+                bitmap[ordinals[genome_ids[ordinals] == feature_genome_ids]] = True # Ignore any genomes which are not in the list.
+                bitmaps.resize(len(features) + 1, axis=0)
+                bitmaps[len(features)] = np.packbits(bitmap)
+                features.append(feature)
+            f.create_dataset('features', data=np.array(features, dtype=bytes))
+
+    def __init__(self, path:str):
+
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.genome_ids = self.file['genome_ids'][:].astype(str)
+        # The list of features is small, so keep a map from each feature to its row in the bitmaps array in memory.
+        self.features = {feature:i for i, feature in enumerate(self.file['features'][:].astype(str))}
+
+    def close(self):
+        self.file.close()
+
+    def get(self, features:List[str]) -> np.ndarray:
+        '''Get the unpacked bitmaps for a list of features, as a boolean array of shape (len(features), number of genomes).
+        Features which are not in the index have no genomes.'''
+        bitmaps = np.zeros((len(features), len(self.genome_ids)), dtype=bool)
+        rows = [(i, self.features[feature]) for i, feature in enumerate(features) if feature in self.features]
+        if len(rows) > 0:
+            # HDF5 requires the rows to be read in increasing order, with no duplicates.
+            unique_rows = sorted(set([row for _, row in rows]))
+            packed = self.file['bitmaps'][unique_rows, :]
+            unpacked = np.unpackbits(packed, axis=1, count=len(self.genome_ids)).astype(bool)
+            positions = {row:j for j, row in enumerate(unique_rows)}
+            for i, row in rows:
+                bitmaps[i] = unpacked[positions[row]]
+        return bitmaps
+
+    def get_ordinals(self, genome_ids:List[str]) -> np.ndarray:
+        '''Get the ordinals for a list of genome IDs, raising an error if any are not in the index.'''
+        genome_ids = np.array(genome_ids, dtype=str)
+        ordinals = np.searchsorted(self.genome_ids, genome_ids)
+        ordinals = np.minimum(ordinals, len(self.genome_ids) - 1)
+        missing = genome_ids[self.genome_ids[ordinals] != genome_ids]
+        if len(missing) > 0:
+            raise ValueError(f"BitmapIndex.get_ordinals: Genome IDs {', '.join(missing[:10])} are not in the index.")
+        return ordinals
+
+    def query(self, features:List[str], operator:str='or') -> List[str]:
+        '''Get the genome IDs which result from combining the bitmaps of the features using the operator. The andnot
+        operator returns the genomes which carry the first feature, but none of the others.'''
+        if operator not in BitmapIndex.operators:
+            raise ValueError(f"BitmapIndex.query: Operator {operator} is not supported. Supported operators are {', '.join(BitmapIndex.operators)}.")
+        if len(features) == 0:
+            raise ValueError('BitmapIndex.query: At least one feature must be specified.')
+        bitmaps = self.get(features)
+        if operator == 'or':
+            bitmap = np.any(bitmaps, axis=0)
+        elif operator == 'and':
+            bitmap = np.all(bitmaps, axis=0)
+        elif operator == 'andnot':
+            bitmap = bitmaps[0] & ~np.any(bitmaps[1:], axis=0)
+        return self.genome_ids[bitmap].tolist()
+
+    def matrix(self, features:List[str], genome_ids:List[str]=None, chunk_size:int=1000) -> Generator[List[Dict], None, None]:
+        '''Build a genome-by-feature presence/absence matrix, yielded in chunks of rows (one row per genome) so it can be written
+        using the functions in utils/formats.py.
+
+        :param features: The features to include as columns.
+        :param genome_ids: The genomes to include as rows. If None, all genomes are included.
+        :param chunk_size: The number of rows in each chunk.
+        '''
+        features = list(dict.fromkeys(features)) # Remove duplicate features, preserving order. 
+        ordinals = np.arange(len(self.genome_ids)) if (genome_ids is None) else self.get_ordinals(genome_ids)
+        bitmaps = self.get(features).astype(np.uint8)
+        for i in range(0, len(ordinals), chunk_size):
+            df = pd.DataFrame(bitmaps[:, ordinals[i:i + chunk_size]].T, columns=features)
+            df.insert(0, 'genome_id', self.genome_ids[ordinals[i:i + chunk_size]])
+            yield df.to_dict(orient='records')
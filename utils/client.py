@@ -0,0 +1,166 @@
+'''A Python client for the Find-A-Bug API. The client builds filter strings, gets the number of results from the /count endpoint, and
+then fetches the pages of results from the /get endpoint concurrently, retrying any requests which fail. Because each GTDB release is
+never modified once it is uploaded, pages can be cached on disk indefinitely, so re-running a notebook doesn't re-send the same requests.'''
+import io
+import os
+import time
+import hashlib
+import collections
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Generator
+
+# pyarrow is only needed to return results as an Arrow table, so don't require it to use the client.
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class ClientError(Exception):
+    '''Raised when the server rejects a request, e.g. if the filter string is invalid or the query is too expensive.'''
+    pass
+
+
+def get_filter_string(filters:Dict[str, Any]=None, include:List[str]=None) -> str:
+    '''Build a filter string which can be parsed by Filter.parse in utils/query.py.
+
+    :param filters: A dictionary mapping each field to the value(s) to filter on. A single value is matched exactly, a list of values
+        matches any of them, and an (operator, value) tuple uses the specified operator, e.g. ('gt', 0.5), ('in', (0.4, 0.6)), or
+        ('under', 'Methanobacteriales').
+    :param include: Fields to include in the results, in addition to the fields in the table being queried.
+    :return: The filter string, e.g. genome_id[eq]GB_GCA_000008085.1[or]GB_GCA_000010525.1[and]gc_content[gt]0.5.
+    '''
+    filters = dict() if (filters is None) else filters
+    include = list() if (include is None) else include
+
+    filter_string = []
+    for field, value in filters.items():
+        if isinstance(value, tuple):
+            operator, value = value
+            operator = operator.strip('[]')
+            if operator == 'in':
+                low, high = value
+                value = f'{low}[to]{high}'
+            filter_string.append(f'{field}[{operator}]{value}')
+        elif isinstance(value, (list, set)):
+            filter_string.append(f'{field}[eq]' + '[or]'.join([str(v) for v in value]))
+        else:
+            filter_string.append(f'{field}[eq]{value}')
+    filter_string += include
+    return '[and]'.join(filter_string)
+
+
+class Client():
+
+    base_url = 'https://microbes.gps.caltech.edu'
+    page_size = 500 # The number of results per page, which must match the page size used by the /get endpoint.
+
+    def __init__(self, version:int=207, base_url:str=None, max_workers:int=4, max_retries:int=3, backoff:float=1, cache_dir:str=None, session=None):
+        '''
+        :param version: The GTDB release to query.
+        :param base_url: The URL of the server. Defaults to the public Find-A-Bug server.
+        :param max_workers: The maximum number of requests to send at the same time.
+        :param max_retries: The number of times to retry a request which fails because of a connection error or a server error.
+        :param backoff: The number of seconds to wait before the first retry, which is doubled for each subsequent retry.
+        :param cache_dir: The directory where pages are cached. If None, results are not cached.
+        :param session: The object used to send the requests, which must have a get method. Defaults to a requests.Session, but can
+            also be e.g. a Flask test client.
+        '''
+        self.version = version
+        self.base_url = Client.base_url if (base_url is None) else base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache_dir = cache_dir
+        self.session = requests.Session() if (session is None) else session
+        self.n_requests = 0 # The number of requests actually sent to the server, which is mostly useful for testing.
+
+    def get_url(self, endpoint:str, table_name:str, filter_string:str, page:int=None) -> str:
+        url = f'{self.base_url}/{endpoint}/{table_name}_r{self.version}?{filter_string}'
+        if page is not None:
+            url += f'[and][page]{page}' if (len(filter_string) > 0) else f'[page]{page}'
+        return url
+
+    def get_cache_path(self, url:str) -> str:
+        '''Get the path where the response to a request is cached. The URL includes the release version, the table, the filter string,
+        and the page, but not the server, so that the same cache can be used with a mirror.'''
+        key = hashlib.sha256(url.replace(self.base_url, '').encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'r{self.version}', key)
+
+    def request(self, url:str) -> str:
+        '''Send a GET request to the server, retrying with exponential backoff if it fails. Responses are read from and written to the
+        cache, if there is one.'''
+        cache_path = None if (self.cache_dir is None) else self.get_cache_path(url)
+        if (cache_path is not None) and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                return f.read()
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+            try:
+                self.n_requests += 1
+                response = self.session.get(url)
+            except requests.RequestException as err:
+                error = err
+                continue
+            if response.status_code == 200:
+                break
+            elif (response.status_code >= 500) or (response.status_code == 429):
+                error = ClientError(f'Client.request: Request to {url} failed with status code {response.status_code}.\n{response.text}')
+                continue
+            raise ClientError(f'Client.request: Request to {url} failed with status code {response.status_code}.\n{response.text}')
+        else:
+            raise error
+
+        if cache_path is not None:
+            # Write to a temporary file first, so that a partially-written response is never read from the cache.
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + f'.{os.getpid()}.tmp', 'w') as f:
+                f.write(response.text)
+            os.replace(cache_path + f'.{os.getpid()}.tmp', cache_path)
+        return response.text
+
+    def count(self, table_name:str, filters:Dict[str, Any]=None) -> int:
+        '''Get the number of results matching the filters.'''
+        filter_string = get_filter_string(filters)
+        return int(self.request(self.get_url('count', table_name, filter_string)))
+
+    def get_page(self, table_name:str, filter_string:str, page:int) -> pd.DataFrame:
+        text = self.request(self.get_url('get', table_name, filter_string, page=page))
+        if len(text) == 0: # The server returns an empty string if there are no results.
+            return pd.DataFrame()
+        return pd.read_csv(io.StringIO(text), index_col=0)
+
+    def pages(self, table_name:str, filters:Dict[str, Any]=None, include:List[str]=None) -> Generator[pd.DataFrame, None, None]:
+        '''Fetch the pages of results concurrently, yielding them in order. At most max_workers pages are fetched ahead of the page
+        being yielded, so the results don't need to fit in memory all at once.'''
+        filter_string = get_filter_string(filters, include=include)
+        n_pages = -(-self.count(table_name, filters) // self.page_size)
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = collections.deque()
+            for page in range(n_pages):
+                futures.append(pool.submit(self.get_page, table_name, filter_string, page))
+                if len(futures) >= self.max_workers:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+
+    def get(self, table_name:str, filters:Dict[str, Any]=None, include:List[str]=None, arrow:bool=False):
+        '''Get all results matching the filters.
+
+        :param table_name: The name of the table to query, without the version suffix, e.g. proteins.
+        :param filters: The filters to apply (see get_filter_string).
+        :param include: Fields from related tables to include in the results.
+        :param arrow: Whether or not to return the results as a pyarrow Table instead of a DataFrame.
+        '''
+        pages = [page for page in self.pages(table_name, filters, include=include) if len(page) > 0]
+        data = pd.concat(pages).reset_index(drop=True) if (len(pages) > 0) else pd.DataFrame()
+        if arrow:
+            if pa is None:
+                raise ImportError('Client.get: The pyarrow package is required to return results as an Arrow table.')
+            return pa.Table.from_pandas(data, preserve_index=False)
+        return data
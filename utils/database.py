@@ -1,16 +1,33 @@
 import sqlalchemy
-from sqlalchemy import insert, text
-from utils.tables import create_annotations_kegg_table, create_annotations_pfam_table, create_metadata_table, create_proteins_table, Reflected
-from typing import List, Dict, NoReturn
+from sqlalchemy import insert, text, select, delete, func, literal
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from utils.tables import create_annotations_kegg_table, create_annotations_pfam_table, create_metadata_table, create_proteins_table, Reflected, GENE_ID_LENGTH
+from utils.tables import create_summary_kegg_table, create_summary_pfam_table, create_taxonomy_table, RANKS
+from utils.tables import create_vocabulary_ko_table, create_vocabulary_pfam_table, create_vocabulary_interpro_table, VOCABULARIES, get_accession_id
+from utils.tables import Partitioning, get_genome_key, create_boundaries_table
+from utils.metadata import MetadataCache
+from typing import List, Dict, NoReturn, Iterable
 import pandas as pd
+import numpy as np
+
+# How the proteins and annotations tables are partitioned by genome, e.g. Partitioning('hash', n_partitions=32). If None, the tables are 
+# not partitioned. The tables need to be re-created (and re-loaded) for a change to take effect. 
+PARTITIONING = None
 
 class Database():
     versions = [207]
         
     tables = [create_metadata_table(version) for version in versions]
-    tables += [create_proteins_table(version) for version in versions]
-    tables += [create_annotations_kegg_table(version) for version in versions]
-    tables += [create_annotations_pfam_table(version) for version in versions]
+    tables += [create_taxonomy_table(version) for version in versions]
+    tables += [create_boundaries_table(version) for version in versions]
+    tables += [create_proteins_table(version, partitioning=PARTITIONING) for version in versions]
+    tables += [create_vocabulary_ko_table(version) for version in versions]
+    tables += [create_vocabulary_pfam_table(version) for version in versions]
+    tables += [create_vocabulary_interpro_table(version) for version in versions]
+    tables += [create_annotations_kegg_table(version, partitioning=PARTITIONING) for version in versions]
+    tables += [create_annotations_pfam_table(version, partitioning=PARTITIONING) for version in versions]
+    tables += [create_summary_kegg_table(version) for version in versions]
+    tables += [create_summary_pfam_table(version) for version in versions]
     table_names = [table.__tablename__ for table in tables]
 
     # host = '127.0.0.1' # Equivalent to localhost, although not sure why this would work and localhost doesn't.
@@ -21,12 +38,27 @@ class Database():
     password = 'Doledi7-Bebyno2'
     name = 'findabug'
     url = f'{dialect}+{driver}://{user}:{password}@{host}/{name}'
+    # The driver used by the async engine, which is only needed when serving the app with asgi.py. 
+    async_driver = 'aiomysql'
+    async_url = f'{dialect}+{async_driver}://{user}:{password}@{host}/{name}'
+    async_engine_kwargs = {'pool_size':100, 'max_overflow':20}
+    # The async engine is shared by every request in the process, as opening a new pool for each request defeats the point. 
+    async_engine = None
 
-    def __init__(self, reflect:bool=True, versions:List[int]=[207]):
+    # Directory where the on-disk indices built by scripts/setup.py (e.g. the bitmap indices) are stored. 
+    index_dir = '/home/prichter/microbes-data1/findabug/'
 
-        self.engine = sqlalchemy.create_engine(Database.url, pool_size=100, max_overflow=20)
+    def __init__(self, reflect:bool=True, versions:List[int]=[207], engine:sqlalchemy.Engine=None, outer_tables:Dict[str, str]=None):
+        '''
+        :param reflect: Whether or not to reflect the tables from the database.
+        :param engine: An existing engine to use instead of creating a new one (see Database.fork). 
+        :param outer_tables: An existing cache of the outer table of the query on each table (see Query.get_outer_table).
+        '''
+        self.shared_engine = engine is not None # The engine is only disposed of by the Database which created it. 
+        self.engine = sqlalchemy.create_engine(Database.url, pool_size=100, max_overflow=20) if (engine is None) else engine
 
         self.session = sqlalchemy.orm.Session(self.engine, autobegin=True) 
+        self.outer_tables = dict() if (outer_tables is None) else outer_tables
     
         if reflect:
             # for table in Database.tables:
@@ -34,6 +66,38 @@ class Database():
             Reflected.prepare(self.engine)
   
 
+    def fork(self):
+        '''Get a new Database which shares the engine (and so the connection pool) and the cached query plans, but has its own session, 
+        so that it can be used to run queries from another thread. The tables are not reflected again.'''
+        return Database(reflect=False, engine=self.engine, outer_tables=self.outer_tables)
+
+    def get_session(self) -> sqlalchemy.orm.Session:
+        '''Open a new session on the shared engine. Sessions are not thread-safe, so this should be used to get a separate session 
+        (and connection) for each thread when running statements in parallel. The caller is responsible for closing it.'''
+        return sqlalchemy.orm.Session(self.engine, autobegin=True)
+
+    def get_async_engine(self) -> AsyncEngine:
+        '''Get the async engine shared by the process, creating it if it doesn't exist yet. The engine must be used from the event loop 
+        it was created in.'''
+        if Database.async_engine is None:
+            Database.async_engine = create_async_engine(Database.async_url, **Database.async_engine_kwargs)
+        return Database.async_engine
+
+    def get_async_session(self) -> AsyncSession:
+        '''Open a new async session on the shared async engine. The caller is responsible for closing it.'''
+        return AsyncSession(self.get_async_engine())
+
+    async def async_reflect(self):
+        '''Reflect the tables using the async engine, which only needs to be done once, when the process starts.'''
+        async with self.get_async_engine().connect() as conn:
+            await conn.run_sync(Reflected.prepare)
+
+    async def async_close(self):
+        '''Dispose of the shared async engine, closing all of its connections.'''
+        if Database.async_engine is not None:
+            await Database.async_engine.dispose()
+            Database.async_engine = None
+
     def has_table(self, table_name:str) -> bool:
         '''Checks for the existence of a table in the database.'''
         return sqlalchemy.inspect(self.engine).has_table(table_name)
@@ -52,6 +116,7 @@ class Database():
         if self.has_table(table_name): # Only try to drop tables that actually exist.
             table = self.get_table(table_name)
             table.__table__.drop(self.engine)
+            MetadataCache.invalidate(table_name)
 
     def drop_all(self) -> NoReturn:
         '''Delete all tables found in the Database.'''
@@ -77,6 +142,8 @@ class Database():
     def upload(self, table_name:str, entry:Dict):
 
         table = self.get_table(table_name)
+        if 'genome_key' in table.__table__.c: # Hash-partitioned tables also store the genome key. 
+            entry['genome_key'] = get_genome_key(entry['genome_id'])
         stmt = insert(table).values(**entry)
         self.session.execute(stmt)
         self.session.commit()
@@ -85,9 +152,142 @@ class Database():
         # Sometimes the list of entries is empty, which can cause some errors with SQLAlchemy. 
         if len(entries) > 0:
             table = self.get_table(table_name)
-            self.session.execute(insert(table), entries) 
+            partitioning = getattr(table, 'partitioning', None)
+            if partitioning is None:
+                self.session.execute(insert(table), entries) 
+            else:
+                # Insert the entries for each partition separately, so each statement only touches the indices of a single partition, and
+                # loaders running in parallel are less likely to contend for the same pages. 
+                partitions = dict()
+                for entry in entries:
+                    if partitioning.field == 'genome_key':
+                        entry['genome_key'] = get_genome_key(entry['genome_id'])
+                    partitions.setdefault(partitioning.get_partition(entry['genome_id']), []).append(entry)
+                for partition in sorted(partitions.keys()):
+                    self.session.execute(insert(table), partitions[partition])
+            self.session.commit()
+            MetadataCache.invalidate(table_name) # Make sure the new rows are seen by any filters in this process. 
+
+    def get_vocabulary_tables(self, table_name:str) -> Dict:
+        '''Get the vocabulary tables for the dictionary-encoded fields in a table, keyed by the name of the ID column which refers to them.'''
+        table, version = self.get_table(table_name), table_name.split('_r')[-1]
+        id_fields = sorted(set(VOCABULARIES.values()))
+        return {id_field:self.get_table(f'vocabulary_{vocabulary}_r{version}') for vocabulary, id_field in id_fields if (id_field in table.__table__.c)}
+
+    def encode(self, table_name:str, entries:List[Dict]) -> List[Dict]:
+        '''Dictionary-encode the KO, Pfam, and InterPro fields of the entries to be uploaded to a table, replacing them with the IDs 
+        of the corresponding rows in the vocabulary tables. Any new values are added to the vocabulary tables. The IDs are derived from the 
+        accessions, so this can be called from multiple processes at once.
+
+        :param table_name: The name of the table the entries will be uploaded to. 
+        :param entries: The entries to encode, which are modified in place. 
+        :return: The encoded entries. 
+        '''
+        if len(entries) == 0:
+            return entries
+        version = table_name.split('_r')[-1]
+
+        for vocabulary, id_field in sorted(set(VOCABULARIES.values())):
+            # The accession is always listed first, and is used to get the ID. 
+            fields = [field for field, (v, _) in VOCABULARIES.items() if (v == vocabulary) and (field in entries[0])]
+            if len(fields) == 0:
+                continue
+            values = dict()
+            for entry in entries:
+                value = {field:entry.pop(field) for field in fields}
+                entry[id_field] = get_accession_id(value[fields[0]])
+                values[entry[id_field]] = value
+            
+            table = self.get_table(f'vocabulary_{vocabulary}_r{version}')
+            stmt = insert(table).prefix_with('IGNORE', dialect=Database.dialect).prefix_with('OR IGNORE', dialect='sqlite') # Skip values which are already in the vocabulary. 
+            self.session.execute(stmt, [{id_field:id_, **value} for id_, value in values.items()])
+            self.session.commit()
+
+        return entries
+
+    def load_ids(self, ids:Iterable[str], chunk_size:int=10000) -> sqlalchemy.Table:
+        '''Bulk-load a (potentially very large) collection of IDs into a temporary table, which can then be joined against 
+        the other tables in the database. This is much more efficient than a giant IN clause. The temporary table only exists
+        for the current connection, so it should be used with the same session, and is dropped when the connection is closed.
+
+        :param ids: An iterable of gene or genome IDs. Duplicates and empty strings are ignored. 
+        :param chunk_size: The number of IDs to insert in each statement. 
+        :return: The temporary table, which has a single id column. 
+        '''
+        table = sqlalchemy.Table('lookup', sqlalchemy.MetaData(), sqlalchemy.Column('id', sqlalchemy.String(GENE_ID_LENGTH), primary_key=True), prefixes=['TEMPORARY'])
+        # SQLite (which the tests use as a stand-in for MariaDB) keeps temporary tables in a separate schema, and has no DROP TEMPORARY TABLE. 
+        self.session.execute(text('DROP TABLE IF EXISTS temp.lookup' if (self.engine.dialect.name == 'sqlite') else 'DROP TEMPORARY TABLE IF EXISTS lookup'))
+        table.create(bind=self.session.connection())
+
+        stmt = insert(table).prefix_with('IGNORE', dialect=Database.dialect).prefix_with('OR IGNORE', dialect='sqlite') # Skip duplicate IDs. 
+        chunk = []
+        for id_ in ids:
+            id_ = id_.strip()
+            if len(id_) > 0:
+                chunk.append({'id':id_})
+            if len(chunk) == chunk_size:
+                self.session.execute(stmt, chunk)
+                chunk = []
+        if len(chunk) > 0:
+            self.session.execute(stmt, chunk)
+        # NOTE: Don't commit here, as ending the transaction could return the connection (and the temporary table) to the pool.
+        return table
+
+    def build_summary(self, table_name:str, annotations_table_name:str, metadata_table_name:str, field:str) -> NoReturn:
+        '''Populate a summary table with the number of genomes, genes, and annotations for each annotation and taxon, at every 
+        taxonomic rank. Any existing rows are deleted first. The counts are computed in the database using INSERT ... SELECT, 
+        so nothing needs to be loaded into memory.
+
+        :param table_name: The name of the summary table to populate. 
+        :param annotations_table_name: The name of the annotations table to summarize. 
+        :param metadata_table_name: The name of the metadata table containing the taxonomy for each genome. 
+        :param field: The annotation field being summarized, i.e. ko or pfam.
+        '''
+        table = self.get_table(table_name)
+        annotations_table = self.get_table(annotations_table_name)
+        metadata_table = self.get_table(metadata_table_name)
+        # The annotations are dictionary-encoded, so the values need to be read from the vocabulary table. 
+        vocabulary, id_field = VOCABULARIES[field]
+        vocabulary_table = self.get_table(f'vocabulary_{vocabulary}_r{annotations_table_name.split("_r")[-1]}')
+
+        self.session.execute(delete(table))
+        columns = [field, 'rank', 'taxon', 'version', 'n_genomes', 'n_genes', 'n_annotations']
+        for rank in RANKS:
+            taxon = func.coalesce(getattr(metadata_table, rank), 'none') # Genomes with a missing rank are counted under 'none'.
+            stmt = select(getattr(vocabulary_table, field), literal(rank), taxon, func.min(annotations_table.version), 
+                func.count(annotations_table.genome_id.distinct()), func.count(annotations_table.gene_id.distinct()), func.count())
+            stmt = stmt.select_from(annotations_table).join(metadata_table, annotations_table.genome_id == metadata_table.genome_id)
+            stmt = stmt.join(vocabulary_table, getattr(annotations_table, id_field) == getattr(vocabulary_table, id_field))
+            stmt = stmt.group_by(getattr(vocabulary_table, field), taxon)
+            self.session.execute(insert(table).from_select(columns, stmt))
             self.session.commit()
 
+    def build_boundaries(self, table_name:str, metadata_table_name:str, n_ranges:int=64) -> NoReturn:
+        '''Populate a boundaries table with the genome IDs which split the genomes (in sorted order) into ranges containing roughly the 
+        same number of proteins, using the protein counts in the metadata table. Any existing rows are deleted first.
+
+        :param table_name: The name of the boundaries table to populate. 
+        :param metadata_table_name: The name of the metadata table. 
+        :param n_ranges: The number of ranges to split the genomes into. 
+        '''
+        metadata_table = self.get_table(metadata_table_name)
+        stmt = select(metadata_table.genome_id, metadata_table.protein_count).order_by(metadata_table.genome_id)
+        data = pd.DataFrame(self.session.execute(stmt).all(), columns=['genome_id', 'protein_count'])
+
+        # The first genome in each range is the one where the running total of proteins passes the next quantile. 
+        totals = data.protein_count.fillna(0).cumsum().values
+        idxs = np.searchsorted(totals, totals[-1] * np.arange(1, n_ranges) / n_ranges, side='right')
+        boundaries = np.unique(data.genome_id.values[np.minimum(idxs, len(data) - 1)])
+
+        version = table_name.split('_r')[-1]
+        self.session.execute(delete(self.get_table(table_name)))
+        self.bulk_upload(table_name, [{'boundary_id':i, 'version':int(version), 'genome_id':genome_id} for i, genome_id in enumerate(boundaries)])
+
+    def get_boundaries(self, table_name:str) -> List[str]:
+        '''Get the sorted genome IDs stored in a boundaries table.'''
+        table = self.get_table(table_name)
+        return list(self.session.execute(select(table.genome_id).order_by(table.genome_id)).scalars().all())
+
     def reflect(self):
         # Reflected.prepare(self.engine)
         for table in Database.tables:
@@ -96,7 +296,24 @@ class Database():
     def close(self):
         self.session.close()
         # See https://stackoverflow.com/questions/8645250/how-to-close-sqlalchemy-connection-in-mysql. 
-        self.engine.dispose()
+        if not self.shared_engine:
+            self.engine.dispose()
+
+    def set_max_statement_time(self, max_statement_time:float, session:sqlalchemy.orm.Session=None):
+        '''Set the maximum time (in seconds) any statement executed in the current session (or the specified session) can run 
+        before it is aborted by MariaDB.'''
+        session = self.session if (session is None) else session
+        session.execute(text('SET SESSION max_statement_time = :max_statement_time'), {'max_statement_time':max_statement_time})
+
+    async def async_set_max_statement_time(self, max_statement_time:float, session:AsyncSession):
+        '''Async version of Database.set_max_statement_time.'''
+        await session.execute(text('SET SESSION max_statement_time = :max_statement_time'), {'max_statement_time':max_statement_time})
+
+    def get_table_rows(self, table_name:str) -> int:
+        '''Get the approximate number of rows in a table from the table statistics, without counting them.'''
+        stmt = text('SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name')
+        result = self.session.execute(stmt, {'table_name':table_name}).scalar()
+        return 0 if (result is None) else int(result)
 
     def explain(self, query):
         sql = str(query)
@@ -104,3 +321,7 @@ class Database():
         result = [row._asdict() for row in result]
         return pd.DataFrame(result)
 
+    async def async_explain(self, query, session:AsyncSession):
+        '''Async version of Database.explain.'''
+        result = await session.execute(text(f'EXPLAIN {str(query)}'))
+        return pd.DataFrame([row._asdict() for row in result])
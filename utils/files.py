@@ -9,6 +9,13 @@ import gzip
 
 # NOTE: Donnie mentioned that pre-compiling regex expressions might speed things up quite a bit. 
 
+# Average masses (in Daltons) of each amino acid residue, i.e. of the amino acid minus a water molecule, which is lost when the peptide
+# bond forms. The mass of a protein is the sum of the residue masses plus the mass of one water molecule. 
+RESIDUE_MASSES = {'A':71.0788, 'R':156.1875, 'N':114.1038, 'D':115.0886, 'C':103.1388, 'E':129.1155, 'Q':128.1307, 'G':57.0519, 
+    'H':137.1411, 'I':113.1594, 'L':113.1594, 'K':128.1741, 'M':131.1926, 'F':147.1766, 'P':97.1167, 'S':87.0782, 'T':101.1051, 
+    'W':186.2132, 'Y':163.1760, 'V':99.1326, 'X':110.0, 'U':150.0388, 'B':114.5962, 'Z':128.6231, 'J':113.1594}
+WATER_MASS = 18.01528
+
 def compressed(path:str):
     file_name = os.path.basename(path)
     ext = file_name.split('.')[-1]
@@ -169,6 +176,27 @@ class ProteinsFile(File):
     def get_stop_codons(seqs:List[str]) -> List[str]:
         return [seq[-3:] for seq in seqs]
 
+    @staticmethod
+    def get_composition(seqs:List[str]) -> Dict[str, np.ndarray]:
+        '''Compute the length, cysteine count, and molecular weight of each amino acid sequence. The sequences are concatenated into a 
+        single array, so the counts for every sequence are computed at once with bincount. The trailing stop (*) added by Prodigal is not 
+        counted as a residue, and any other character without a known mass (e.g. O, for pyrrolysine) is given the mass of an unknown residue (X).'''
+        n = len(seqs)
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        residues = np.frombuffer(''.join(seqs).upper().encode('ascii'), dtype=np.uint8)
+        idxs = np.repeat(np.arange(n), lengths) # The index of the sequence each residue belongs to. 
+
+        masses = np.full(256, RESIDUE_MASSES['X'])
+        masses[ord('*')] = 0
+        for aa, mass in RESIDUE_MASSES.items():
+            masses[ord(aa)] = mass
+
+        composition = dict()
+        composition['seq_length'] = lengths - np.bincount(idxs[residues == ord('*')], minlength=n)
+        composition['cysteine_count'] = np.bincount(idxs[residues == ord('C')], minlength=n)
+        composition['molecular_weight'] = np.bincount(idxs, weights=masses[residues], minlength=n) + np.where(composition['seq_length'] > 0, WATER_MASS, 0)
+        return composition
+
     def size(self):
         # Avoid re-computing the number of entries each time. 
         return len(self.headers)
@@ -179,6 +207,8 @@ class ProteinsFile(File):
 
         if (self.type_ == 'aa'):
             df['seq'] = self.seqs
+            for field, values in ProteinsFile.get_composition(self.seqs).items():
+                df[field] = values
         if (self.type_ == 'nt'):
             df['stop_codon'] = self.stop_codons 
             df['start_codon'] = self.start_codons
@@ -216,7 +246,7 @@ class MetadataFile(File):
     @staticmethod
     def parse_taxonomy(taxonomy:str) -> pd.DataFrame:
         '''Takes a taxonomy string as input, and parses it into a dictionary mapping the new column names to the values.'''
-        map_ = {'o':'gtdb_order', 'd':'gtdb_domain', 'p':'gtdb_phylum', 'c':'gtdb_class', 'f':'', 'g':'gtdb_genus', 's':'gtdb_species'}
+        map_ = {'o':'gtdb_order', 'd':'gtdb_domain', 'p':'gtdb_phylum', 'c':'gtdb_class', 'f':'gtdb_family', 'g':'gtdb_genus', 's':'gtdb_species'}
         parsed = {t:'none' for t in map_.values()}
         if taxonomy == 'none': # This is an edge case. Just fill in all none values if this happens. 
             rows.append(new_row)
@@ -0,0 +1,184 @@
+'''Functions for writing the results of a Find-A-Bug query in the output formats supported by the API. Each writer consumes chunks
+of rows (lists of dictionaries, as yielded by Query.stream) and yields the encoded output piece-by-piece, so that the full result
+never needs to be held in memory.'''
+import io
+import zlib
+import json
+import math
+import pandas as pd
+import numpy as np
+from typing import Dict, List, Generator, Iterable
+from sqlalchemy import ColumnElement
+
+# pyarrow is only needed for the Parquet and Arrow IPC formats, so don't require it to run the rest of the app.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+
+# Map each supported format to the MIME type used for the Content-Type header and content negotiation.
+content_types = {'csv':'text/plain',
+    'csv.gz':'application/gzip',
+    'jsonl':'application/x-ndjson',
+    'parquet':'application/vnd.apache.parquet',
+    'arrow':'application/vnd.apache.arrow.stream',
+    'fasta':'text/x-fasta'}
+
+# Alternative MIME types which clients might reasonably put in an Accept header.
+aliases = {'text/csv':'csv',
+    'application/x-gzip':'csv.gz',
+    'application/jsonl':'jsonl',
+    'application/x-parquet':'parquet',
+    'application/vnd.apache.arrow.file':'arrow',
+    'text/fasta':'fasta'}
+
+# The Arrow type used for the columns with each Python type (see get_schema). 
+arrow_types = dict() if (pa is None) else {float:pa.float64(), int:pa.int64(), str:pa.string(), bool:pa.bool_()}
+
+
+def get_format(accept:str=None, format_:str=None) -> str:
+    '''Determine the output format for a request, either from an explicitly-specified format or from the Accept header.
+    Explicitly-specified formats take priority. If no supported format is found, defaults to CSV.
+
+    :param accept: The value of the Accept header sent with the request.
+    :param format_: The format name specified in the URL, e.g. the "parquet" in [format]parquet.
+    :return: The name of the output format.
+    '''
+    if format_ is not None:
+        if format_ not in content_types:
+            raise ValueError(f"get_format: Format {format_} is not supported. Supported formats are {', '.join(content_types.keys())}.")
+        return format_
+
+    if accept is not None:
+        for mime_type in accept.split(','):
+            mime_type = mime_type.split(';')[0].strip() # Remove any quality values, e.g. ;q=0.9
+            for format_, content_type in content_types.items():
+                if mime_type == content_type:
+                    return format_
+            if mime_type in aliases:
+                return aliases[mime_type]
+    return 'csv'
+
+
+def write_csv(chunks:Iterable[List[Dict]]) -> Generator[str, None, None]:
+    '''Write the chunks as CSV text, matching the output of DataFrame.to_csv for the full result. The index is kept
+    continuous across chunks, and the header is only written once.'''
+    offset = 0
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        df = pd.DataFrame.from_records(chunk)
+        df.index = np.arange(offset, offset + len(df))
+        yield df.to_csv(header=(offset == 0))
+        offset += len(df)
+
+
+def write_csv_gz(chunks:Iterable[List[Dict]]) -> Generator[bytes, None, None]:
+    '''Write the chunks as gzip-compressed CSV text.'''
+    # The wbits value tells zlib to include the gzip header and trailer, so the output can be read by gzip.open.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for text in write_csv(chunks):
+        data = compressor.compress(text.encode())
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
+
+
+def write_jsonl(chunks:Iterable[List[Dict]]) -> Generator[str, None, None]:
+    '''Write the chunks as newline-delimited JSON, with one object per row.'''
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        # default=str handles any non-serializable types, e.g. Decimal values returned by the database driver. NaN and infinity 
+        # aren't valid JSON, so they are written as null.
+        yield ''.join([json.dumps({field:(None if (isinstance(value, float) and not math.isfinite(value)) else value) for field, value in row.items()}, default=str, allow_nan=False) + '\n' for row in chunk])
+
+
+def check_pyarrow(format_:str):
+    if pa is None:
+        raise ImportError(f'check_pyarrow: The pyarrow package is required for output format {format_}.')
+
+
+def get_schema(chunk:List[Dict], columns:Iterable[ColumnElement]=None):
+    '''Get the Arrow schema for the results. The type of each field is taken from the SQL type of the selected column with the same
+    name, as a field which is NULL in every row of the first chunk would otherwise be given the null type, and the later chunks 
+    couldn't be written. The types of any other fields are inferred from the first chunk.'''
+    types = dict()
+    for col in ([] if (columns is None) else columns):
+        try:
+            types[col.name] = arrow_types.get(col.type.python_type, None)
+        except NotImplementedError: # Some types, e.g. NullType, don't have a Python type. 
+            continue
+    schema = pa.Table.from_pylist(chunk).schema
+    return pa.schema([(field.name, field.type if (types.get(field.name, None) is None) else types[field.name]) for field in schema])
+
+
+def write_arrow(chunks:Iterable[List[Dict]], parquet:bool=False, columns:Iterable[ColumnElement]=None) -> Generator[bytes, None, None]:
+    '''Write the chunks as an Arrow IPC stream (or a Parquet file, if specified). Each chunk becomes a record batch (or a row group).
+    The schema is built from the first non-empty chunk (see get_schema), and nothing is written if there are no results.
+
+    :param chunks: The chunks of rows to write.
+    :param columns: The columns selected by the query, whose SQL types are used for the schema.
+    '''
+    check_pyarrow('parquet' if parquet else 'arrow')
+
+    buffer = io.BytesIO()
+    writer, schema = None, None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if schema is None:
+            schema = get_schema(chunk, columns=columns)
+            writer = pq.ParquetWriter(buffer, schema) if parquet else pa.ipc.new_stream(buffer, schema)
+        writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+        # Empty the buffer after each chunk is written, so that memory usage is bounded by the chunk size.
+        if buffer.tell() > 0:
+            yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if writer is not None:
+        writer.close() # Writes the Parquet footer or the end-of-stream marker.
+        yield buffer.getvalue()
+
+
+def write_fasta(chunks:Iterable[List[Dict]], fields:List[str]=None, width:int=80) -> Generator[str, None, None]:
+    '''Write the chunks as a FASTA file, using the gene ID as the header and wrapping the sequences. The rows must
+    have a seq field, so this only works for queries on the proteins tables.
+
+    :param chunks: The chunks of rows to write.
+    :param fields: Additional fields to include in the header, written as space-separated field=value pairs after the gene ID.
+    :param width: The maximum length of each sequence line.
+    '''
+    fields = [] if fields is None else fields
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if 'seq' not in chunk[0]:
+            raise ValueError('write_fasta: The query results do not contain sequences, so cannot be written in FASTA format.')
+        records = []
+        for row in chunk:
+            header = ' '.join(['>' + row['gene_id']] + [f'{field}={row.get(field)}' for field in fields])
+            seq = '\n'.join([row['seq'][i:i + width] for i in range(0, len(row['seq']), width)])
+            records.append(header + '\n' + seq + '\n')
+        yield ''.join(records)
+
+
+def write(chunks:Iterable[List[Dict]], format_:str='csv', fields:List[str]=None, columns:Iterable[ColumnElement]=None) -> Generator:
+    '''Write the chunks in the specified format. The fields are only used for the FASTA format, and the columns selected by the 
+    query are only used for the Parquet and Arrow formats.'''
+    if format_ == 'csv':
+        return write_csv(chunks)
+    elif format_ == 'csv.gz':
+        return write_csv_gz(chunks)
+    elif format_ == 'jsonl':
+        return write_jsonl(chunks)
+    elif format_ == 'parquet':
+        return write_arrow(chunks, parquet=True, columns=columns)
+    elif format_ == 'arrow':
+        return write_arrow(chunks, parquet=False, columns=columns)
+    elif format_ == 'fasta':
+        return write_fasta(chunks, fields=fields)
+    raise ValueError(f'write: Format {format_} is not supported.')
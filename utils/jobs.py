@@ -0,0 +1,158 @@
+'''Classes for running export jobs in the background. Downloading a large result set one page at a time means hundreds of requests, each
+of which re-runs the query. Instead, a client can submit an export job, which runs the query once (using a server-side cursor) and writes
+the results to a file, and then poll for the job's status and download the file when it is finished. The number of jobs running at once,
+and the number waiting to run, are limited so that exports can't starve the regular queries.'''
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Callable, Iterable, Union
+
+
+class JobQueueFullError(Exception):
+    '''Raised when a job is submitted while the maximum number of jobs are already queued or running.'''
+    pass
+
+
+class Job():
+
+    def __init__(self, job_id:str, path:str):
+
+        self.job_id = job_id
+        self.path = path # Where the output is written.
+        self.status = 'queued' # One of queued, running, done, or failed.
+        self.error = None
+        self.size = 0 # The number of bytes written so far.
+        self.submitted = time.time()
+        self.finished = None
+
+    def to_dict(self) -> Dict:
+        return {'job_id':self.job_id, 'status':self.status, 'error':self.error, 'size':self.size, 'submitted':self.submitted, 'finished':self.finished}
+
+    @staticmethod
+    def from_dict(data:Dict, path:str):
+        '''Rebuild a Job from the output of Job.to_dict.'''
+        job = Job(data['job_id'], path)
+        job.status, job.error, job.size, job.submitted, job.finished = data['status'], data['error'], data['size'], data['submitted'], data['finished']
+        return job
+
+
+# NOTE: When the app is served by several worker processes, a client's requests to poll a job can go to any of them, so the state of each
+# job is also written to a JSON file next to its output, and read back by the workers which didn't run the job. The limit on the number of
+# jobs only applies to the jobs submitted to each worker. 
+
+class JobQueue():
+
+    # The job IDs are UUIDs (see JobQueue.submit), and anything else is rejected before it is used to build a path. 
+    job_id_pattern = re.compile(r'[0-9a-f]{32}')
+
+    def __init__(self, output_dir:str, max_workers:int=2, max_jobs:int=20, max_age:float=24 * 60 * 60):
+        '''
+        :param output_dir: The directory where the output files are written.
+        :param max_workers: The maximum number of jobs which can run at the same time.
+        :param max_jobs: The maximum number of jobs which can be queued or running. Submitting more raises a JobQueueFullError.
+        :param max_age: The number of seconds a finished job (and its output file) is kept before it is removed.
+        '''
+        self.output_dir = output_dir
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.jobs:Dict[str, Job] = dict()
+        self.lock = threading.Lock()
+
+    def submit(self, task:Callable[[], Iterable[Union[str, bytes]]], extension:str) -> Job:
+        '''Submit a job to the queue.
+
+        :param task: A function which returns the output of the job piece-by-piece, e.g. the output of one of the writers in utils/formats.py.
+        :param extension: The file extension for the output file, e.g. parquet.
+        :return: The Job, which can be used to check the status.
+        '''
+        with self.lock:
+            self.cleanup()
+            n_active = len([job for job in self.jobs.values() if job.status in ['queued', 'running']])
+            if n_active >= self.max_jobs:
+                raise JobQueueFullError(f'JobQueue.submit: There are already {n_active} export jobs queued or running. Try again later.')
+            job_id = uuid.uuid4().hex
+            job = Job(job_id, os.path.join(self.output_dir, f'{job_id}.{extension}'))
+            self.save(job)
+            self.jobs[job_id] = job
+        self.pool.submit(self.run, job, task)
+        return job
+
+    def run(self, job:Job, task:Callable[[], Iterable[Union[str, bytes]]]):
+        '''Run a job, writing its output to a temporary file which is renamed once the job is finished, so that partial output
+        is never downloaded. The state of the job is saved whenever its status changes, and at most once a second while it is running.'''
+        job.status = 'running'
+        try:
+            self.save(job)
+            saved = time.time()
+            with open(job.path + '.tmp', 'wb') as f:
+                for data in task():
+                    data = data.encode() if isinstance(data, str) else data
+                    f.write(data)
+                    job.size += len(data)
+                    if time.time() - saved > 1:
+                        self.save(job)
+                        saved = time.time()
+            os.rename(job.path + '.tmp', job.path)
+            # The finish time is set first, so a job is never seen as done without one. 
+            job.finished = time.time()
+            job.status = 'done'
+        except Exception:
+            job.error = traceback.format_exc()
+            job.finished = time.time()
+            job.status = 'failed'
+            if os.path.exists(job.path + '.tmp'):
+                os.remove(job.path + '.tmp')
+        try:
+            self.save(job)
+        except OSError: # The job is still available from this process. 
+            pass
+
+    def get_state_path(self, job_id:str) -> str:
+        return os.path.join(self.output_dir, f'{job_id}.json')
+
+    def save(self, job:Job):
+        '''Write the state of a job next to its output. The state is written to a temporary file which is then renamed, so that a
+        partially-written state is never read.'''
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = self.get_state_path(job.job_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({**job.to_dict(), 'path':job.path}, f)
+        os.replace(path + '.tmp', path)
+
+    def load(self, job_id:str) -> Job:
+        '''Read the state of a job, which might have been submitted to another process. Returns None if there is no saved state.'''
+        try:
+            with open(self.get_state_path(job_id), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return Job.from_dict(data, data['path'])
+
+    def get(self, job_id:str) -> Job:
+        '''Get a job using its ID. Jobs which were submitted to another process are read from disk. Returns None if there is no job 
+        with the ID (or if it has expired).'''
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        return self.load(job_id) if (JobQueue.job_id_pattern.fullmatch(job_id) is not None) else None
+
+    def cleanup(self):
+        '''Remove any finished jobs which are older than the maximum age, including those submitted to other processes, and delete their 
+        output files.'''
+        job_ids = set(self.jobs.keys())
+        if os.path.isdir(self.output_dir):
+            job_ids.update([file_name[:-len('.json')] for file_name in os.listdir(self.output_dir) if file_name.endswith('.json')])
+        for job_id in job_ids:
+            job = self.get(job_id)
+            if (job is not None) and (job.finished is not None) and (time.time() - job.finished > self.max_age):
+                for path in [job.path, self.get_state_path(job_id)]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError: # Another process might have removed it first. 
+                        pass
+                self.jobs.pop(job_id, None)
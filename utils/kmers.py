@@ -0,0 +1,120 @@
+'''Class for managing the k-mer index over the protein sequences, which makes it possible to find the proteins containing a peptide or a
+simple motif without scanning every sequence. Each k-mer of amino acids is encoded as an integer, and the index stores the sorted list of
+proteins containing each k-mer (a posting list). A peptide can only occur in a protein which contains all of its k-mers, so intersecting
+their posting lists gives a short list of candidates, which are then checked against the sequences themselves.'''
+import os
+import re
+import json
+import numpy as np
+from typing import List, Iterable, Tuple, Generator
+
+# NOTE: The index is split into shards of a fixed number of proteins, each stored as a set of .npy files which are memory-mapped when the
+# index is loaded. Only the pages of the posting lists which are needed for a query are read from disk, and a shard can be built in memory.
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+class KmerIndex():
+
+    @staticmethod
+    def encode(seq:str) -> np.ndarray:
+        '''Map each residue of a sequence to its position in the amino acid alphabet. Non-standard residues (e.g. X) and stops are
+        mapped to -1, and no k-mer containing them is indexed.'''
+        lookup = np.full(256, -1, dtype=np.int64)
+        lookup[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+        return lookup[np.frombuffer(seq.upper().encode('ascii', errors='replace'), dtype=np.uint8)]
+
+    @staticmethod
+    def get_kmers(seq:str, k:int) -> np.ndarray:
+        '''Get the integer encodings of the k-mers in a sequence, in order. Any k-mers with non-standard residues are removed.'''
+        codes = KmerIndex.encode(seq)
+        if len(codes) < k:
+            return np.array([], dtype=np.int64)
+        windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+        kmers = windows @ (len(AMINO_ACIDS) ** np.arange(k - 1, -1, -1))
+        return kmers[np.all(windows >= 0, axis=1)]
+
+    @staticmethod
+    def build_shard(path:str, gene_ids:List[str], seqs:List[str], k:int):
+        '''Build a single shard of the index and write it to disk. The posting lists are stored back-to-back in a single array, and the
+        position of the posting list for each k-mer is stored in the offsets array.'''
+        n_kmers = len(AMINO_ACIDS) ** k
+        kmers = [np.unique(KmerIndex.get_kmers(seq, k)) for seq in seqs] # Each protein only needs to be listed once for each k-mer.
+        ordinals = np.repeat(np.arange(len(seqs), dtype=np.uint32), [len(kmers_) for kmers_ in kmers])
+        kmers = np.concatenate(kmers) if (len(kmers) > 0) else np.array([], dtype=np.int64)
+
+        order = np.argsort(kmers, kind='stable') # A stable sort keeps the ordinals for each k-mer in increasing order.
+        offsets = np.zeros(n_kmers + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum(np.bincount(kmers, minlength=n_kmers))
+        np.save(f'{path}_offsets.npy', offsets)
+        np.save(f'{path}_postings.npy', ordinals[order])
+        np.save(f'{path}_gene_ids.npy', np.array(gene_ids, dtype=bytes))
+
+    @staticmethod
+    def build(path:str, entries:Iterable[Tuple[str, str]], k:int=5, shard_size:int=1000000):
+        '''Build a k-mer index and write it to a directory. The entries are consumed one shard at a time, so only one shard needs to be held
+        in memory.
+
+        :param path: The directory where the index will be written.
+        :param entries: An iterable of (gene ID, amino acid sequence) tuples.
+        :param k: The length of the k-mers. Peptides shorter than this can't be searched for.
+        :param shard_size: The number of proteins in each shard.
+        '''
+        os.makedirs(path, exist_ok=True)
+        n_shards, gene_ids, seqs = 0, [], []
+        for gene_id, seq in entries:
+            gene_ids.append(gene_id)
+            seqs.append(seq)
+            if len(gene_ids) == shard_size:
+                KmerIndex.build_shard(os.path.join(path, f'shard_{n_shards}'), gene_ids, seqs, k)
+                n_shards, gene_ids, seqs = n_shards + 1, [], []
+        if len(gene_ids) > 0:
+            KmerIndex.build_shard(os.path.join(path, f'shard_{n_shards}'), gene_ids, seqs, k)
+            n_shards += 1
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'k':k, 'n_shards':n_shards}, f)
+
+    def __init__(self, path:str):
+
+        self.path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            info = json.load(f)
+        self.k = info['k']
+        self.shards = []
+        for i in range(info['n_shards']):
+            shard_path = os.path.join(path, f'shard_{i}')
+            self.shards.append(tuple(np.load(f'{shard_path}_{name}.npy', mmap_mode='r') for name in ['offsets', 'postings', 'gene_ids']))
+
+    @staticmethod
+    def get_pattern(motif:str) -> re.Pattern:
+        '''Get the regular expression for a motif, which is a peptide where x stands for any residue, e.g. CxxCH.'''
+        if re.fullmatch(f'[{AMINO_ACIDS}x]+', motif) is None:
+            raise ValueError(f'KmerIndex.get_pattern: Motif {motif} is not valid. Motifs can only contain the standard amino acids, or x for any residue.')
+        return re.compile(motif.replace('x', '.'))
+
+    def is_searchable(self, motif:str) -> bool:
+        '''Check whether a motif can be searched using the index, i.e. whether it has a stretch of at least k residues without a wildcard.'''
+        return any([len(stretch) >= self.k for stretch in motif.split('x')])
+
+    def get_motif_kmers(self, motif:str) -> np.ndarray:
+        '''Get the k-mers which every match to the motif must contain, i.e. the k-mers in each stretch of the motif without a wildcard.'''
+        KmerIndex.get_pattern(motif)
+        kmers = [KmerIndex.get_kmers(stretch, self.k) for stretch in motif.split('x') if (len(stretch) >= self.k)]
+        if not self.is_searchable(motif):
+            raise ValueError(f'KmerIndex.get_motif_kmers: Motif {motif} needs at least {self.k} residues in a row without a wildcard to be searched using the index.')
+        return np.unique(np.concatenate(kmers))
+
+    def search(self, motif:str) -> Generator[str, None, None]:
+        '''Get the gene IDs of the proteins which contain every k-mer in the motif. These are candidates, which still need to be checked
+        against the sequences, as the k-mers might not occur in the right order.'''
+        kmers = self.get_motif_kmers(motif)
+        for offsets, postings, gene_ids in self.shards:
+            # Start with the shortest posting lists, so the intersection shrinks as quickly as possible.
+            lists = sorted([postings[offsets[kmer]:offsets[kmer + 1]] for kmer in kmers], key=len)
+            candidates = np.asarray(lists[0])
+            for list_ in lists[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates = np.intersect1d(candidates, list_, assume_unique=True)
+            for gene_id in gene_ids[candidates]:
+                yield gene_id.decode()
@@ -0,0 +1,121 @@
+'''Class for caching the metadata table in memory. The metadata table only has one row per genome (tens of thousands of rows), but filtering
+one of the large tables on a metadata field (e.g. checkm_completeness[gt]90) means joining the metadata table to every row. Instead, the
+metadata filters can be evaluated against the cached table to get the matching genome IDs, and applied to the (indexed) genome_id column of
+the large table. Each GTDB release is not expected to change once it is uploaded, so a table is only read from the database once. A table
+is not cached while it is empty, and tables are removed from the cache whenever they are uploaded to or dropped (see MetadataCache.invalidate).'''
+import weakref
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from typing import Dict, List, Tuple
+
+
+class MetadataCache():
+
+    # Every cache in the process, so they can all be invalidated when a table is modified (see MetadataCache.invalidate). 
+    caches = weakref.WeakSet()
+
+    def __init__(self, max_genome_ids:int=10000):
+        '''
+        :param max_genome_ids: The maximum number of genome IDs which can be put in an IN (or NOT IN) list. If the filters match more
+            genomes than this (and exclude more genomes than this), they are applied using a join as usual.
+        '''
+        self.max_genome_ids = max_genome_ids
+        self.tables:Dict[str, pd.DataFrame] = dict()
+        MetadataCache.caches.add(self)
+
+    @staticmethod
+    def invalidate(table_name:str=None):
+        '''Remove a table from every cache in the process, so it is read from the database again the next time it is used. This is
+        called by Database.bulk_upload and Database.drop. If no table name is given, every table is removed.'''
+        for cache in list(MetadataCache.caches):
+            if table_name is None:
+                cache.tables.clear()
+            else:
+                cache.tables.pop(table_name, None)
+
+    def is_loaded(self, table) -> bool:
+        return table.__tablename__ in self.tables
+
+    def add(self, table, rows:List) -> pd.DataFrame:
+        '''Add the rows of a metadata table to the cache. The conversion of each column is chosen using its SQL type, as a column which
+        is NULL in every row can't be told apart from a string column using the values. The numeric columns are stored as floats, and the 
+        string columns are stored as categoricals, as there are few distinct values for most of them (e.g. the taxonomy), which keeps the 
+        cache small. An empty table is returned, but not cached, as it is probably still being uploaded.'''
+        data = pd.DataFrame.from_records([row._asdict() for row in rows], columns=[col.name for col in table.__table__.c])
+        for col in table.__table__.c:
+            try:
+                python_type = col.type.python_type
+            except NotImplementedError:
+                continue
+            if python_type in [int, float]:
+                data[col.name] = pd.to_numeric(data[col.name], errors='coerce').astype(float)
+            elif (python_type == str) and (col.name != 'genome_id'):
+                data[col.name] = data[col.name].astype('category')
+        # Multiple threads might load the same table at the same time, which is wasteful but harmless.
+        if len(data) > 0:
+            self.tables[table.__tablename__] = data
+        return data
+
+    def load(self, session, table) -> pd.DataFrame:
+        '''Get the cached metadata table, reading it from the database if it is not already cached.'''
+        if not self.is_loaded(table):
+            return self.add(table, session.execute(select(table.__table__)).all())
+        return self.tables[table.__tablename__]
+
+    @staticmethod
+    def to_float(value:str) -> float:
+        '''Convert the value of a filter on a numeric field, returning NaN if it isn't a number, so that it doesn't match any rows.'''
+        try:
+            return float(value)
+        except ValueError:
+            return np.nan
+
+    @staticmethod
+    def get_mask(data:pd.DataFrame, field:str, operator:str, value:str, ranges:List[Tuple[int, int]]=None) -> np.ndarray:
+        '''Evaluate a single filter against the cached metadata table, matching the behavior of the operators in Filter.
+
+        :param ranges: The taxonomy index ranges of the clade, which are needed for the [under] operator (see Filter.in_subtree).
+        '''
+        col = data[field]
+        if operator == '[eq]':
+            values = value.split('[or]')
+            if pd.api.types.is_numeric_dtype(col):
+                # NaN is removed, as isin would match it to the NULL values. 
+                return col.isin([v for v in map(MetadataCache.to_float, values) if not np.isnan(v)]).values
+            # String comparisons in MariaDB are case-insensitive under the default collation.
+            return col.astype(str).str.lower().isin([v.lower() for v in values]).values & col.notna().values
+        elif operator == '[lt]':
+            return (col < MetadataCache.to_float(value)).values
+        elif operator == '[lte]':
+            return (col <= MetadataCache.to_float(value)).values
+        elif operator == '[gt]':
+            return (col > MetadataCache.to_float(value)).values
+        elif operator == '[gte]':
+            return (col >= MetadataCache.to_float(value)).values
+        elif operator == '[in]':
+            low, high = value.split('[to]')
+            return col.between(MetadataCache.to_float(low), MetadataCache.to_float(high)).values
+        elif operator == '[under]':
+            taxonomy_index = data['taxonomy_index']
+            return np.any([taxonomy_index.between(left, right).values for left, right in ranges], axis=0) if (len(ranges) > 0) else np.zeros(len(data), dtype=bool)
+        raise ValueError(f'MetadataCache.get_mask: Operator {operator} is not supported.')
+
+    def get_genome_ids(self, data:pd.DataFrame, filters:List[Tuple[str, str, str]], ranges:Dict[str, List[Tuple[int, int]]]=dict()) -> Tuple[bool, np.ndarray]:
+        '''Get the genome IDs which match all of the filters.
+
+        :param data: The cached metadata table.
+        :param filters: A list of (field, operator, value) tuples.
+        :param ranges: The taxonomy index ranges for any [under] filters, keyed by field.
+        :return: A tuple (include, genome_ids). If include is True, the genome IDs are the ones which match the filters, otherwise they
+            are the ones which don't. Whichever list is shorter is returned. If both are longer than max_genome_ids, returns None.
+        '''
+        mask = np.ones(len(data), dtype=bool)
+        for field, operator, value in filters:
+            mask &= MetadataCache.get_mask(data, field, operator, value, ranges=ranges.get(field))
+        n_matches = mask.sum()
+        if min(n_matches, len(data) - n_matches) > self.max_genome_ids:
+            return None
+        if n_matches <= len(data) - n_matches:
+            return True, data.genome_id.values[mask]
+        return False, data.genome_id.values[~mask]
@@ -4,10 +4,20 @@ from sqlalchemy import or_, select
 from sqlalchemy.schema import Column
 from sqlalchemy.sql.expression import Select
 # from versioned import versioned_session
-from typing import Set, List, Dict, NoReturn, Tuple
+from typing import Set, List, Dict, NoReturn, Tuple, Generator
 import sqlalchemy
 from sqlalchemy.inspection import inspect
 from sqlalchemy import func
+from utils.tables import RANKS, MAX_GENE_LENGTH, get_genome_key
+import pandas as pd
+import numpy as np
+import re
+import urllib.parse
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 # Allowed operators... [eq], [gt], [gte], [lt], [lte], [to], [and]
 
@@ -20,10 +30,13 @@ from sqlalchemy import func
 
 class Filter():
 
-    operators = ['[eq]', '[gt]', '[gte]', '[lt]', '[lte]', '[in]']
+    operators = ['[eq]', '[gt]', '[gte]', '[lt]', '[lte]', '[in]', '[under]', '[match]']
     symbols = ['[to]', '[or]']
     connector = '[and]'
 
+    # The MetadataCache used to evaluate filters on metadata fields in memory (see utils/metadata.py). Set to None to disable. 
+    metadata_cache = None
+
     @classmethod
     def get_operator(cls, filter_:str):
         for operator in cls.operators:
@@ -47,13 +60,32 @@ class Filter():
 
         return filters, include
 
+    @classmethod
+    def normalize(cls, filter_string:str) -> str:
+        '''Normalize a filter string, so that equivalent filters which are written differently (e.g. with the filters in a different order,
+        or with surrounding whitespace) give the same string. Returns None if there is no filter.'''
+        if (filter_string is None) or (len(filter_string.strip()) == 0):
+            return None
+        filters, include = Filter.parse(filter_string.strip())
+        normalized = []
+        for field, (operator, value) in filters.items():
+            value = value.strip()
+            value = Filter.symbols[1].join(sorted([v.strip() for v in value.split(Filter.symbols[1])])) if (operator == '[eq]') else value
+            normalized.append(f'{field.strip()}{operator}{value}')
+        return Filter.connector.join(sorted(normalized) + sorted([field.strip() for field in include if (len(field.strip()) > 0)]))
+
 
     def __init__(self, database, table_name:str, filter_string:str):
 
         self.table_name = table_name 
         self.table = database.get_table(table_name)
+        self.database = database
+        self.version = table_name.split('_r')[-1]
         
+        self.filter_string = filter_string
         self.filters, self.include = Filter.parse(filter_string)
+        self.resolved = dict() # The results of the lookups needed to apply the filter, keyed by field.
+        self.cached_fields = []
 
         self.field_to_table_map = dict()
         for rel, _ in self.table.__mapper__.relationships.items():
@@ -65,6 +97,10 @@ class Filter():
         tables_to_join = [self.field_to_table_map.get(field) for field in list(self.filters.keys()) + self.include]
         tables_to_join = [table for table in tables_to_join if table is not None] # Should I be worried about this?
 
+        # Dictionary-encoded fields are filtered by looking up their IDs, so the vocabulary tables never need to be joined. 
+        self.vocabulary_tables = database.get_vocabulary_tables(table_name)
+        tables_to_join = [table for table in tables_to_join if table not in self.vocabulary_tables.values()]
+
         # Make sure the table itself is not included in this list. 
         self.tables_to_join = set([table for table in tables_to_join if table.__table__.name != self.table_name])
 
@@ -96,9 +132,167 @@ class Filter():
         return stmt.filter(col.between(float(low), float(high)))
 
 
-    def __call__(self, stmt):
+    def in_subtree(self, stmt:Select, col:Column=None, value:str=None):
+        '''Filter for genomes in the clade with the specified name, e.g. gtdb_order[under]Methanobacteriales. The clade is looked up in the 
+        taxonomy table, and the filter is applied as a range on the (indexed) taxonomy_index of the metadata table, which works the same way
+        at any rank.'''
+        if col.name not in RANKS:
+            raise ValueError(f'Filter.in_subtree: The [under] operator can only be used with taxonomic ranks, not {col.name}.')
+        ranges = self.execute(col.name, self.get_ranges_stmt(col, value))
+        # The same name might occur in multiple places in the taxonomy (e.g. 'none'), in which case there are multiple ranges. 
+        taxonomy_index = col.class_.taxonomy_index
+        return stmt.filter(or_(sqlalchemy.false(), *[taxonomy_index.between(left, right) for left, right in ranges]))
+
+    def match(self, stmt:Select, col:Column=None, value:str=None):
+        '''Filter for rows where a text field contains all of the keywords, e.g. interpro_description[match]ferredoxin. The search uses
+        the FULLTEXT index on the column in boolean mode, so it is fast and a keyword ending in * matches any word with that prefix.'''
+        indices = [index for index in col.class_.__table__.indexes if (index.dialect_options['mariadb']['prefix'] == 'FULLTEXT')]
+        if not any([col.name in [c.name for c in index.columns] for index in indices]):
+            raise ValueError(f'Filter.match: The [match] operator can only be used with fields which have a FULLTEXT index, not {col.name}.')
+        # Remove any boolean operators from the keywords (which are separated by encoded spaces in the URL), except for a trailing *, and 
+        # require every keyword. 
+        keywords = [re.sub(r'\W', '', keyword) + ('*' if keyword.endswith('*') else '') for keyword in urllib.parse.unquote_plus(value).split()]
+        keywords = [keyword for keyword in keywords if (len(keyword.strip('*')) > 0)]
+        if len(keywords) == 0: # An empty search would match nothing, rather than everything. 
+            raise ValueError(f'Filter.match: The value {value} does not contain any keywords to search for.')
+        return stmt.filter(col.match(' '.join([f'+{keyword}' for keyword in keywords])))
+
+    def shape(self) -> List[Tuple[str, str, str]]:
+        '''Get the "shape" of the filter, i.e. the table, column, and operator of each filter without the values. This is what determines
+        which indices can be used to execute the query, so it is recorded in the query log (see utils/advisor.py).'''
+        shape = []
+        if len(self.cached_fields) > 0: # These are applied as a list of genome IDs. 
+            shape.append((self.table_name, 'genome_id', '[eq]'))
+        for field, (operator, _) in self.filters.items():
+            col = self.get_column(field)
+            if field in self.cached_fields:
+                continue
+            elif col.class_ in self.vocabulary_tables.values(): # These are applied to the ID column of the table being queried. 
+                shape.append((self.table_name, inspect(col.class_).primary_key[0].name, operator))
+            elif operator == '[under]': # This is applied as a range on the taxonomy index. 
+                shape.append((col.class_.__tablename__, 'taxonomy_index', '[in]'))
+            else:
+                shape.append((col.class_.__tablename__, col.name, operator))
+        return shape
+
+    def get_metadata_filters(self) -> List[Tuple[str, str, str]]:
+        '''Get the filters which can be evaluated using the metadata cache, i.e. the filters on metadata fields when another table with a
+        genome ID is being queried.
+
+        :return: A list of (field, operator, value) tuples.
+        '''
+        if (Filter.metadata_cache is None) or ('genome_id' not in self.table.__table__.c) or (self.table_name.startswith('metadata')):
+            return []
+        metadata_table = self.database.get_table(f'metadata_r{self.version}')
+        filters = [(field, operator, value) for field, (operator, value) in self.filters.items() if (self.field_to_table_map.get(field) == metadata_table)]
+        # Leave any invalid [under] filters to Filter.in_subtree and any [match] filters to Filter.match, which raise an error.
+        return [(field, operator, value) for field, operator, value in filters if ((operator != '[under]') or (field in RANKS)) and (operator != '[match]')]
+
+    def get_genome_ids(self, filters:List[Tuple[str, str, str]]):
+        '''Evaluate the metadata filters against the metadata cache. See MetadataCache.get_genome_ids for the return value.'''
+        metadata_table = self.database.get_table(f'metadata_r{self.version}')
+        data = self.resolved.get(metadata_table.__tablename__, None) # Read ahead of time by Filter.resolve if it wasn't cached. 
+        data = Filter.metadata_cache.load(self.database.session, metadata_table) if (data is None) else data
+        if len(data) == 0: # The table is still being uploaded, so use the join to get the latest data. 
+            return None
+        ranges = {field:self.execute(field, self.get_ranges_stmt(self.get_column(field), value)) for field, operator, value in filters if (operator == '[under]')}
+        return Filter.metadata_cache.get_genome_ids(data, filters, ranges=ranges)
+
+    def prune(self, stmt:Select):
+        '''If the table is hash-partitioned, add a filter on the genome key for any genome IDs in the filter, so that MariaDB only reads 
+        the partitions which contain them. Range-partitioned tables are pruned using the filter on the genome ID directly.'''
+        partitioning = getattr(self.table, 'partitioning', None)
+        if (partitioning is None) or (partitioning.field != 'genome_key') or ('genome_id' not in self.filters):
+            return stmt
+        operator, value = self.filters['genome_id']
+        if operator != '[eq]':
+            return stmt
+        return stmt.filter(self.table.genome_key.in_([get_genome_key(genome_id) for genome_id in value.split('[or]')]))
+
+    def lookup_ids(self, stmt:Select, col:Column=None, operator:str=None, value:str=None):
+        '''Filter on a dictionary-encoded field, e.g. ko[eq]K00001. The filter is applied to the vocabulary table to get the 
+        matching IDs, and the statement is filtered on the (indexed) ID column of the table being queried.'''
+        id_col = inspect(col.class_).primary_key[0]
+        ids = [row[0] for row in self.execute(col.name, self.get_ids_stmt(col, operator, value))]
+        return stmt.filter(getattr(self.table, id_col.name).in_(ids))
+
+    def get_ranges_stmt(self, col:Column, value:str) -> Select:
+        '''Build the statement which looks up the taxonomy index ranges of the clade with the specified name.'''
+        taxonomy_table = self.database.get_table(f'taxonomy_r{self.version}')
+        return select(taxonomy_table.left_index, taxonomy_table.right_index).where(taxonomy_table.rank == col.name, taxonomy_table.name == value)
+
+    def get_ids_stmt(self, col:Column, operator:str, value:str) -> Select:
+        '''Build the statement which looks up the IDs of the values matching a filter on a dictionary-encoded field.'''
+        return self.apply(select(inspect(col.class_).primary_key[0]), col, operator, value)
+
+    def get_lookups(self) -> Dict[str, Select]:
+        '''Get the statements which need to be executed before the filter can be applied (the ID lookups for dictionary-encoded fields,
+        and the clade lookups for [under]), keyed by field.'''
+        lookups = dict()
+        for field, (operator, value) in self.filters.items():
+            col = self.get_column(field)
+            if col.class_ in self.vocabulary_tables.values():
+                lookups[col.name] = self.get_ids_stmt(col, operator, value)
+            elif (operator == '[under]') and (col.name in RANKS):
+                lookups[col.name] = self.get_ranges_stmt(col, value)
+        return lookups
+
+    def execute(self, field:str, stmt:Select) -> List:
+        '''Execute the lookup statement for a field, unless its result has already been resolved (see Filter.resolve).'''
+        if field not in self.resolved:
+            self.resolved[field] = self.database.session.execute(stmt).all()
+        return self.resolved[field]
+
+    async def resolve(self, session):
+        '''Execute the lookup statements using an async session ahead of time, so applying the filter doesn't block the event loop.'''
+        for field, stmt in self.get_lookups().items():
+            self.resolved[field] = (await session.execute(stmt)).all()
+        if len(self.get_metadata_filters()) > 0:
+            metadata_table = self.database.get_table(f'metadata_r{self.version}')
+            if not Filter.metadata_cache.is_loaded(metadata_table):
+                # The table is kept with the other lookups, as it isn't cached if it's empty. 
+                self.resolved[metadata_table.__tablename__] = Filter.metadata_cache.add(metadata_table, (await session.execute(select(metadata_table.__table__))).all())
+
+    def apply(self, stmt:Select, col:Column, operator:str, value:str):
+        '''Apply a single filter to a SELECT statement.'''
+        if operator == '[lt]':
+            return self.less_than(stmt, col, value)
+        elif operator == '[gt]':
+            return self.greater_than(stmt, col, value)
+        elif operator == '[gte]':
+            return self.greater_than_or_equal_to(stmt, col, value)
+        elif operator == '[lte]':
+            return self.less_than_or_equal_to(stmt, col, value)
+        elif operator == '[eq]':
+            return self.equal_to(stmt, col, value)
+        elif operator == '[in]':
+            return self.in_range(stmt, col, value)
+        elif operator == '[under]':
+            return self.in_subtree(stmt, col, value)
+        elif operator == '[match]':
+            return self.match(stmt, col, value)
+        return stmt
+
+    def __call__(self, stmt, add_columns:bool=True):
+        '''Apply the filters to a SELECT statement, joining any related tables which are needed. 
         
-        for relationship in self.tables_to_join:
+        :param stmt: The statement to filter.
+        :param add_columns: Whether or not to add the filtered and included fields to the selected columns. This should be
+            False when the statement is an aggregate, e.g. a sum. 
+        '''
+        filters, tables_to_join = self.filters, self.tables_to_join
+        self.cached_fields = [] # The fields whose filters were evaluated using the metadata cache. 
+        metadata_filters = self.get_metadata_filters()
+        genome_ids = self.get_genome_ids(metadata_filters) if (len(metadata_filters) > 0) else None
+        if genome_ids is not None:
+            self.cached_fields = [field for field, _, _ in metadata_filters]
+            filters = {field:filter_ for field, filter_ in self.filters.items() if (field not in self.cached_fields)}
+            metadata_table = self.database.get_table(f'metadata_r{self.version}')
+            # The metadata table only needs to be joined if any of its columns are being returned. 
+            if (not add_columns) or all([self.field_to_table_map.get(field) != metadata_table for field in self.include + list(self.filters.keys())]):
+                tables_to_join = [table for table in tables_to_join if (table != metadata_table)]
+
+        for relationship in tables_to_join:
             # TODO: Should probably have a failure condition here if a relationship is not found. 
             if relationship is not None:
                 # TODO: Figure out a better way to handle this...
@@ -107,26 +301,26 @@ class Filter():
             # I don't think we can use joinedload with a many-to-one relationship and get the behavior I want. 
             # stmt = stmt.option(sqlalchemy.orm.joinedload(getattr(table, relationship)))
 
-        for field, (operator, value) in self.filters.items():
+        stmt = self.prune(stmt)
+        if genome_ids is not None:
+            include, genome_ids = genome_ids
+            stmt = stmt.filter(self.table.genome_id.in_(genome_ids) if include else self.table.genome_id.not_in(genome_ids))
+        for field, (operator, value) in filters.items():
             col = self.get_column(field)
-
-            if operator == '[lt]':
-                stmt = self.less_than(stmt, col, value)
-            elif operator == '[gt]':
-                stmt = self.greater_than(stmt, col, value)
-            elif operator == '[gte]':
-                stmt = self.greater_than_or_equal_to(stmt, col, value)
-            elif operator == '[lte]':
-                stmt = self.less_than_or_equal_to(stmt, col, value)
-            elif operator == '[eq]':
-                stmt = self.equal_to(stmt, col, value)
-            elif operator == '[in]':
-                stmt = self.in_range(stmt, col, value)
+            if col.class_ in self.vocabulary_tables.values():
+                stmt = self.lookup_ids(stmt, col, operator, value)
+            else:
+                stmt = self.apply(stmt, col, operator, value)
         
+        if not add_columns:
+            return stmt
+
         # Add all relevant columns to the return statement.
         selected_columns = [col.name for col in stmt.selected_columns]
         for field in self.include + list(self.filters.keys()):
             col = self.get_column(field)
+            if col.class_ in self.vocabulary_tables.values(): # These are already decoded by Query.get_stmt. 
+                continue
             if col.name not in selected_columns:
                 stmt = stmt.add_columns(col)
 
@@ -134,15 +328,54 @@ class Filter():
 
 
 
+class QueryCostError(Exception):
+    '''Raised when the estimated cost of a query exceeds the budget set by Query.max_cost.'''
+    pass
+
+
 class Query():
-    
-    def __init__(self, database, table_name:str, page:int=0, page_size:int=None, filter_string:str=None):
 
+    # The maximum number of rows the database is allowed to examine for a single query, as estimated using EXPLAIN. Queries 
+    # which exceed this budget are rejected before they are executed. Set to None to disable the check.
+    max_cost = 10 ** 8
+    # The maximum time (in seconds) a single statement is allowed to run before MariaDB aborts it. 
+    max_statement_time = 300
+
+    # Rough relative error of the row estimates from table statistics and EXPLAIN. InnoDB samples a small number of index pages
+    # to estimate row counts, so these can be off by a lot for skewed data. 
+    approx_error = 0.5
+
+    # Path to a file where the shape and estimated cost of every admitted query is recorded, for use with utils/advisor.py. 
+    # Set to None to disable logging. 
+    log_path = None
+    # Entries waiting to be appended to the query log. These are written by a background thread (see Query.write_log), so that a slow or 
+    # unwritable disk never holds up a query. If the writer falls behind, new entries are dropped. 
+    log_queue = queue.Queue(maxsize=10000)
+    log_thread = None
+    log_lock = threading.Lock()
+
+    # The number of threads (and database connections) used to run a query in parallel. See Query.parallel_count and Query.parallel_stream.
+    n_workers = 8
+    
+    def __init__(self, database, table_name:str, page:int=0, page_size:int=None, filter_string:str=None, lookup:Tuple[sqlalchemy.Table, str]=None):
+        '''
+        :param database: The Database object, which manages the connection to the SQL database.
+        :param table_name: The name of the table being queried. 
+        :param page: The page of results to return, if the results are paginated. 
+        :param page_size: The number of results on each page. If None, the results are not paginated.
+        :param filter_string: The filter string, as parsed from the URL. 
+        :param lookup: A temporary table of IDs (created using Database.load_ids) and the field (gene_id or genome_id) to join it on. 
+            If specified, only rows which match one of the IDs in the table are returned.
+        '''
         self.table = database.get_table(table_name)
+        if (lookup is not None) and (lookup[1] not in self.table.__table__.c):
+            raise ValueError(f'Query: Table {table_name} has no field {lookup[1]}, so it can\'t be joined with the lookup table.')
         self.table_primary_key = inspect(self.table).primary_key[0].name
         self.page = page
         self.page_size = page_size
         self.filter_ = Filter(database, table_name, filter_string) if (filter_string is not None) else None
+        self.lookup = lookup
+        self.order_by = None # The name of the column the results are sorted by, which is set by get_stmt. 
 
     def __str__(self):
         '''Return a string representation of the query, which is the statement sent to the SQL database.
@@ -150,35 +383,367 @@ class Query():
         # This is a potential security risk. See https://feyyazbalci.medium.com/parameter-binding-f0b8df2cf058. 
         return str(self.stmt.compile(compile_kwargs={'literal_binds':True}))
 
-    def get(self, database, debug:bool=False, filter:Filter=None):
+    def get_stmt(self, database, outer_table=None) -> Select:
+        '''Build the SELECT statement used to retrieve data from the database.
+
+        :param database: The Database object.
+        :param outer_table: The outer table of the query (see Query.get_outer_table). If None, it is looked up using EXPLAIN.
+        '''
         # Use orderby to enforce consistent behavior. All tables have a genome ID, so this is probably the simplest way to go about this. 
-        self.stmt = select(*self.table.__table__.c) # I don't know why I need to add the columns manually...
-        self.stmt = self.stmt.order_by(getattr(self.get_outer_table(database), 'genome_id'))
+        self.stmt = self.decode(database, self.table)
+        if 'genome_id' in self.table.__table__.c:
+            outer_table = self.get_outer_table(database) if (outer_table is None) else outer_table
+            self.stmt = self.stmt.order_by(getattr(outer_table, 'genome_id'))
+            self.order_by = 'genome_id'
+        else: # The summary tables don't have a genome ID, so order by the primary key instead.
+            self.stmt = self.stmt.order_by(*inspect(self.table).primary_key)
+            self.order_by = self.table_primary_key
+        if self.lookup is not None:
+            lookup_table, field = self.lookup
+            self.stmt = self.stmt.join(lookup_table, lookup_table.c.id == getattr(self.table, field))
         if self.filter_ is not None:
             self.stmt = self.filter_(self.stmt)
         if self.page_size is not None:
             self.stmt = self.stmt.offset(self.page * self.page_size).limit(self.page_size)
+        return self.stmt
+
+    def decode(self, database, table) -> Select:
+        '''Build a SELECT statement for all columns of a table, replacing the IDs of any dictionary-encoded fields with their values
+        from the vocabulary tables.'''
+        columns = [getattr(table, col.name) for col in table.__table__.c]
+        vocabulary_tables = database.get_vocabulary_tables(table.__table__.name)
+        # The genome key is only used for partitioning, so is not returned. 
+        columns = [col for col in columns if (col.name not in vocabulary_tables) and (col.name != 'genome_key')]
+        for id_field, vocabulary_table in vocabulary_tables.items():
+            columns += [getattr(vocabulary_table, col.name) for col in vocabulary_table.__table__.c if (col.name != id_field)]
+
+        stmt = select(*columns).select_from(table)
+        for id_field, vocabulary_table in vocabulary_tables.items():
+            stmt = stmt.outerjoin(vocabulary_table, getattr(table, id_field) == getattr(vocabulary_table, id_field))
+        return stmt
+
+    def get_cost(self, database) -> int:
+        '''Estimate the number of rows the database will examine to execute the current statement, using EXPLAIN. For a nested-loop 
+        join, every row read from one table triggers a lookup in the next, so the total is the sum of the running products of the rows 
+        examined for each table. This is a rough estimate, but is good enough to catch queries which will tie up the database for minutes.'''
+        return self.estimate_cost(database.explain(self))
+
+    def estimate_cost(self, result:pd.DataFrame) -> int:
+        '''Estimate the number of rows examined from the output of EXPLAIN (see Query.get_cost).'''
+        rows = pd.to_numeric(result['rows'], errors='coerce').fillna(1).values
+        extra = ' '.join(result['Extra'].fillna('').astype(str)) if ('Extra' in result.columns) else ''
+        if (self.page_size is not None) and ('filesort' not in extra) and ('temporary' not in extra):
+            # If the rows are read in order, the database can stop once it has found enough rows to fill the page. 
+            rows[0] = min(rows[0], (self.page + 1) * self.page_size)
+        return int(np.sum(np.cumprod(rows)))
+
+    def admit(self, database):
+        '''Check that the estimated cost of the current statement is within budget, and set the statement timeout for the session. 
+        Should be called immediately before the statement is executed.'''
+        cost = None
+        if Query.max_cost is not None:
+            cost = self.get_cost(database)
+            if cost > Query.max_cost:
+                raise QueryCostError(f'Query.admit: The query is estimated to examine {cost} rows, which exceeds the limit of {Query.max_cost}. Try adding more selective filters, or use [approx] to get an estimated count.')
+        if Query.log_path is not None:
+            self.log(cost=cost)
+        if Query.max_statement_time is not None:
+            database.set_max_statement_time(Query.max_statement_time)
+
+    async def async_admit(self, database, session):
+        '''Async version of Query.admit, which runs the EXPLAIN and sets the statement timeout using an async session.'''
+        cost = None
+        if Query.max_cost is not None:
+            cost = self.estimate_cost(await database.async_explain(self, session))
+            if cost > Query.max_cost:
+                raise QueryCostError(f'Query.async_admit: The query is estimated to examine {cost} rows, which exceeds the limit of {Query.max_cost}. Try adding more selective filters, or use [approx] to get an estimated count.')
+        if Query.log_path is not None:
+            self.log(cost=cost)
+        if Query.max_statement_time is not None:
+            await database.async_set_max_statement_time(Query.max_statement_time, session)
+
+    def log(self, cost:int=None):
+        '''Queue the shape of the query (see Filter.shape) and its estimated cost to be appended to the query log as a line of JSON. 
+        This never blocks, and never raises an error.'''
+        entry = {'time':datetime.now().isoformat(), 'table':self.table.__tablename__, 'order_by':self.order_by, 'cost':cost}
+        entry['filters'] = [] if (self.filter_ is None) else self.filter_.shape()
+        if self.lookup is not None: # The join on the lookup table is an equality condition on the lookup field. 
+            entry['filters'].append((self.table.__tablename__, self.lookup[1], '[eq]'))
+        with Query.log_lock: # The writer is started on first use, so it is started in the worker process rather than a parent. 
+            if (Query.log_thread is None) or (not Query.log_thread.is_alive()):
+                Query.log_thread = threading.Thread(target=Query.write_log, daemon=True)
+                Query.log_thread.start()
+        try:
+            Query.log_queue.put_nowait((Query.log_path, entry))
+        except queue.Full:
+            pass
+
+    @staticmethod
+    def write_log():
+        '''Append the entries in the log queue to the query log as they arrive. The log is only used to recommend indices, so entries which 
+        can't be written (e.g. because the directory doesn't exist) are dropped.'''
+        while True:
+            path, entry = Query.log_queue.get()
+            try:
+                # Each line is appended to the end of the file with a single write, so other processes can append to the same file. If lines 
+                # from different processes are ever interleaved, utils/advisor.py skips the lines which can't be parsed. 
+                with open(path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except OSError:
+                pass
+            finally:
+                Query.log_queue.task_done()
+
+    def get(self, database, debug:bool=False, filter:Filter=None, total:bool=False):
+        '''Execute the query, and return the result.
+
+        :param database: The Database object.
+        :param debug: If True, return the statement instead of executing it.
+        :param total: If True, add a total_count column with the total number of results (ignoring pagination) to every row. 
+            This is computed with a window function in the same statement, so a separate count query is not needed.
+        '''
+        self.stmt = self.get_stmt(database)
+        if total:
+            # The window covers all matching rows, as window functions are evaluated before the LIMIT is applied. 
+            self.stmt = self.stmt.add_columns(func.count().over().label('total_count'))
 
         # return database.session.execute(self.stmt.where(Metadata.genome_id == 'GCA_000248235.2'))
         if debug:
             return str(self)
 
+        self.admit(database)
         return database.session.execute(self.stmt) # .all()
 
-    def count(self, database, debug:bool=False, filter_:Filter=None):
+    async def async_get(self, database, session, total:bool=False):
+        '''Async version of Query.get, which executes the query using an async session (see Database.get_async_session). The lookups
+        needed to apply the filter are resolved first, so building the statement never blocks the event loop.'''
+        if self.filter_ is not None:
+            await self.filter_.resolve(session)
+        outer_table = (await self.async_get_outer_table(database, session)) if ('genome_id' in self.table.__table__.c) else None
+        self.stmt = self.get_stmt(database, outer_table=outer_table)
+        if total:
+            self.stmt = self.stmt.add_columns(func.count().over().label('total_count'))
+
+        await self.async_admit(database, session)
+        return await session.execute(self.stmt)
+
+    def stream(self, database, chunk_size:int=1000) -> Generator[List[Dict], None, None]:
+        '''Execute the query using a server-side cursor, and yield the results in chunks of dictionaries. Unlike Query.get, 
+        the rows are not all loaded into memory at once, so memory usage is bounded by the chunk size.'''
+        self.stmt = self.get_stmt(database)
+        self.admit(database)
+        # NOTE: With PyMySQL, stream_results uses an unbuffered cursor (SSCursor), so rows are fetched as they are consumed. 
+        result = database.session.execute(self.stmt, execution_options={'stream_results':True, 'yield_per':chunk_size})
+        for rows in result.partitions(chunk_size):
+            yield [row._asdict() for row in rows]
+        result.close()
+
+    def get_count_stmt(self) -> Select:
+        '''Build the SELECT statement used to count the results.'''
         # Modified from https://gist.github.com/hest/8798884
         # NOTE: Why are subqueries so bad?
         # self.stmt = select(func.count(self.table.__table__)) # I don't know why I need to add the columns manually...)
         self.stmt = select(func.count(getattr(self.table, self.table_primary_key))) # I don't know why I need to add the columns manually...)
         self.stmt = self.stmt.order_by(None)
+        self.order_by = None
         if self.filter_ is not None:
-            self.stmt = self.filter_(self.stmt)
+            self.stmt = self.filter_(self.stmt, add_columns=False)
+        return self.stmt
+
+    def count(self, database, debug:bool=False, filter_:Filter=None):
+        self.stmt = self.get_count_stmt()
 
         if debug:
             return str(self)
 
+        self.admit(database)
         return database.session.execute(self.stmt).scalar()
 
+    async def async_count(self, database, session) -> int:
+        '''Async version of Query.count.'''
+        if self.filter_ is not None:
+            await self.filter_.resolve(session)
+        self.stmt = self.get_count_stmt()
+
+        await self.async_admit(database, session)
+        return (await session.execute(self.stmt)).scalar()
+
+    def get_ranges(self, database) -> List[Tuple[str, str]]:
+        '''Split the genome IDs into disjoint ranges using the boundaries table, so that a query can be run in parallel.
+        
+        :return: A list of (low, high) tuples in increasing order, where low is inclusive and high is exclusive. The first low and 
+            the last high are None, meaning the range is unbounded.
+        '''
+        if 'genome_id' not in self.table.__table__.c:
+            raise ValueError(f'Query.get_ranges: Table {self.table.__tablename__} has no genome_id, so the query can\'t be split into ranges.')
+        if self.lookup is not None: # Temporary tables are only visible to the connection which created them. 
+            raise ValueError('Query.get_ranges: Queries using a lookup table can\'t be run in parallel.')
+        boundaries = [None] + database.get_boundaries(f"boundaries_r{self.table.__tablename__.split('_r')[-1]}") + [None]
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def restrict(self, stmt:Select, low:str=None, high:str=None) -> Select:
+        '''Restrict a statement to the genome IDs in a range.'''
+        if low is not None:
+            stmt = stmt.where(self.table.genome_id >= low)
+        if high is not None:
+            stmt = stmt.where(self.table.genome_id < high)
+        return stmt
+
+    def parallel_count(self, database, debug:bool=False) -> int:
+        '''Count the results by splitting the query into genome ID ranges, counting each range on a separate connection, and adding up 
+        the counts. This lets MariaDB use multiple cores for a single count.'''
+        self.stmt = self.get_count_stmt()
+        if debug:
+            return str(self)
+
+        self.admit(database)
+        stmts = [self.restrict(self.stmt, low, high) for low, high in self.get_ranges(database)]
+
+        def count(stmt):
+            session = database.get_session()
+            try:
+                if Query.max_statement_time is not None:
+                    database.set_max_statement_time(Query.max_statement_time, session=session)
+                return session.execute(stmt).scalar()
+            finally:
+                session.close()
+
+        with ThreadPoolExecutor(Query.n_workers) as pool:
+            return sum(pool.map(count, stmts))
+
+    def parallel_stream(self, database, chunk_size:int=1000, max_chunks:int=4) -> Generator[List[Dict], None, None]:
+        '''Execute the query by splitting it into genome ID ranges, which are read concurrently on separate connections. The results are
+        yielded in chunks in the same order as Query.stream, i.e. sorted by genome ID, as each range is only yielded once the ones before
+        it are finished. 
+
+        :param database: The Database object. 
+        :param chunk_size: The number of rows in each chunk.
+        :param max_chunks: The maximum number of chunks buffered for each range which is waiting to be yielded. This bounds memory usage. 
+        '''
+        if self.page_size is not None:
+            raise ValueError('Query.parallel_stream: Paginated queries can\'t be run in parallel.')
+        self.stmt = self.get_stmt(database)
+        self.admit(database)
+        stmts = [self.restrict(self.stmt, low, high) for low, high in self.get_ranges(database)]
+        return Query.stream_concurrently(database, stmts, chunk_size=chunk_size, max_chunks=max_chunks)
+
+    @staticmethod
+    def stream_concurrently(database, stmts:List[Select], chunk_size:int=1000, max_chunks:int=4) -> Generator[List[Dict], None, None]:
+        '''Execute a list of statements concurrently, each on a separate connection, and yield the results in chunks. The results of each
+        statement are only yielded once the ones before it are finished, so the order of the statements is preserved.'''
+        queues = [queue.Queue(maxsize=max_chunks) for _ in stmts]
+        cancelled = threading.Event() # Set if the caller stops consuming the results early, so the worker threads can exit. 
+
+        def put(q:queue.Queue, item):
+            while not cancelled.is_set():
+                try:
+                    q.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read(stmt, q:queue.Queue):
+            session = database.get_session()
+            try:
+                if Query.max_statement_time is not None:
+                    database.set_max_statement_time(Query.max_statement_time, session=session)
+                result = session.execute(stmt, execution_options={'stream_results':True, 'yield_per':chunk_size})
+                for rows in result.partitions(chunk_size):
+                    if not put(q, [row._asdict() for row in rows]):
+                        break
+                result.close()
+                put(q, None) # Marks the end of the results for the statement. 
+            except Exception as err:
+                put(q, err)
+            finally:
+                session.close()
+
+        # The pool runs the statements in order, and each is only waiting on the ones before it, so this can't deadlock. 
+        pool = ThreadPoolExecutor(Query.n_workers)
+        try:
+            for stmt, q in zip(stmts, queues):
+                pool.submit(read, stmt, q)
+            for q in queues:
+                for item in iter(q.get, None):
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            cancelled.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+    def approx_count(self, database, debug:bool=False) -> Tuple[int, int]:
+        '''Estimate the number of results for the query without actually running it, which returns in milliseconds even
+        for very large tables. The estimate comes from (in order of preference) the table statistics, the per-annotation tallies 
+        in the summary tables, the per-genome protein tallies in the metadata table, or the row estimates produced by EXPLAIN.
+
+        :return: A tuple containing the estimated count and a bound on the error of the estimate.
+        '''
+        version = self.table.__tablename__.split('_r')[-1]
+        metadata_table = database.get_table(f'metadata_r{version}')
+
+        if self.filter_ is None: # The number of rows in the table is in the table statistics. 
+            estimate = database.get_table_rows(self.table.__tablename__)
+            return estimate, int(estimate * Query.approx_error)
+
+        summary = self.get_summary(database, version)
+        if summary is not None:
+            # The number of annotations for a single KO or Pfam (optionally within a single taxon) is pre-computed in the summary tables.  
+            summary_table, field, rank, taxon = summary
+            col = getattr(summary_table, field)
+            self.stmt = select(func.sum(summary_table.n_annotations)).where(col == self.filter_.filters[field][1])
+            self.stmt = self.stmt.where(summary_table.rank == rank)
+            self.stmt = self.stmt if (taxon is None) else self.stmt.where(summary_table.taxon == taxon)
+            if debug:
+                return str(self)
+            estimate = database.session.execute(self.stmt).scalar()
+            return (0 if estimate is None else int(estimate)), 0
+
+        # Some fields (e.g. gc_content) are in both tables, in which case the filter applies to the proteins table, not the metadata table. 
+        if (self.table.__tablename__ == f'proteins_r{version}') and all([self.filter_.field_to_table_map.get(field) is metadata_table for field in self.filter_.filters]):
+            # If the filters only apply to genomes, the number of proteins is the sum of the protein counts for each genome. 
+            filter_ = Filter(database, f'metadata_r{version}', self.filter_.filter_string)
+            self.stmt = filter_(select(func.sum(metadata_table.protein_count)), add_columns=False)
+            if debug:
+                return str(self)
+            estimate = database.session.execute(self.stmt).scalar()
+            return (0 if estimate is None else int(estimate)), 0
+
+        self.stmt = self.filter_(select(getattr(self.table, self.table_primary_key)), add_columns=False)
+        if debug:
+            return str(self)
+        result = database.explain(self)
+        # The estimated number of output rows for a nested-loop join is the product of the rows examined for each table, 
+        # scaled by the fraction of rows expected to pass the WHERE clause. 
+        rows = pd.to_numeric(result['rows'], errors='coerce').fillna(1)
+        if 'filtered' in result.columns:
+            rows = rows * pd.to_numeric(result['filtered'], errors='coerce').fillna(100) / 100
+        estimate = int(np.prod(rows.values))
+        return estimate, int(estimate * Query.approx_error)
+
+    def get_summary(self, database, version:int):
+        '''Check if the count for the query can be read from one of the summary tables, which is the case if the query is on an 
+        annotations table and filters for a single KO or Pfam, and optionally a single taxon.
+
+        :return: None if the summary tables can't be used. Otherwise, a tuple containing the summary table, the annotation field,
+            the rank, and the taxon (which is None if no taxon is specified).
+        '''
+        names = {f'annotations_kegg_r{version}':('ko', f'summary_kegg_r{version}'), f'annotations_pfam_r{version}':('pfam', f'summary_pfam_r{version}')}
+        if self.table.__tablename__ not in names:
+            return None
+        field, summary_table_name = names[self.table.__tablename__]
+
+        filters = self.filter_.filters
+        if (field not in filters) or (filters[field][0] != '[eq]') or ('[or]' in filters[field][1]):
+            return None
+        ranks = [f for f in filters if f != field]
+        if len(ranks) == 0: # Every genome has a domain, so summing over domains gives the total. 
+            return database.get_table(summary_table_name), field, 'gtdb_domain', None
+        if (len(ranks) == 1) and (ranks[0] in RANKS) and (filters[ranks[0]][0] == '[eq]') and ('[or]' not in filters[ranks[0]][1]):
+            return database.get_table(summary_table_name), field, ranks[0], filters[ranks[0]][1]
+        return None
 
     def get_outer_table(self, database):
         '''The database engine picks a table for the "outer" part of the query, i.e. the table on the left side of the join (this table is not always the first one
@@ -186,16 +751,167 @@ class Query():
         inner table's values (I think), which is very slow and uses a lot of memory. this function figures out what the outer table is, and ensures that the ORDER BY is 
         called on that table.'''
 
-        sql = self.__str__()
-        result = database.explain(self)  
-        outer_table_name = result['table'].values[0] # Get the first row from the result of EXPLAIN.
-        return database.get_table(outer_table_name)
+        # The statement only depends on the table being queried, so the result is cached on the Database. 
+        table_name = self.table.__tablename__
+        if table_name not in database.outer_tables:
+            result = database.explain(self)  
+            database.outer_tables[table_name] = result['table'].values[0] # Get the first row from the result of EXPLAIN.
+        return database.get_table(database.outer_tables[table_name])
+
+    async def async_get_outer_table(self, database, session):
+        '''Async version of Query.get_outer_table, which shares its cache.'''
+        table_name = self.table.__tablename__
+        if table_name not in database.outer_tables:
+            self.stmt = self.decode(database, self.table)
+            result = await database.async_explain(self, session)
+            database.outer_tables[table_name] = result['table'].values[0]
+        return database.get_table(database.outer_tables[table_name])
 
 
     
 
 class HistoryQuery(Query):
-    pass
+    '''A query which is run against the same table in several GTDB releases, e.g. annotations_kegg_r207 and annotations_kegg_r214, so
+    that the results can be compared across releases. The query for each release is run concurrently on a separate connection, and the
+    results are merged in order of version, with every row tagged with the version it came from.'''
+
+    # The counts and pages for each release, keyed by (table name, filter string, page, page size, mode). A release is never modified once
+    # it is uploaded, so these never need to be recomputed. The latest release is not cached, as it might still be being loaded.
+    cache = dict()
+    cache_lock = threading.Lock()
+    max_cache_size = 10000
+
+    def __init__(self, database, table_name:str, versions:List[int]=None, page:int=0, page_size:int=None, filter_string:str=None):
+        '''
+        :param database: The Database object, which manages the connection to the SQL database.
+        :param table_name: The name of the table being queried, without the version, e.g. annotations_kegg. If a version is included,
+            it is ignored.
+        :param versions: The GTDB releases to query. If None, every release in Database.versions is queried.
+        :param page: The page of results to return from each release, if the results are paginated.
+        :param page_size: The number of results on each page. If None, the results are not paginated.
+        :param filter_string: The filter string, as parsed from the URL, which is applied to every release.
+        '''
+        self.versions = sorted(set(database.versions if (versions is None) else versions))
+        for version in self.versions:
+            if version not in database.versions:
+                raise ValueError(f'HistoryQuery: Version {version} is not one of the available GTDB releases ({", ".join(map(str, database.versions))}).')
+        self.table_family = re.sub(r'_r\d+$', '', table_name)
+        self.filter_string = filter_string
+        super().__init__(database, f'{self.table_family}_r{self.versions[-1]}', page=page, page_size=page_size, filter_string=filter_string)
+
+    def get_query(self, database, version:int) -> Query:
+        return Query(database, f'{self.table_family}_r{version}', page=self.page, page_size=self.page_size, filter_string=self.filter_string)
+
+    def get_versioned_stmt(self, database, query:Query, version:int) -> Select:
+        '''Build the statement for a single release, making sure the version is included in the results.'''
+        stmt = query.get_stmt(database)
+        return stmt if ('version' in query.table.__table__.c) else stmt.add_columns(sqlalchemy.literal(version).label('version'))
+
+    def run(self, database, mode:str) -> Dict[int, object]:
+        '''Run the query for each release concurrently, each using its own Database (see Database.fork), and return the results keyed by
+        version. Results for releases other than the latest are read from (and added to) the cache.
+
+        :param mode: Either count, which gets the number of results, or get, which gets the rows on the page.
+        '''
+        def run_(version:int):
+            key = (f'{self.table_family}_r{version}', self.filter_string, self.page, self.page_size, mode)
+            with HistoryQuery.cache_lock:
+                if key in HistoryQuery.cache:
+                    return HistoryQuery.cache[key]
+
+            database_ = database.fork()
+            try:
+                query = self.get_query(database_, version)
+                if mode == 'count':
+                    result = query.count(database_)
+                else:
+                    query.stmt = self.get_versioned_stmt(database_, query, version)
+                    query.admit(database_)
+                    result = [row._asdict() for row in database_.session.execute(query.stmt)]
+            finally:
+                database_.close()
+
+            if version < max(database.versions):
+                with HistoryQuery.cache_lock:
+                    if len(HistoryQuery.cache) >= HistoryQuery.max_cache_size: # Evict the oldest result.
+                        HistoryQuery.cache.pop(next(iter(HistoryQuery.cache)))
+                    HistoryQuery.cache[key] = result
+            return result
+
+        with ThreadPoolExecutor(min(Query.n_workers, len(self.versions))) as pool:
+            return dict(zip(self.versions, pool.map(run_, self.versions)))
+
+    def count(self, database, debug:bool=False) -> Dict[int, int]:
+        '''Count the results for each release.'''
+        if debug:
+            return '\n\n'.join([str(self.get_query(database, version).count(database, debug=True)) for version in self.versions])
+        return self.run(database, 'count')
+
+    def stream(self, database, chunk_size:int=1000, max_chunks:int=4) -> Generator[List[Dict], None, None]:
+        '''Execute the query for each release, and yield the results in chunks in order of version. Unpaginated results are read
+        concurrently from server-side cursors (see Query.stream_concurrently), and are not cached, as they can be arbitrarily large.'''
+        if self.page_size is not None:
+            # The statement for the latest release is kept, so the selected columns are available to the caller (as with Query.stream).
+            self.stmt = self.get_versioned_stmt(database, self.get_query(database, self.versions[-1]), self.versions[-1])
+            for version, rows in self.run(database, 'get').items():
+                for i in range(0, len(rows), chunk_size):
+                    yield rows[i:i + chunk_size]
+            return
+
+        stmts = []
+        for version in self.versions:
+            query = self.get_query(database, version)
+            query.stmt = self.get_versioned_stmt(database, query, version)
+            query.admit(database)
+            stmts.append(query.stmt)
+        self.stmt = stmts[-1]
+        yield from Query.stream_concurrently(database, stmts, chunk_size=chunk_size, max_chunks=max_chunks)
+
+
+class NeighborhoodQuery(Query):
+    '''A query for the genomic neighborhoods of a set of anchor genes, e.g. all genes within 10 kb of every gene annotated with K00001. 
+    The anchors are selected by applying the filter string to an annotations table, and the neighbors are found with a single join on 
+    the proteins table, which uses the (genome_id, scaffold_id, start) index.'''
+
+    def __init__(self, database, table_name:str, filter_string:str=None, window:int=10000):
+        '''
+        :param database: The Database object, which manages the connection to the SQL database.
+        :param table_name: The name of the annotations table used to select the anchor genes. The neighbors are returned with 
+            their annotations from the same table.
+        :param filter_string: The filter string used to select the anchor genes. 
+        :param window: The maximum distance (in base pairs) between the anchor gene and its neighbors. 
+        '''
+        if not table_name.startswith('annotations_'):
+            raise ValueError(f'NeighborhoodQuery: Anchor genes must be selected from one of the annotations tables, not {table_name}.')
+        super().__init__(database, table_name, filter_string=filter_string)
+
+        self.window = window
+        self.proteins_table = database.get_table(f'proteins_r{table_name.split("_r")[-1]}')
+        self.field = 'ko' if ('ko_id' in self.table.__table__.c) else 'pfam'
+        self.vocabulary_table = database.get_table(f'vocabulary_{self.field}_r{table_name.split("_r")[-1]}')
+
+    def get_stmt(self, database) -> Select:
+        '''Build the SELECT statement used to retrieve the neighborhoods.'''
+        anchors = select(self.table.gene_id)
+        if self.filter_ is not None:
+            anchors = self.filter_(anchors, add_columns=False)
+        anchors = anchors.distinct().subquery('anchors')
+        anchor_proteins = sqlalchemy.orm.aliased(self.proteins_table, name='anchor_proteins')
+        neighbors = sqlalchemy.orm.aliased(self.proteins_table, name='neighbors')
+
+        # Include all protein fields except the sequence, which is large, and can be retrieved separately if needed.  
+        columns = [getattr(neighbors, col.name) for col in self.proteins_table.__table__.c if (col.name != 'seq')]
+        self.stmt = select(anchors.c.gene_id.label('anchor_gene_id'), *columns, getattr(self.vocabulary_table, self.field))
+        self.stmt = self.stmt.join(anchor_proteins, anchor_proteins.gene_id == anchors.c.gene_id)
+        # The first condition on start is redundant, but lets the database use the location index to find candidate neighbors.  
+        self.stmt = self.stmt.join(neighbors, sqlalchemy.and_(neighbors.genome_id == anchor_proteins.genome_id, neighbors.scaffold_id == anchor_proteins.scaffold_id,
+            neighbors.start.between(anchor_proteins.start - self.window - MAX_GENE_LENGTH, anchor_proteins.stop + self.window), 
+            neighbors.stop >= anchor_proteins.start - self.window))
+        self.stmt = self.stmt.outerjoin(self.table, self.table.gene_id == neighbors.gene_id)
+        id_field = f'{self.field}_id'
+        self.stmt = self.stmt.outerjoin(self.vocabulary_table, getattr(self.table, id_field) == getattr(self.vocabulary_table, id_field))
+        self.stmt = self.stmt.order_by(anchor_proteins.genome_id, anchors.c.gene_id, neighbors.start)
+        return self.stmt
 
 
 
@@ -0,0 +1,55 @@
+'''Class for deduplicating identical requests which arrive at the same time. When a shared notebook is run by lots of people at once, the
+server gets many copies of the same request within a few seconds. Rather than running the same query once for every request, the first
+request runs it, and any identical requests which arrive while it is running wait for it to finish and share the result.'''
+import threading
+from typing import Dict, Any, Callable, Hashable
+
+
+class Call():
+    '''An in-flight call, which waiting threads can block on until the result is available.'''
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.n_waiting = 0 # The number of other threads sharing the result, which is mostly useful for testing.
+
+
+class SingleFlight():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls:Dict[Hashable, Call] = dict()
+
+    def do(self, key:Hashable, func:Callable, *args, **kwargs) -> Any:
+        '''Call the function, unless a call with the same key is already running, in which case wait for it to finish and return its
+        result (or raise its error). Results are not cached once the call finishes, so later requests always see fresh data.
+
+        :param key: The key identifying the call, e.g. the endpoint, table, and normalized filter string of a request.
+        :param func: The function to call. Any additional arguments are passed to it.
+        '''
+        with self.lock:
+            call = self.calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+            else:
+                call.n_waiting += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            # Remove the call before waking up the waiting threads, so that any new requests start a new call.
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
@@ -0,0 +1,104 @@
+'''Class for managing the on-disk sequence store, which serves amino acid sequences without reading them from the proteins table. The
+sequences are written as FASTA records into independently-compressed blocks (in the style of BGZF), and an index maps each gene ID to the
+block containing its record and the position of the record within the uncompressed block. Fetching a sequence means decompressing a single
+small block, so any list of gene IDs can be served with a handful of direct reads and no database round-trips.'''
+import os
+import zlib
+import numpy as np
+from typing import List, Dict, Iterable, Tuple
+
+# NOTE: Each block is a complete gzip member, so the data file is itself a valid gzip file, and can be read with zcat or gzip.open to recover
+# the plain FASTA. The index and the data file are memory-mapped when the store is loaded, so lookups can be done from multiple threads
+# without sharing a file handle.
+
+
+class SequenceStore():
+
+    data_file_name = 'sequences.fa.gz'
+
+    @staticmethod
+    def compress(block:bytes) -> bytes:
+        compressor = zlib.compressobj(level=6, wbits=31) # The wbits=31 option writes a gzip header and trailer.
+        return compressor.compress(block) + compressor.flush()
+
+    @staticmethod
+    def build(path:str, entries:Iterable[Tuple[str, str]], block_size:int=65536):
+        '''Build a sequence store and write it to a directory. Only the index (and the current block) are held in memory.
+
+        :param path: The directory where the store will be written.
+        :param entries: An iterable of (gene ID, amino acid sequence) tuples. Each gene ID should only appear once.
+        :param block_size: The maximum size of an uncompressed block in bytes. Records are never split across blocks, so a record
+            longer than this gets a block to itself.
+        '''
+        os.makedirs(path, exist_ok=True)
+        gene_ids, record_blocks, record_offsets, record_lengths = [], [], [], []
+        block_offsets = [0] # The position of each block in the data file, ending with the size of the file.
+        block = bytearray()
+
+        with open(os.path.join(path, SequenceStore.data_file_name), 'wb') as f:
+            for gene_id, seq in entries:
+                record = f'>{gene_id}\n{seq}\n'.encode('ascii')
+                if (len(block) > 0) and (len(block) + len(record) > block_size):
+                    block_offsets.append(block_offsets[-1] + f.write(SequenceStore.compress(bytes(block))))
+                    block = bytearray()
+                gene_ids.append(gene_id)
+                record_blocks.append(len(block_offsets) - 1)
+                record_offsets.append(len(block) + len(gene_id) + 2) # Point past the header line, directly to the sequence.
+                record_lengths.append(len(seq))
+                block += record
+            if len(block) > 0:
+                block_offsets.append(block_offsets[-1] + f.write(SequenceStore.compress(bytes(block))))
+
+        # Sort the index by gene ID, so that gene IDs can be found using a binary search.
+        gene_ids = np.array(gene_ids, dtype=bytes)
+        order = np.argsort(gene_ids, kind='stable')
+        np.save(os.path.join(path, 'gene_ids.npy'), gene_ids[order])
+        np.save(os.path.join(path, 'records.npy'), np.array([record_blocks, record_offsets, record_lengths], dtype=np.uint32).T[order])
+        np.save(os.path.join(path, 'blocks.npy'), np.array(block_offsets, dtype=np.uint64))
+
+    def __init__(self, path:str):
+
+        self.path = path
+        self.gene_ids = np.load(os.path.join(path, 'gene_ids.npy'), mmap_mode='r')
+        self.records = np.load(os.path.join(path, 'records.npy'), mmap_mode='r')
+        self.blocks = np.load(os.path.join(path, 'blocks.npy'), mmap_mode='r')
+        self.data = np.memmap(os.path.join(path, SequenceStore.data_file_name), dtype=np.uint8, mode='r') if (len(self.gene_ids) > 0) else None
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    def get_records(self, gene_ids:List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        '''Find the index records for a list of gene IDs. Returns a boolean mask indicating which gene IDs are in the store, and the
+        (block, offset, length) records for the gene IDs which are.'''
+        gene_ids = np.array(gene_ids, dtype=bytes)
+        if (len(self.gene_ids) == 0) or (len(gene_ids) == 0):
+            return np.zeros(len(gene_ids), dtype=bool), np.zeros((0, 3), dtype=np.uint32)
+        idxs = np.minimum(np.searchsorted(self.gene_ids, gene_ids), len(self.gene_ids) - 1)
+        mask = self.gene_ids[idxs] == gene_ids
+        return mask, self.records[idxs[mask]]
+
+    def read_block(self, block:int) -> bytes:
+        start, stop = int(self.blocks[block]), int(self.blocks[block + 1])
+        return zlib.decompress(self.data[start:stop].tobytes(), wbits=31)
+
+    def get(self, gene_ids:Iterable[str]) -> Dict[str, str]:
+        '''Get the sequences for a collection of gene IDs. Each block is only decompressed once, however many of the requested
+        sequences it contains. Gene IDs which are not in the store are ignored.
+
+        :param gene_ids: The gene IDs to look up.
+        :return: A dictionary mapping each gene ID which was found to its sequence, in the order the gene IDs were given.
+        '''
+        gene_ids = [gene_id.strip() for gene_id in gene_ids if (len(gene_id.strip()) > 0)]
+        mask, records = self.get_records(gene_ids)
+        gene_ids = [gene_id for gene_id, found in zip(gene_ids, mask) if found]
+
+        seqs = dict()
+        order = np.argsort(records[:, 0], kind='stable')
+        block, data = None, None
+        for i in order:
+            if records[i, 0] != block:
+                block = records[i, 0]
+                data = self.read_block(block)
+            offset, length = int(records[i, 1]), int(records[i, 2])
+            seqs[gene_ids[i]] = data[offset:offset + length].decode('ascii')
+        return {gene_id:seqs[gene_id] for gene_id in gene_ids}
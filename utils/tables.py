@@ -1,16 +1,19 @@
 import os
+import re
+import bisect
 from sqlalchemy import inspect
 import sqlalchemy
 import pandas as pd 
 import numpy as np
 import sqlalchemy.orm
 from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy import String, Integer, ForeignKey, PrimaryKeyConstraint, Float, ForeignKeyConstraint, Text, CHAR
+from sqlalchemy import String, Integer, ForeignKey, PrimaryKeyConstraint, Float, ForeignKeyConstraint, Text, CHAR, Index
 from sqlalchemy.orm import DeclarativeBase, relationship, mapped_column
 from sqlalchemy.ext.declarative import DeferredReflection
 from typing import List, Dict, Set
 
 MAX_SEQ_LENGTH = 50000 # The maximum number of amino acids allowed for a protein sequence. 
+MAX_GENE_LENGTH = 3 * MAX_SEQ_LENGTH # The maximum number of nucleotides in a gene. 
 GENOME_ID_LENGTH = 20 # Length of the GTDB genome accessions. 
 GENE_ID_LENGTH = 50 # Approximate length of GTDB gene accessions. 
 DEFAULT_STRING_LENGTH = 50
@@ -35,9 +38,74 @@ class Base(DeclarativeBase):
 
 class Reflected(DeferredReflection):
     __abstract__ = True
+
+
+def get_genome_key(genome_id:str) -> int:
+    '''Get an integer key for a genome, which is the numerical part of the accession without the version, e.g. 7325 for GCA_000007325.1. 
+    MariaDB can only hash-partition on integers, so this is stored alongside the genome ID in hash-partitioned tables.'''
+    digits = re.sub(r'\D', '', genome_id.split('.')[0])
+    return 0 if (len(digits) == 0) else int(digits)
+
+
+class Partitioning():
+    '''Describes how the proteins and annotations tables are partitioned by genome. Hash partitioning spreads the genomes evenly across 
+    the partitions using the genome key. Range partitioning splits the sorted genome IDs at the specified boundaries, so that each partition 
+    holds a contiguous range of genome IDs. In both cases, the partition for a genome can be computed without querying the database.'''
+
+    methods = ['hash', 'range']
+
+    def __init__(self, method:str='hash', n_partitions:int=16, boundaries:List[str]=None):
+        '''
+        :param method: The partitioning method, either hash or range.
+        :param n_partitions: The number of partitions, if using hash partitioning. 
+        :param boundaries: The genome IDs at which to split the partitions, if using range partitioning. Each partition contains the genome
+            IDs which are greater than or equal to the previous boundary, and less than the next one. 
+        '''
+        if method not in Partitioning.methods:
+            raise ValueError(f"Partitioning: Method {method} is not supported. Supported methods are {', '.join(Partitioning.methods)}.")
+        if (method == 'range') and (boundaries is None):
+            raise ValueError('Partitioning: Boundaries must be specified for range partitioning.')
+
+        self.method = method
+        self.boundaries = None if (boundaries is None) else sorted(boundaries)
+        self.n_partitions = n_partitions if (method == 'hash') else len(self.boundaries) + 1
+        self.field = 'genome_key' if (method == 'hash') else 'genome_id' # The column which determines the partition. 
+
+    def get_table_kwargs(self) -> Dict[str, str]:
+        '''Get the dialect-specific keyword arguments which add the PARTITION BY clause to the CREATE TABLE statement.'''
+        if self.method == 'hash':
+            return {'mariadb_partition_by':'HASH(genome_key)', 'mariadb_partitions':str(self.n_partitions)}
+        partitions = [f"PARTITION p{i} VALUES LESS THAN ('{boundary}')" for i, boundary in enumerate(self.boundaries)]
+        partitions += [f'PARTITION p{len(self.boundaries)} VALUES LESS THAN (MAXVALUE)']
+        return {'mariadb_partition_by':f"RANGE COLUMNS(genome_id) ({', '.join(partitions)})"}
+
+    def get_partition(self, genome_id:str) -> int:
+        '''Get the index of the partition which holds the genome.'''
+        if self.method == 'hash':
+            return get_genome_key(genome_id) % self.n_partitions # This is how MariaDB assigns rows to hash partitions. 
+        return bisect.bisect_right(self.boundaries, genome_id)
+
+
+def get_table_args(*constraints, partitioning:Partitioning=None) -> tuple:
+    '''Build the __table_args__ for a table which can be partitioned. MariaDB does not support foreign keys on partitioned tables, so 
+    they are not created in the database, but are kept in the table metadata so the relationships still work.'''
+    if partitioning is None:
+        return (*constraints, {'extend_existing':True})
+    constraints = [c.ddl_if(callable_=lambda *args, **kwargs: False) if isinstance(c, ForeignKeyConstraint) else c for c in constraints]
+    return (*constraints, {'extend_existing':True, **partitioning.get_table_kwargs()})
+
+
+def add_partition_key(attrs:Dict, partitioning:Partitioning=None):
+    '''MariaDB requires the partitioning column to be part of every unique key, so add it to the primary key of a partitioned table.'''
+    if partitioning is None:
+        return
+    if partitioning.field == 'genome_key':
+        attrs['genome_key'] = mapped_column(Integer, primary_key=True, autoincrement=False, comment='The numerical part of the genome ID, used for partitioning.')
+    else:
+        attrs['genome_id'] = mapped_column(String(GENOME_ID_LENGTH), primary_key=True, comment='The GTDB genome ID.')
     
     
-def create_proteins_table(version:int):
+def create_proteins_table(version:int, partitioning:Partitioning=None):
 
     # class Base(DeclarativeBase):
     #     pass 
@@ -51,9 +119,14 @@ def create_proteins_table(version:int):
     
     attrs = dict()
     attrs['__tablename__'] = f'proteins_r{version}'
-    attrs['__table_args__'] = (ForeignKeyConstraint(['genome_id'], [f'metadata_r{version}.genome_id']),
-                                {'extend_existing':True})
+    attrs['__table_args__'] = get_table_args(ForeignKeyConstraint(['genome_id'], [f'metadata_r{version}.genome_id']),
+                                Index(f'ix_proteins_r{version}_location', 'genome_id', 'scaffold_id', 'start'), # Used for finding genomic neighborhoods.
+                                Index(f'ix_proteins_r{version}_seq_length', 'seq_length'),
+                                Index(f'ix_proteins_r{version}_cysteine_count', 'cysteine_count'),
+                                Index(f'ix_proteins_r{version}_molecular_weight', 'molecular_weight'),
+                                partitioning=partitioning)
     attrs[f'metadata_r{version}'] = relationship(f'Metadata_r{version}', viewonly=True)
+    attrs['partitioning'] = partitioning
 
     # Set table column attributes. 
     attrs['gene_id'] = mapped_column(String(GENE_ID_LENGTH), primary_key=True)
@@ -69,11 +142,17 @@ def create_proteins_table(version:int):
     attrs['partial'] = mapped_column(String(2), comment='An indicator of if a gene runs off the edge of a sequence or into a gap. A 0 indicates the gene has a true boundary (a start or a stop), whereas a 1 indicates the gene is partial at that edge. For example, 00 indicates a complete gene with a start and stop codon.') 
     attrs['rbs_motif'] = mapped_column(String(DEFAULT_STRING_LENGTH)) # The RBS binding motif detected by Prodigal. 
     attrs['scaffold_id'] = mapped_column(Integer) # TODO: How do I extract this?
+    # Computed from the amino acid sequence by ProteinsFile.get_composition, so they can be filtered on without reading the sequences. 
+    attrs['seq_length'] = mapped_column(Integer, comment='The number of residues in the amino acid sequence, not including the stop.')
+    attrs['cysteine_count'] = mapped_column(Integer, comment='The number of cysteine residues in the amino acid sequence.')
+    attrs['molecular_weight'] = mapped_column(Float, comment='The average molecular weight of the protein, in Daltons.')
+
+    add_partition_key(attrs, partitioning)
 
     return type(name, parents, attrs)
 
 
-def create_annotations_kegg_table(version:int):
+def create_annotations_kegg_table(version:int, partitioning:Partitioning=None):
 
     # class Base(DeclarativeBase):
     #     pass 
@@ -88,20 +167,30 @@ def create_annotations_kegg_table(version:int):
     attrs['__tablename__'] = f'annotations_kegg_r{version}'
     attrs[f'metadata_r{version}'] = relationship(f'Metadata_r{version}', viewonly=True)
     attrs[f'proteins_r{version}'] = relationship(f'Proteins_r{version}', viewonly=True)
-    attrs['__table_args__'] = (ForeignKeyConstraint(['genome_id'], [f'metadata_r{version}.genome_id']), 
+    attrs[f'vocabulary_ko_r{version}'] = relationship(f'VocabularyKo_r{version}', viewonly=True)
+    attrs['partitioning'] = partitioning
+    attrs['__table_args__'] = get_table_args(ForeignKeyConstraint(['genome_id'], [f'metadata_r{version}.genome_id']), 
                                 ForeignKeyConstraint(['gene_id'], [f'proteins_r{version}.gene_id']),
-                                {'extend_existing':True})  
+                                ForeignKeyConstraint(['ko_id'], [f'vocabulary_ko_r{version}.ko_id']),
+                                # Filters on the KO are almost always ordered by genome, so the index can also be used for sorting. Because 
+                                # InnoDB secondary indices include the primary key, this also covers counts. 
+                                Index(f'ix_annotations_kegg_r{version}_ko_genome', 'ko_id', 'genome_id'),
+                                # Used for joins on the genome ID, and for ordering the results by genome. 
+                                Index(f'ix_annotations_kegg_r{version}_genome_gene', 'genome_id', 'gene_id'),
+                                partitioning=partitioning)  
 
     # Set table column attributes. 
-    attrs['annotation_id'] = mapped_column(Integer, primary_key=True)
+    attrs['annotation_id'] = mapped_column(Integer, primary_key=True, autoincrement=True) # Needs to be explicit if the primary key includes the partitioning column.
     attrs['version'] = mapped_column(Integer, comment='The GTDB version from which the data was obtained.')
     attrs['gene_id'] = mapped_column(String(GENE_ID_LENGTH))
     attrs['genome_id'] = mapped_column(String(GENOME_ID_LENGTH))
-    attrs['ko'] = mapped_column(String(DEFAULT_STRING_LENGTH), index=True) # The KEGG Orthology group with which the gene was annotated.
+    attrs['ko_id'] = mapped_column(Integer) # The KEGG Orthology group with which the gene was annotated, as an ID in the KO vocabulary table.
     attrs['threshold'] = mapped_column(Float) # The adaptive threshold for the bitscore generated using Kofamscan
     attrs['score'] = mapped_column(Float) # The bit score generated using Kofamscan which gives a measure of similarity between the gene and the KO family.
     attrs['e_value'] = mapped_column(Float)
 
+    add_partition_key(attrs, partitioning)
+
     return type(name, parents, attrs)
 
 
@@ -148,12 +237,13 @@ def create_metadata_table(version:int):
     attrs['mean_scaffold_length'] = mapped_column(Float)
     attrs['protein_count'] = mapped_column(Integer)
     attrs['ncbi_genome_representation'] = mapped_column(String(DEFAULT_STRING_LENGTH))
+    attrs['taxonomy_index'] = mapped_column(Integer, index=True, comment='The position of the genome when sorted by lineage. Genomes in the same clade have consecutive indices.')
     
     return type(name, parents, attrs)
 
 
 
-def create_annotations_pfam_table(version:int):
+def create_annotations_pfam_table(version:int, partitioning:Partitioning=None):
 
     # class Base(DeclarativeBase):
     #     pass 
@@ -168,23 +258,153 @@ def create_annotations_pfam_table(version:int):
     attrs['__tablename__'] = f'annotations_pfam_r{version}'
     attrs[f'metadata_r{version}'] = relationship(f'Metadata_r{version}', viewonly=True)
     attrs[f'proteins_r{version}'] = relationship(f'Proteins_r{version}', viewonly=True)
-    attrs['__table_args__'] = (ForeignKeyConstraint(['genome_id'], [f'metadata_r{version}.genome_id']), 
+    attrs[f'vocabulary_pfam_r{version}'] = relationship(f'VocabularyPfam_r{version}', viewonly=True)
+    attrs[f'vocabulary_interpro_r{version}'] = relationship(f'VocabularyInterpro_r{version}', viewonly=True)
+    attrs['partitioning'] = partitioning
+    attrs['__table_args__'] = get_table_args(ForeignKeyConstraint(['genome_id'], [f'metadata_r{version}.genome_id']), 
                                 ForeignKeyConstraint(['gene_id'], [f'proteins_r{version}.gene_id']),
-                                {'extend_existing':True}) 
+                                ForeignKeyConstraint(['pfam_id'], [f'vocabulary_pfam_r{version}.pfam_id']),
+                                ForeignKeyConstraint(['interpro_id'], [f'vocabulary_interpro_r{version}.interpro_id']),
+                                Index(f'ix_annotations_pfam_r{version}_pfam_genome', 'pfam_id', 'genome_id'),
+                                Index(f'ix_annotations_pfam_r{version}_genome_gene', 'genome_id', 'gene_id'),
+                                partitioning=partitioning) 
 
     # Set attributes for all the table columns. 
-    attrs['annotation_id'] = mapped_column(Integer, primary_key=True)
+    attrs['annotation_id'] = mapped_column(Integer, primary_key=True, autoincrement=True) # Needs to be explicit if the primary key includes the partitioning column.
     attrs['version'] = mapped_column(Integer, comment='The GTDB version from which the data was obtained.')
     attrs['gene_id'] = mapped_column(String(GENE_ID_LENGTH))
     attrs['genome_id'] = mapped_column(String(GENOME_ID_LENGTH))
-    attrs['pfam'] = mapped_column(String(DEFAULT_STRING_LENGTH), index=True) # The KEGG Orthology group with which the gene was annotated.
+    attrs['pfam_id'] = mapped_column(Integer) # The Pfam family with which the gene was annotated, as an ID in the Pfam vocabulary table.
     attrs['start'] = mapped_column(Integer)
     attrs['stop'] = mapped_column(Integer)
     attrs['length'] = mapped_column(Integer)
     attrs['e_value'] = mapped_column(Float)
-    attrs['interpro_accession'] = mapped_column(String(DEFAULT_STRING_LENGTH))
-    attrs['interpro_description'] = mapped_column(String(200))
+    attrs['interpro_id'] = mapped_column(Integer) # The InterPro accession and description are stored in the InterPro vocabulary table.
+
+    add_partition_key(attrs, partitioning)
+
+    return type(name, parents, attrs)
+
+
+# Taxonomic ranks, from highest to lowest. 
+RANKS = ['gtdb_domain', 'gtdb_phylum', 'gtdb_class', 'gtdb_order', 'gtdb_family', 'gtdb_genus', 'gtdb_species']
+
+
+def create_taxonomy_table(version:int):
+    '''Create a table storing the nodes of the GTDB taxonomy as a nested set. Each node stores the (inclusive) range of taxonomy 
+    indices of the genomes beneath it in the metadata table. See utils/taxonomy.py.'''
+
+    name = f'Taxonomy_r{version}'
+    parents = (Base, Reflected)
+
+    attrs = dict()
+    attrs['__tablename__'] = f'taxonomy_r{version}'
+    attrs['__table_args__'] = (Index(f'ix_taxonomy_r{version}_rank_name', 'rank', 'name'), {'extend_existing':True})
+
+    # Set table column attributes. 
+    attrs['node_id'] = mapped_column(Integer, primary_key=True)
+    attrs['version'] = mapped_column(Integer, comment='The GTDB version from which the data was obtained.')
+    attrs['rank'] = mapped_column(String(DEFAULT_STRING_LENGTH), comment='The taxonomic rank, e.g. gtdb_phylum.')
+    attrs['name'] = mapped_column(String(DEFAULT_STRING_LENGTH), comment='The name of the taxon.')
+    attrs['parent_id'] = mapped_column(Integer, comment='The node ID of the parent taxon, or -1 for domains.')
+    attrs['left_index'] = mapped_column(Integer, comment='The smallest taxonomy index of the genomes in the taxon.')
+    attrs['right_index'] = mapped_column(Integer, comment='The largest taxonomy index of the genomes in the taxon.')
+
+    return type(name, parents, attrs)
+
+
+def create_boundaries_table(version:int):
+    '''Create a table storing the genome IDs which split the genomes into ranges with roughly the same number of proteins. These are 
+    used to split queries into disjoint pieces which can be run in parallel. Each boundary is the (inclusive) lower bound of a range.'''
+    attrs = dict()
+    attrs['__tablename__'] = f'boundaries_r{version}'
+    attrs['__table_args__'] = {'extend_existing':True}
+
+    attrs['boundary_id'] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    attrs['version'] = mapped_column(Integer, comment='The GTDB version from which the data was obtained.')
+    attrs['genome_id'] = mapped_column(String(GENOME_ID_LENGTH), comment='The smallest genome ID in the range.')
+
+    return type(f'Boundaries_r{version}', (Base, Reflected), attrs)
+
+
+def create_summary_table(version:int, field:str):
+    '''Create a table summarizing the annotations in one of the annotations tables. Each row contains the number of genomes, genes, and 
+    annotations in a taxon (at a particular rank) annotated with a particular KO or Pfam. These are built from the annotations and metadata
+    tables after they are loaded, so that these counts can be served without joining the annotations and metadata tables.
+
+    :param version: The GTDB version. 
+    :param field: The annotation field which is summarized, either ko or pfam. 
+    '''
+    name = 'kegg' if (field == 'ko') else 'pfam'
+
+    attrs = dict()
+    attrs['__tablename__'] = f'summary_{name}_r{version}'
+    attrs['__table_args__'] = {'extend_existing':True}
+
+    # Set table column attributes. The primary key is used for lookups by annotation, so the annotation field should come first. 
+    attrs[field] = mapped_column(String(DEFAULT_STRING_LENGTH), primary_key=True)
+    attrs['rank'] = mapped_column(String(DEFAULT_STRING_LENGTH), primary_key=True, comment='The taxonomic rank, e.g. gtdb_phylum.')
+    attrs['taxon'] = mapped_column(String(DEFAULT_STRING_LENGTH), primary_key=True, index=True, comment='The name of the taxon at the specified rank.')
+    attrs['version'] = mapped_column(Integer, comment='The GTDB version from which the data was obtained.')
+    attrs['n_genomes'] = mapped_column(Integer, comment='The number of genomes in the taxon with at least one annotation.')
+    attrs['n_genes'] = mapped_column(Integer, comment='The number of genes in the taxon with at least one annotation.')
+    attrs['n_annotations'] = mapped_column(Integer, comment='The total number of annotations in the taxon.')
+
+    return type(f'Summary{name.capitalize()}_r{version}', (Base, Reflected), attrs)
+
+
+def create_summary_kegg_table(version:int):
+    return create_summary_table(version, 'ko')
+
+
+def create_summary_pfam_table(version:int):
+    return create_summary_table(version, 'pfam')
+
+
+# NOTE: The KO, Pfam, and InterPro accessions (and the InterPro descriptions) are repeated on every row of the annotations tables, so 
+# they are dictionary-encoded, i.e. stored once in a vocabulary table and referred to by a small integer ID. The ID is just the numerical 
+# part of the accession (e.g. 1 for K00001), so that files can be encoded independently without agreeing on IDs ahead of time. 
+
+# Maps each dictionary-encoded field to the vocabulary it is stored in, and the name of the ID column. 
+VOCABULARIES = {'ko':('ko', 'ko_id'), 'pfam':('pfam', 'pfam_id'), 'interpro_accession':('interpro', 'interpro_id'), 'interpro_description':('interpro', 'interpro_id')}
+
+
+def get_accession_id(accession:str) -> int:
+    '''Get the integer ID for a KO, Pfam, or InterPro accession, e.g. 1 for K00001. Missing accessions (which InterProScan 
+    writes as a dash) have an ID of 0.'''
+    digits = re.sub(r'\D', '', str(accession))
+    return 0 if (len(digits) == 0) else int(digits)
+
+
+def create_vocabulary_table(version:int, vocabulary:str):
+    '''Create a table which stores the values of a dictionary-encoded field in the annotations tables. 
+
+    :param version: The GTDB version. 
+    :param vocabulary: The name of the vocabulary, one of ko, pfam, or interpro. 
+    '''
+    attrs = dict()
+    attrs['__tablename__'] = f'vocabulary_{vocabulary}_r{version}'
+    attrs['__table_args__'] = {'extend_existing':True}
+
+    attrs[f'{vocabulary}_id'] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    if vocabulary == 'interpro':
+        # The descriptions are searched by keyword using the [match] operator, which needs a FULLTEXT index. 
+        attrs['__table_args__'] = (Index(f'ix_vocabulary_interpro_r{version}_description', 'interpro_description', mariadb_prefix='FULLTEXT'), {'extend_existing':True})
+        attrs['interpro_accession'] = mapped_column(String(DEFAULT_STRING_LENGTH), unique=True)
+        attrs['interpro_description'] = mapped_column(String(200))
+    else:
+        attrs[vocabulary] = mapped_column(String(DEFAULT_STRING_LENGTH), unique=True)
+
+    return type(f'Vocabulary{vocabulary.capitalize()}_r{version}', (Base, Reflected), attrs)
+
+
+def create_vocabulary_ko_table(version:int):
+    return create_vocabulary_table(version, 'ko')
+
 
-    return type(name, parents, attrs) 
+def create_vocabulary_pfam_table(version:int):
+    return create_vocabulary_table(version, 'pfam')
 
 
+def create_vocabulary_interpro_table(version:int):
+    return create_vocabulary_table(version, 'interpro')
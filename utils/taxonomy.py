@@ -0,0 +1,36 @@
+'''Functions for building a nested-set encoding of the GTDB taxonomy. Genomes are sorted by lineage and assigned a taxonomy index (their
+position in the sorted order), so that all genomes in a clade have consecutive indices. Each node in the taxonomy (a taxon at a particular
+rank) stores the range of indices of the genomes beneath it, which means that "everything in order X" can be answered with an integer range
+on the metadata table, regardless of the rank.'''
+import pandas as pd
+import numpy as np
+from typing import Tuple
+from utils.tables import RANKS
+
+
+def build_taxonomy(data:pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    '''Build the taxonomy nodes from the metadata for every genome. The metadata should contain all genomes in the database (i.e.
+    the data from all metadata files), as the taxonomy indices need to be unique across the whole table.
+
+    :param data: A DataFrame with a genome_id column and a column for every rank in RANKS.
+    :return: A tuple containing the metadata (sorted by lineage, with a new taxonomy_index column) and the taxonomy nodes. The nodes
+        have columns node_id, rank, name, parent_id, left_index, and right_index (the range is inclusive).
+    '''
+    data = data.sort_values(RANKS + ['genome_id']).reset_index(drop=True)
+    data['taxonomy_index'] = np.arange(len(data))
+
+    nodes = []
+    parent_ids = np.full(len(data), -1) # Root nodes have no parent.
+    for i, rank in enumerate(RANKS):
+        # Each node is identified by the full lineage down to the rank, which handles names (like 'none') appearing in multiple places.
+        lineage = data[RANKS[:i + 1]].astype(str).agg(';'.join, axis=1).values
+        # Because the genomes are sorted by lineage, each node is a run of consecutive genomes.
+        starts = np.concatenate([[0], np.where(lineage[1:] != lineage[:-1])[0] + 1])
+        stops = np.concatenate([starts[1:] - 1, [len(data) - 1]])
+        node_ids = np.arange(len(nodes), len(nodes) + len(starts))
+        for node_id, start, stop in zip(node_ids, starts, stops):
+            nodes.append({'node_id':node_id, 'rank':rank, 'name':data[rank].iloc[start], 'parent_id':parent_ids[start], 'left_index':start, 'right_index':stop})
+        parent_ids = np.repeat(node_ids, stops - starts + 1) # The nodes at this rank are the parents of the nodes at the next rank.
+
+    nodes = pd.DataFrame(nodes, columns=['node_id', 'rank', 'name', 'parent_id', 'left_index', 'right_index'])
+    return data, nodes